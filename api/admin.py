@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from api.models import Order, Payment, CreditCard, EBTCard
+from api.models import Order, Payment, PaymentAttempt, CreditCard, EBTCard, DailySettlement, ArchivedOrder, ArchivedPayment, StatusEvent
 
 class CreditCardAdmin(admin.ModelAdmin):
     list_display = ("id", "last_4", "brand", "exp_month", "exp_year")
@@ -12,9 +12,29 @@ class OrderAdmin(admin.ModelAdmin):
     list_display = ("id", "order_total", "status", "success_date")
 
 class PaymentAdmin(admin.ModelAdmin):
-    list_display = ("id", "order", "amount", "payment_method", "status", "success_date")
+    list_display = ("id", "order", "amount", "payment_method", "status", "success_date", "attempt_count", "next_retry_at")
+
+class PaymentAttemptAdmin(admin.ModelAdmin):
+    list_display = ("id", "payment", "attempt", "status", "error", "created_at")
+
+class DailySettlementAdmin(admin.ModelAdmin):
+    list_display = ("date", "source", "status", "brand", "tender", "count", "amount")
+
+class ArchivedOrderAdmin(admin.ModelAdmin):
+    list_display = ("id", "order_total", "status", "success_date", "archived_at")
+
+class ArchivedPaymentAdmin(admin.ModelAdmin):
+    list_display = ("id", "order", "amount", "payment_method", "status", "archived_at")
+
+class StatusEventAdmin(admin.ModelAdmin):
+    list_display = ("id", "object_type", "object_id", "order_id", "status", "created_at")
 
 admin.site.register(CreditCard, CreditCardAdmin)
 admin.site.register(Order, OrderAdmin)
 admin.site.register(Payment, PaymentAdmin)
+admin.site.register(PaymentAttempt, PaymentAttemptAdmin)
 admin.site.register(EBTCard, EBTCardAdmin)
+admin.site.register(DailySettlement, DailySettlementAdmin)
+admin.site.register(ArchivedOrder, ArchivedOrderAdmin)
+admin.site.register(ArchivedPayment, ArchivedPaymentAdmin)
+admin.site.register(StatusEvent, StatusEventAdmin)
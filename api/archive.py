@@ -0,0 +1,96 @@
+# Moves settled orders, together with their payments, out of the hot tables.
+#
+# Orders are selected by keyset pagination on the primary key and every batch is
+# copied and deleted in its own short transaction, so live traffic only ever waits
+# on --batch-size rows at a time. An optional pause between batches throttles the
+# run further on busy databases. Sharded orders are archived one shard after the
+# other, each into the archive tables of its own shard.
+
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from api.models import ArchivedOrder, ArchivedPayment, Order, Payment
+from api.sharding import order_shards
+
+
+ARCHIVABLE_ORDER_STATUSES = (Order.TYPE_SUCCEEDED, Order.TYPE_FAILED)
+
+
+def copy_row(archive_model, obj):
+    return archive_model(**{
+        field.attname: getattr(obj, field.attname)
+        for field in obj._meta.concrete_fields
+    })
+
+
+def archivable_orders(cutoff, using=None):
+    return Order.objects.using(using).filter(status__in=ARCHIVABLE_ORDER_STATUSES).annotate(
+        settled_date=Coalesce("processed_date", "success_date"),
+    ).filter(settled_date__lt=cutoff).exclude(
+        # Failed orders stay while the retry scheduler may still succeed their payments
+        payment__next_retry_at__isnull=False,
+    )
+
+
+def archive_batch(order_ids, cutoff, using=None):
+    """ Archives the given orders and their payments, returns (orders, payments) moved. """
+    with transaction.atomic(using=using):
+        # Re-check the conditions inside the transaction, an order may have been
+        # captured again since it was picked
+        orders = list(
+            archivable_orders(cutoff, using).filter(pk__in=order_ids).select_for_update()
+        )
+        if not orders:
+            return 0, 0
+        order_ids = [order.pk for order in orders]
+        payments = list(Payment.objects.using(using).filter(order_id__in=order_ids))
+
+        ArchivedOrder.objects.using(using).bulk_create([copy_row(ArchivedOrder, order) for order in orders])
+        ArchivedPayment.objects.using(using).bulk_create([copy_row(ArchivedPayment, payment) for payment in payments])
+
+        Payment.objects.using(using).filter(pk__in=[payment.pk for payment in payments]).delete()
+        Order.objects.using(using).filter(pk__in=order_ids).delete()
+
+    return len(orders), len(payments)
+
+
+def archive_settled_orders(older_than_days, batch_size=500, pause=0, max_batches=None, progress=None):
+    """ Archives every order that succeeded or failed more than older_than_days ago.
+
+    progress is called with the running totals after every batch. Returns a dict with
+    the number of orders, payments and batches processed and the elapsed seconds.
+    """
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+    started = time.monotonic()
+    totals = {"orders": 0, "payments": 0, "batches": 0}
+
+    for using in order_shards():
+        last_id = 0
+        while max_batches is None or totals["batches"] < max_batches:
+            order_ids = list(
+                archivable_orders(cutoff, using)
+                .filter(pk__gt=last_id)
+                .order_by("pk")
+                .values_list("pk", flat=True)[:batch_size]
+            )
+            if not order_ids:
+                break
+            last_id = order_ids[-1]
+
+            orders, payments = archive_batch(order_ids, cutoff, using)
+            totals["orders"] += orders
+            totals["payments"] += payments
+            totals["batches"] += 1
+
+            if progress is not None:
+                progress(dict(totals, seconds=time.monotonic() - started))
+
+            if pause:
+                time.sleep(pause)
+
+    totals["seconds"] = time.monotonic() - started
+    return totals
@@ -0,0 +1,146 @@
+# Set-based deletes for cards and orders.
+#
+# Model.delete() and QuerySet.delete() run Django's deletion collector, which loads
+# every related Payment into memory before deleting anything. The functions below
+# walk the rows to delete by primary key in batches instead, and remove the rows
+# which reference them with plain DELETE ... WHERE statements, so memory use only
+# depends on the batch size.
+#
+# Payments point at cards through a generic foreign key, which the database knows
+# nothing about. Deleting cards therefore either refuses to run when payments still
+# reference them (restrict) or deletes those payments first (cascade). Payments are
+# looked up in every order shard (see api/sharding.py), cards are on 'default'.
+# delete() on a card or a queryset of cards (the admin included) calls delete_cards
+# with restrict, see CardQuerySet.delete.
+#
+# Settled orders and payments are taken out of the DailySettlement rollups in the
+# transaction that deletes them, on their own shard (see api/settlements.py).
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+
+from api.models import ArchivedPayment, Order, Payment, PaymentAttempt
+from api.settlements import record_deletions
+from api.sharding import order_shards
+
+
+ON_DELETE_RESTRICT = "restrict"
+ON_DELETE_CASCADE = "cascade"
+ON_DELETE_CHOICE = (
+    (ON_DELETE_RESTRICT, "restrict"),
+    (ON_DELETE_CASCADE, "cascade"),
+)
+
+
+class DeleteRestricted(Exception):
+    """ Raised when restricted cards are still referenced by payments. """
+
+    def __init__(self, message, payment_count):
+        super().__init__(message)
+        self.payment_count = payment_count
+
+
+def raw_delete(queryset):
+    # _raw_delete issues a single DELETE without collecting related objects. It is
+    # the same call Django uses for its own fast deletes; every reference to the
+    # deleted rows is removed explicitly by the callers below.
+    return queryset._raw_delete(queryset.db)
+
+
+def batched_ids(queryset, batch_size):
+    """ Yields lists of primary keys of queryset, batch_size at a time, in pk order. """
+    last_id = None
+    while True:
+        batch = queryset.order_by("pk")
+        if last_id is not None:
+            batch = batch.filter(pk__gt=last_id)
+        ids = list(batch.values_list("pk", flat=True)[:batch_size])
+        if not ids:
+            return
+        yield ids
+        last_id = ids[-1]
+
+
+def card_payments(card_model, card_ids):
+    """ Live and archived payments of the cards, one queryset per model and shard. """
+    content_type = ContentType.objects.get_for_model(card_model)
+    return [
+        payment_model.objects.using(using).filter(content_type=content_type, payment_method_id__in=card_ids)
+        for using in order_shards()
+        for payment_model in (Payment, ArchivedPayment)
+    ]
+
+
+def restricted_payment_count(card_model, ids):
+    return sum(payments.count() for payments in card_payments(card_model, ids))
+
+
+def delete_cards(card_model, queryset=None, on_delete=ON_DELETE_RESTRICT, batch_size=1000):
+    """ Deletes the CreditCard or EBTCard rows in queryset (defaults to all of them).
+
+    Returns a dict with the number of cards and payments deleted. Raises
+    DeleteRestricted, before anything is deleted, if on_delete is restrict and any
+    payment (live or archived) references one of the cards. Every batch is checked
+    again right before it is deleted, with its cards locked, so a payment created in
+    the meantime stops the delete at its card's batch instead of being orphaned.
+    """
+    if queryset is None:
+        queryset = card_model.objects.all()
+
+    if on_delete == ON_DELETE_RESTRICT:
+        # Batch by batch, a subquery can not reach across databases when sharded
+        payment_count = sum(
+            restricted_payment_count(card_model, ids) for ids in batched_ids(queryset, batch_size)
+        )
+        if payment_count:
+            raise DeleteRestricted(
+                "{} payments still reference these cards".format(payment_count),
+                payment_count,
+            )
+    elif on_delete != ON_DELETE_CASCADE:
+        raise ValueError("Unknown on_delete behaviour {!r}".format(on_delete))
+
+    deleted = {"cards": 0, "payments": 0}
+    for ids in batched_ids(queryset, batch_size):
+        with transaction.atomic():
+            # Payments are created with their card locked (see PaymentSerializer.create),
+            # on backends with row locks none can be added to these cards from here on
+            ids = list(card_model.objects.filter(pk__in=ids).select_for_update().values_list("pk", flat=True))
+            if on_delete == ON_DELETE_RESTRICT:
+                payment_count = restricted_payment_count(card_model, ids)
+                if payment_count:
+                    raise DeleteRestricted(
+                        "{} payments started referencing these cards during the delete".format(payment_count),
+                        payment_count,
+                    )
+            else:
+                for payments in card_payments(card_model, ids):
+                    with transaction.atomic(using=payments.db):
+                        record_deletions(payments)
+                        if payments.model is Payment:
+                            raw_delete(PaymentAttempt.objects.using(payments.db).filter(payment__in=payments))
+                        deleted["payments"] += raw_delete(payments)
+            deleted["cards"] += raw_delete(card_model.objects.filter(pk__in=ids))
+    return deleted
+
+
+def delete_orders(queryset=None, batch_size=1000):
+    """ Deletes the orders in queryset (defaults to all of them) and their payments.
+
+    Returns a dict with the number of orders and payments deleted.
+    """
+    if queryset is None:
+        queryset = Order.objects.all()
+
+    deleted = {"orders": 0, "payments": 0}
+    for using in order_shards():
+        for ids in batched_ids(queryset.using(using), batch_size):
+            with transaction.atomic(using=using):
+                payments = Payment.objects.using(using).filter(order_id__in=ids)
+                orders = Order.objects.using(using).filter(pk__in=ids)
+                record_deletions(payments)
+                record_deletions(orders)
+                raw_delete(PaymentAttempt.objects.using(using).filter(payment__order_id__in=ids))
+                deleted["payments"] += raw_delete(payments)
+                deleted["orders"] += raw_delete(orders)
+    return deleted
@@ -0,0 +1,171 @@
+# Card number validation for the card endpoints and bulk imports.
+#
+# Brands are inferred from the leading digits (BIN/IIN) of the number with a
+# precomputed table of prefix ranges. Every range is widened to BIN_LENGTH digits,
+# so a lookup is one int() of the first six digits and one bisect over the sorted
+# range starts, whatever the number of ranges. The Luhn checksum uses str.translate
+# tables instead of per digit arithmetic, which keeps the whole check in C.
+#
+# Every function works on whole batches and returns one result per input row.
+# clean_cards() is the entry point used by the card serializers and the import
+# command, see benchmarks/card_validation.py for throughput numbers.
+
+from bisect import bisect_right
+from datetime import date
+
+from api.models import DEFAULT_CARD_NUMBER, CreditCard
+
+
+BIN_LENGTH = 6
+
+# (first prefix, last prefix, brand, allowed number lengths)
+BIN_RANGES = (
+    ("34", "34", CreditCard.TYPE_AMEX, (15,)),
+    ("37", "37", CreditCard.TYPE_AMEX, (15,)),
+    ("4", "4", CreditCard.TYPE_VISA, (13, 16, 19)),
+    ("2221", "2720", CreditCard.TYPE_MASTERCARD, (16,)),
+    ("51", "55", CreditCard.TYPE_MASTERCARD, (16,)),
+    ("6011", "6011", CreditCard.TYPE_DISCOVER, (16, 17, 18, 19)),
+    ("622126", "622925", CreditCard.TYPE_DISCOVER, (16, 17, 18, 19)),
+    ("644", "649", CreditCard.TYPE_DISCOVER, (16, 17, 18, 19)),
+    ("65", "65", CreditCard.TYPE_DISCOVER, (16, 17, 18, 19)),
+)
+
+
+def build_bin_index(ranges):
+    """ Returns (starts, entries) where entries[i] covers starts[i] up to entries[i][0]. """
+    widened = sorted(
+        (
+            int(low.ljust(BIN_LENGTH, "0")),
+            int(high.ljust(BIN_LENGTH, "9")),
+            brand,
+            frozenset(lengths),
+        )
+        for low, high, brand, lengths in ranges
+    )
+    for previous, current in zip(widened, widened[1:]):
+        if current[0] <= previous[1]:
+            raise ValueError("Overlapping BIN ranges {} and {}".format(previous, current))
+    return [entry[0] for entry in widened], [entry[1:] for entry in widened]
+
+
+BIN_STARTS, BIN_ENTRIES = build_bin_index(BIN_RANGES)
+
+# Digits in odd positions from the right are doubled, 2 * d - 9 when that exceeds 9
+LUHN_DOUBLED = str.maketrans("0123456789", "0246813579")
+
+
+def luhn_valid(number):
+    # Summing the ASCII bytes and subtracting ord("0") once per digit avoids an
+    # int() call per digit
+    reversed_digits = number[::-1]
+    doubled = reversed_digits[1::2].translate(LUHN_DOUBLED)
+    total = sum(reversed_digits[::2].encode()) + sum(doubled.encode()) - 48 * len(number)
+    return total % 10 == 0
+
+
+def is_digits(number):
+    # str.isdigit() alone accepts other Unicode digits, e.g. "²", which int() rejects
+    return number.isascii() and number.isdigit()
+
+
+def infer_brand(number):
+    """ Returns (brand, allowed lengths) for the number, or (None, None) when unknown. """
+    if len(number) < BIN_LENGTH or not is_digits(number[:BIN_LENGTH]):
+        return None, None
+    prefix = int(number[:BIN_LENGTH])
+    position = bisect_right(BIN_STARTS, prefix) - 1
+    if position < 0:
+        return None, None
+    high, brand, lengths = BIN_ENTRIES[position]
+    if prefix > high:
+        return None, None
+    return brand, lengths
+
+
+def is_expired(exp_month, exp_year, today):
+    # exp_year has 2 digits, e.g. 26 instead of 2026. Cards are valid until the end
+    # of their expiry month.
+    return (2000 + exp_year, exp_month) < (today.year, today.month)
+
+
+def validate_numbers(numbers, require_brand=True):
+    """ Validates a batch of card numbers.
+
+    Returns a list with one (brand, errors) tuple per number, in order. brand is the
+    inferred brand or None, errors is a list of messages and empty for valid numbers.
+    With require_brand=False numbers from unknown BINs (e.g. state issued EBT cards)
+    are accepted as long as their checksum is valid.
+    """
+    results = []
+    append = results.append
+    for number in numbers:
+        if not is_digits(number):
+            append((None, ["Card number must only contain digits."]))
+            continue
+
+        errors = []
+        brand, lengths = infer_brand(number)
+        if brand is None:
+            if require_brand:
+                errors.append("Card number does not belong to a supported card brand.")
+        elif len(number) not in lengths:
+            errors.append("{} card numbers must be {} digits long.".format(
+                brand.capitalize(), " or ".join(str(length) for length in sorted(lengths))
+            ))
+        if not luhn_valid(number):
+            errors.append("Card number checksum is invalid.")
+        append((brand, errors))
+    return results
+
+
+def validate_expiries(expiries, today=None):
+    """ Validates a batch of (exp_month, exp_year) pairs, returns one error list per pair. """
+    today = today or date.today()
+    results = []
+    for exp_month, exp_year in expiries:
+        if not 1 <= exp_month <= 12:
+            results.append(["Expiry month must be in the range 1 <= month <= 12."])
+        elif is_expired(exp_month, exp_year, today):
+            results.append(["Card has expired."])
+        else:
+            results.append([])
+    return results
+
+
+def clean_cards(rows, require_brand=True, today=None):
+    """ Validates a batch of card dicts (number, brand and, for credit cards, exp_month
+    and exp_year) as the card serializers and the import command receive them.
+
+    The inferred brand replaces the one sent by the client, and last_4 is taken from
+    the number when missing (it must match the number when given). Returns one dict
+    of field -> error messages per row, empty for valid rows.
+    """
+    numbers = validate_numbers([row.get("number", "") for row in rows], require_brand)
+    expiring = [i for i, row in enumerate(rows) if "exp_month" in row and "exp_year" in row]
+    expiries = validate_expiries(
+        [(rows[i]["exp_month"], rows[i]["exp_year"]) for i in expiring], today
+    )
+
+    errors = [{} for _ in rows]
+    for row, row_errors, (brand, number_errors) in zip(rows, errors, numbers):
+        if number_errors:
+            row_errors["number"] = number_errors
+        if brand is not None:
+            row["brand"] = brand
+        elif not row.get("brand"):
+            row_errors["brand"] = ["Brand could not be inferred from the card number."]
+        number = row.get("number", "")
+        if number == DEFAULT_CARD_NUMBER:
+            # Not a real number, legacy cards only hold their real last_4
+            if not row.get("last_4"):
+                row_errors["last_4"] = ["This field is required."]
+        elif not number_errors:
+            if "last_4" not in row:
+                row["last_4"] = number[-4:]
+            elif row["last_4"] != number[-4:]:
+                row_errors["last_4"] = ["Does not match the last 4 digits of the card number."]
+    for i, expiry_errors in zip(expiring, expiries):
+        if expiry_errors:
+            errors[i]["exp_month"] = expiry_errors
+    return errors
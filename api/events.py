@@ -0,0 +1,193 @@
+# Order and payment status change feed.
+#
+# processPayment and CaptureOrder append a StatusEvent row in the same transaction
+# as every status change. On an order shard other than 'default' the row is a
+# PendingStatusEvent next to the order, merged into StatusEvent asynchronously
+# (see api/outbox.py). Clients wait for events after a cursor (the id of the
+# last event they have seen) through /api/events/ (long-poll) or
+# /api/events/stream/ (Server-Sent Events) instead of polling GET /api/orders/:id/.
+#
+# Waiting clients are all served by one ChangeFeed per process. It keeps the most
+# recent events, already serialized, in memory and at most one thread at a time
+# fetches new rows from the database: right after a local commit, or every
+# refresh_interval seconds to pick up events written by other processes. However
+# many clients are waiting, the database sees about one query per interval.
+#
+# Ids are handed out when a row is inserted, not when its transaction commits, so
+# an event can become visible after events with higher ids. The feed never moves
+# its cursor past a missing id until gap_timeout seconds after it was first seen
+# missing: either its transaction commits by then, or it was rolled back and the
+# id is never used.
+
+import threading
+import time
+from collections import deque
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from api.models import Order, Payment, PendingStatusEvent, StatusEvent
+
+
+def record_status_events(objects, using=None):
+    """ Appends one StatusEvent per Order or Payment in objects, with its current status.
+
+    using is the database of objects, events of a shard other than 'default' are
+    written there as PendingStatusEvent rows.
+    """
+    event_model = StatusEvent if using is None or using == DEFAULT_DB_ALIAS else PendingStatusEvent
+    events = []
+    for obj in objects:
+        if isinstance(obj, Order):
+            events.append(event_model(
+                object_type=StatusEvent.TYPE_ORDER, object_id=obj.pk, order_id=obj.pk, status=obj.status,
+            ))
+        elif isinstance(obj, Payment):
+            events.append(event_model(
+                object_type=StatusEvent.TYPE_PAYMENT, object_id=obj.pk, order_id=obj.order_id, status=obj.status,
+            ))
+    if event_model is PendingStatusEvent:
+        PendingStatusEvent.objects.using(using).bulk_create(events)
+        return
+    StatusEvent.objects.bulk_create(events)
+    transaction.on_commit(change_feed.notify)
+
+
+def serialize_event(event):
+    return {
+        "id": event.id,
+        "object_type": event.object_type,
+        "object_id": event.object_id,
+        "order_id": event.order_id,
+        "status": event.status,
+        "created_at": event.created_at.isoformat(),
+    }
+
+
+class ChangeFeed:
+    def __init__(self, buffer_size=5000, refresh_interval=1.0, fetch_size=1000, gap_timeout=10.0):
+        self.condition = threading.Condition()
+        self.events = deque()
+        self.buffer_size = buffer_size
+        self.refresh_interval = refresh_interval
+        self.fetch_size = fetch_size
+        self.gap_timeout = gap_timeout
+
+        # Every event with an id above floor is in self.events, None until loaded
+        self.floor = None
+        # Every event up to last_id that will ever be visible has been fetched
+        self.last_id = 0
+        # First missing id of a gap -> when the gap was first seen
+        self.gaps = {}
+        self.stale = True
+        self.refreshing = False
+        self.last_refresh = 0.0
+
+    def notify(self):
+        """ Called after a local commit wrote events, the next waiter fetches them at once. """
+        with self.condition:
+            self.stale = True
+            self.condition.notify_all()
+
+    def refresh(self):
+        """ Fetches new events unless another thread is already doing it or it is too early. """
+        with self.condition:
+            if self.refreshing or not (self.stale or time.monotonic() - self.last_refresh >= self.refresh_interval):
+                return
+            self.refreshing = True
+            first_load = self.floor is None
+            last_id = self.last_id
+
+        try:
+            if first_load:
+                # Start with the most recent events, older cursors are served from the database
+                fetched = list(StatusEvent.objects.order_by("-id")[:self.buffer_size])[::-1]
+            else:
+                fetched = list(StatusEvent.objects.filter(id__gt=last_id).order_by("id")[:self.fetch_size])
+            fetched = [serialize_event(event) for event in fetched]
+        finally:
+            with self.condition:
+                self.refreshing = False
+
+        with self.condition:
+            if first_load:
+                self.floor = last_id = fetched[0]["id"] - 1 if fetched else 0
+            settled = self.settled(fetched, last_id)
+            self.events.extend(settled)
+            while len(self.events) > self.buffer_size:
+                self.floor = self.events.popleft()["id"]
+            if settled:
+                self.last_id = settled[-1]["id"]
+            # More rows than one fetch holds means we are behind, fetch again right away.
+            # Events held back behind a gap are fetched again on the next interval.
+            self.stale = bool(settled) and len(fetched) == self.fetch_size
+            self.last_refresh = time.monotonic()
+            self.condition.notify_all()
+
+    def settled(self, fetched, last_id):
+        """ The leading events of fetched (ordered by id, all above last_id) which no
+        missing id that may still commit precedes.
+        """
+        now = time.monotonic()
+        settled = []
+        expected = last_id + 1
+        for event in fetched:
+            if event["id"] > expected and now - self.gaps.setdefault(expected, now) < self.gap_timeout:
+                break
+            settled.append(event)
+            expected = event["id"] + 1
+        self.gaps = {first: seen for first, seen in self.gaps.items() if first >= expected}
+        return settled
+
+    def buffered_after(self, cursor, order_id, limit):
+        """ Events after cursor from memory, None if the cursor is older than the buffer. """
+        if self.floor is None or cursor < self.floor:
+            return None
+        events = []
+        for event in reversed(self.events):
+            if event["id"] <= cursor:
+                break
+            if order_id is None or event["order_id"] == order_id:
+                events.append(event)
+        return events[::-1][:limit]
+
+    def wait(self, cursor=None, timeout=25.0, order_id=None, limit=100):
+        """ Returns (events, cursor) with the events after cursor, waiting up to timeout
+        seconds for one to arrive. A cursor of None means "from now on".
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            self.refresh()
+            with self.condition:
+                if cursor is None and self.floor is not None:
+                    cursor = self.last_id
+                if cursor is None:
+                    # Another thread is still loading the feed, "now" is not known yet
+                    events, seen = [], None
+                else:
+                    events = self.buffered_after(cursor, order_id, limit)
+                    # Everything up to here has been looked at for this client
+                    seen = self.last_id
+
+            if events is None:
+                # A client resuming from far back reads the database directly once,
+                # its next cursor is served from memory. Only up to where the feed
+                # has settled, a gap above it may still be filled.
+                queryset = StatusEvent.objects.filter(id__gt=cursor, id__lte=seen).order_by("id")
+                if order_id is not None:
+                    queryset = queryset.filter(order_id=order_id)
+                events = [serialize_event(event) for event in queryset[:limit]]
+                seen = cursor
+
+            if events:
+                return events, events[-1]["id"]
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return [], cursor if seen is None else max(cursor, seen)
+
+            with self.condition:
+                if self.refreshing or not self.stale:
+                    self.condition.wait(min(remaining, self.refresh_interval))
+
+
+change_feed = ChangeFeed()
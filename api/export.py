@@ -0,0 +1,194 @@
+# Streaming export of orders and payments.
+#
+# Rows are read in primary key order with QuerySet.iterator(), which uses a
+# server-side cursor on PostgreSQL, and turned into flat dicts one chunk at a time.
+# For payments the brand and last_4 of the payment method are looked up with one
+# in_bulk() query per card type per chunk. Writers encode rows incrementally, so
+# memory use does not depend on the number of rows exported. Sharded orders and
+# payments are read from every shard at once and merged back into primary key order.
+# Amounts are stored in cents and exported as decimal strings, like the API serves them.
+
+import csv
+import heapq
+import io
+import json
+import zlib
+from itertools import islice
+from operator import itemgetter
+
+from django.contrib.contenttypes.models import ContentType
+
+from api.models import CreditCard, EBTCard, Order, Payment
+from api.money import format_cents
+from api.sharding import order_shards, sharding_enabled
+
+
+FORMAT_CSV = "csv"
+FORMAT_NDJSON = "ndjson"
+
+ORDER_COLUMNS = [
+    "id",
+    "order_total",
+    "ebt_total",
+    "status",
+    "success_date",
+    "processed_date",
+]
+
+PAYMENT_COLUMNS = [
+    "id",
+    "order_id",
+    "amount",
+    "description",
+    "status",
+    "success_date",
+    "processed_date",
+    "last_processing_error",
+    "payment_method_type",
+    "payment_method_id",
+    "payment_method_brand",
+    "payment_method_last_4",
+]
+
+# Integer cents in the database, decimal strings in exports
+MONEY_COLUMNS = {"order_total", "ebt_total", "amount"}
+
+
+def export_queryset(model, start=None, end=None, statuses=None, after_id=None):
+    """ start and end filter on processed_date (inclusive dates), after_id resumes an export. """
+    queryset = model.objects.order_by("pk")
+    if start is not None:
+        queryset = queryset.filter(processed_date__date__gte=start)
+    if end is not None:
+        queryset = queryset.filter(processed_date__date__lte=end)
+    if statuses:
+        queryset = queryset.filter(status__in=statuses)
+    if after_id is not None:
+        queryset = queryset.filter(pk__gt=after_id)
+    return queryset
+
+
+def iter_chunks(queryset, chunk_size):
+    iterator = queryset.iterator(chunk_size=chunk_size)
+    while True:
+        chunk = list(islice(iterator, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def format_money(row):
+    for column in MONEY_COLUMNS.intersection(row):
+        row[column] = format_cents(row[column])
+    return row
+
+
+def iter_order_rows(queryset, chunk_size=2000):
+    for order in queryset.values_list(*ORDER_COLUMNS).iterator(chunk_size=chunk_size):
+        yield format_money(dict(zip(ORDER_COLUMNS, order)))
+
+
+def iter_payment_rows(queryset, chunk_size=2000):
+    # The content type, not payment_card, is what CaptureOrder trusts for the tender
+    card_models = {
+        ContentType.objects.get_for_model(CreditCard).pk: CreditCard,
+        ContentType.objects.get_for_model(EBTCard).pk: EBTCard,
+    }
+    columns = [column for column in PAYMENT_COLUMNS if not column.startswith("payment_method_")]
+    queryset = queryset.values_list("content_type_id", "payment_method_id", *columns)
+
+    for chunk in iter_chunks(queryset, chunk_size):
+        cards = {}
+        for content_type_id, card_model in card_models.items():
+            ids = {row[1] for row in chunk if row[0] == content_type_id}
+            if ids:
+                cards[content_type_id] = card_model.objects.only("brand", "last_4").in_bulk(ids)
+
+        for row in chunk:
+            card = cards.get(row[0], {}).get(row[1])
+            card_model = card_models.get(row[0])
+            exported = dict(zip(columns, row[2:]))
+            exported["payment_method_type"] = card_model._meta.model_name if card_model else None
+            exported["payment_method_id"] = row[1]
+            exported["payment_method_brand"] = card.brand if card is not None else None
+            exported["payment_method_last_4"] = card.last_4 if card is not None else None
+            yield format_money(exported)
+
+
+def iter_rows_across_shards(iter_rows, queryset, chunk_size=2000):
+    """ iter_rows over queryset in every shard, merged in primary key order. """
+    if not sharding_enabled():
+        return iter_rows(queryset, chunk_size)
+    return heapq.merge(
+        *(iter_rows(queryset.using(using), chunk_size) for using in order_shards()),
+        key=itemgetter("id"),
+    )
+
+
+EXPORTS = {
+    "orders": (Order, ORDER_COLUMNS, iter_order_rows),
+    "payments": (Payment, PAYMENT_COLUMNS, iter_payment_rows),
+}
+
+
+def encode_value(value):
+    if value is None:
+        return None
+    if isinstance(value, (int, str)):
+        return value
+    # Datetimes
+    return value.isoformat() if hasattr(value, "isoformat") else str(value)
+
+
+def iter_csv(rows, columns, header=True):
+    """ Yields the CSV text of rows, one line at a time, header first. """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        value = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return value
+
+    if header:
+        writer.writerow(columns)
+        yield flush()
+    for row in rows:
+        writer.writerow([encode_value(row[column]) for column in columns])
+        yield flush()
+
+
+def iter_ndjson(rows, columns, header=True):
+    # NDJSON has no header, the argument only keeps the writers interchangeable
+    for row in rows:
+        yield json.dumps({column: encode_value(row[column]) for column in columns}) + "\n"
+
+
+WRITERS = {
+    FORMAT_CSV: iter_csv,
+    FORMAT_NDJSON: iter_ndjson,
+}
+
+
+def iter_gzip(chunks, flush_size=64 * 1024):
+    """ Gzips an iterable of text, yielding compressed bytes as they become available. """
+    compressor = zlib.compressobj(wbits=31) # 31 selects the gzip container
+    pending = 0
+    for chunk in chunks:
+        data = chunk.encode()
+        pending += len(data)
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+        if pending >= flush_size:
+            pending = 0
+            yield compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+
+def iter_export(target, file_format, chunk_size=2000, header=True, **filters):
+    """ Yields the text of an export of target ("orders" or "payments"). """
+    model, columns, iter_rows = EXPORTS[target]
+    rows = iter_rows_across_shards(iter_rows, export_queryset(model, **filters), chunk_size)
+    return WRITERS[file_format](rows, columns, header)
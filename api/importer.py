@@ -0,0 +1,304 @@
+# Streaming import of cards, orders and payments from CSV or NDJSON files.
+#
+# Records flow through a generator pipeline (read -> chunk -> validate -> write),
+# so only one chunk is ever held in memory whatever the size of the file. Every
+# chunk is validated with the rules of the API serializers, references to orders
+# and cards are checked with one query per chunk, and the valid rows are written
+# inside their own transaction with bulk_create, or COPY on PostgreSQL. After each
+# chunk is committed the number of records consumed is saved to a checkpoint file
+# so an interrupted import can be resumed where it stopped. Sharded orders and
+# payments are given their ids first and written to their shard (see api/sharding.py).
+#
+# A chunk spread over several shards is written in one transaction per shard, all
+# of them open until every write succeeded, so an error rolls the whole chunk back.
+# The transactions still commit one after the other: if the process dies between
+# two of those commits, the shards committed first keep their rows and resuming
+# imports them again, under new ids.
+
+import csv
+import gzip
+import io
+import json
+from collections import defaultdict
+from contextlib import ExitStack
+from itertools import islice
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from rest_framework import serializers
+
+from api.card_validation import clean_cards
+from api.models import CreditCard, EBTCard, Order, Payment, card_fingerprint, vault_key
+from api.sharding import assign_ids, group_by_shard, shard_for_id
+from api.serializers import (
+    CreditCardImportSerializer,
+    EBTCardImportSerializer,
+    OrderSerializer,
+    PaymentImportSerializer,
+)
+
+
+FORMAT_CSV = "csv"
+FORMAT_NDJSON = "ndjson"
+
+
+def open_text(path):
+    if str(path).endswith(".gz"):
+        return gzip.open(path, "rt", newline="")
+    return open(path, "r", newline="")
+
+
+class UnreadableRecord:
+    """ Stands for a record that could not be parsed, the importers reject it. """
+
+    def __init__(self, error):
+        self.errors = {"non_field_errors": ["Invalid JSON: {}".format(error)]}
+
+
+def read_records(path, file_format):
+    """ Yields one dict per record of the file, or an UnreadableRecord. """
+    with open_text(path) as f:
+        if file_format == FORMAT_CSV:
+            for row in csv.DictReader(f):
+                # Empty cells are missing values, not empty strings
+                yield {key: value for key, value in row.items() if value != ""}
+        else:
+            for line in f:
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except ValueError as e:
+                        # Rejected like an invalid record, so the numbering stays aligned
+                        yield UnreadableRecord(e)
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def copy_rows(model, instances, using=None):
+    """ Writes instances with a single COPY ... FROM STDIN (PostgreSQL only). """
+    connection = connections[using or DEFAULT_DB_ALIAS]
+    # Ids are only given up front when orders are sharded
+    with_pk = bool(instances) and instances[0].pk is not None
+    fields = [field for field in model._meta.concrete_fields if with_pk or not field.primary_key]
+
+    def encode(value):
+        if value is None:
+            return "\\N"
+        return (
+            str(value)
+            .replace("\\", "\\\\")
+            .replace("\t", "\\t")
+            .replace("\n", "\\n")
+            .replace("\r", "\\r")
+        )
+
+    buffer = io.StringIO()
+    for instance in instances:
+        for field in fields:
+            if getattr(field, "auto_now_add", False) or getattr(field, "auto_now", False):
+                field.pre_save(instance, add=True)
+        buffer.write("\t".join(
+            encode(field.get_db_prep_save(getattr(instance, field.attname), connection))
+            for field in fields
+        ))
+        buffer.write("\n")
+    buffer.seek(0)
+
+    quote = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            "COPY {} ({}) FROM STDIN".format(
+                quote(model._meta.db_table),
+                ", ".join(quote(field.column) for field in fields),
+            ),
+            buffer,
+        )
+
+
+class Importer:
+    """ Validates chunks of records and turns the valid ones into model instances.
+
+    prepare() returns (instances, rejected, skipped) where rejected is a list of
+    (position in the chunk, errors) and skipped the number of valid records which
+    did not need to be written.
+    """
+    model = None
+    serializer_class = None
+
+    def __init__(self):
+        # Building a serializer's fields is much slower than running them, so a
+        # single instance validates every record like ListSerializer does
+        self.serializer = self.serializer_class()
+
+    def validate_fields(self, records):
+        valid, rejected = [], []
+        for position, record in enumerate(records):
+            if isinstance(record, UnreadableRecord):
+                rejected.append((position, record.errors))
+                continue
+            try:
+                valid.append((position, self.serializer.run_validation(record)))
+            except serializers.ValidationError as e:
+                rejected.append((position, e.detail))
+        return valid, rejected
+
+    def prepare(self, records):
+        valid, rejected = self.validate_fields(records)
+        return [self.model(**data) for _, data in valid], rejected, 0
+
+    def databases(self, instances):
+        """ Returns {database alias: instances to write there}, None is the default database. """
+        return {None: instances}
+
+
+class ShardedImporter(Importer):
+    def databases(self, instances):
+        # One query reserves the ids of the whole chunk
+        assign_ids(instances)
+        return group_by_shard(instances)
+
+
+class CardImporter(Importer):
+    require_brand = True
+
+    def prepare(self, records):
+        valid, rejected = self.validate_fields(records)
+
+        # Brand, checksum and expiry checks for the whole chunk at once
+        card_errors = clean_cards([data for _, data in valid], require_brand=self.require_brand)
+        cards = []
+        for (position, data), errors in zip(valid, card_errors):
+            if errors:
+                rejected.append((position, errors))
+            else:
+                card = self.model(**data)
+                card.fingerprint = card_fingerprint(card.number)
+                cards.append(card)
+
+        # Cards that are already vaulted, or repeated within the chunk, are skipped
+        vaulted = set(self.model.objects.vaulted_keys(cards))
+        new_cards = []
+        for card in cards:
+            if vault_key(card) not in vaulted:
+                vaulted.add(vault_key(card))
+                new_cards.append(card)
+        return new_cards, rejected, len(cards) - len(new_cards)
+
+
+class CreditCardImporter(CardImporter):
+    model = CreditCard
+    serializer_class = CreditCardImportSerializer
+
+
+class EBTCardImporter(CardImporter):
+    model = EBTCard
+    serializer_class = EBTCardImportSerializer
+    require_brand = False
+
+
+class OrderImporter(ShardedImporter):
+    model = Order
+    serializer_class = OrderSerializer
+
+
+class PaymentImporter(ShardedImporter):
+    model = Payment
+    serializer_class = PaymentImportSerializer
+
+    card_models = {
+        Payment.TYPE_CREDITCARD: CreditCard,
+        Payment.TYPE_EBTCARD: EBTCard,
+    }
+
+    def prepare(self, records):
+        valid, rejected = self.validate_fields(records)
+
+        # One query per referenced table (and shard, for orders) for the whole chunk
+        wanted_orders = defaultdict(set)
+        for _, data in valid:
+            wanted_orders[shard_for_id(data["order"])].add(data["order"])
+        order_ids = set()
+        for using, ids in wanted_orders.items():
+            order_ids.update(Order.objects.using(using).filter(pk__in=ids).values_list("pk", flat=True))
+        card_ids = {
+            payment_card: set(
+                card_model.objects.filter(
+                    pk__in={data["payment_method"] for _, data in valid if data["payment_card"] == payment_card}
+                ).values_list("pk", flat=True)
+            )
+            for payment_card, card_model in self.card_models.items()
+        }
+
+        payments = []
+        for position, data in valid:
+            errors = {}
+            if data["order"] not in order_ids:
+                errors["order"] = ["Order {} does not exist.".format(data["order"])]
+            if data["payment_method"] not in card_ids[data["payment_card"]]:
+                errors["payment_method"] = ["{} {} does not exist.".format(
+                    self.card_models[data["payment_card"]].__name__, data["payment_method"]
+                )]
+            if errors:
+                rejected.append((position, errors))
+                continue
+
+            payment_card = data.pop("payment_card")
+            payments.append(Payment(
+                order_id=data.pop("order"),
+                payment_method_id=data.pop("payment_method"),
+                payment_card=payment_card,
+                content_type=ContentType.objects.get_for_model(self.card_models[payment_card]),
+                **data
+            ))
+        return payments, rejected, 0
+
+
+IMPORTERS = {
+    "credit_cards": CreditCardImporter,
+    "ebt_cards": EBTCardImporter,
+    "orders": OrderImporter,
+    "payments": PaymentImporter,
+}
+
+
+def run_import(importer, records, batch_size=1000, use_copy=False, start=0, on_chunk=None, on_reject=None):
+    """ Imports records (an iterable of dicts) chunk by chunk.
+
+    start is the number of records already imported by a previous run, they are
+    skipped. on_chunk is called with the running totals after every committed chunk
+    (totals["records"] is what to resume from), on_reject with (record number,
+    errors) for every invalid record. Returns the totals.
+    """
+    totals = {"records": start, "imported": 0, "rejected": 0, "skipped": 0}
+
+    for chunk in chunked(islice(records, start, None), batch_size):
+        instances, rejected, skipped = importer.prepare(chunk)
+
+        with ExitStack() as stack:
+            for using, group in importer.databases(instances).items():
+                stack.enter_context(transaction.atomic(using=using))
+                if use_copy:
+                    copy_rows(importer.model, group, using)
+                else:
+                    importer.model.objects.using(using).bulk_create(group, batch_size=batch_size)
+
+        if on_reject is not None:
+            for position, errors in sorted(rejected, key=lambda item: item[0]):
+                on_reject(totals["records"] + position + 1, errors)
+
+        totals["records"] += len(chunk)
+        totals["imported"] += len(instances)
+        totals["rejected"] += len(rejected)
+        totals["skipped"] += skipped
+
+        if on_chunk is not None:
+            on_chunk(totals)
+
+    return totals
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.archive import archive_settled_orders
+
+
+class Command(BaseCommand):
+    help = (
+        "Move orders that succeeded or failed more than --days days ago, together with "
+        "their payments, into the archive tables."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=90, help="Minimum age of an order in days")
+        parser.add_argument("--batch-size", type=int, default=500, help="Orders moved per transaction")
+        parser.add_argument("--pause", type=float, default=0.1, help="Seconds to sleep between batches")
+        parser.add_argument("--max-batches", type=int, help="Stop after this many batches")
+
+    def handle(self, *args, **options):
+        if options["days"] < 0:
+            raise CommandError("--days cannot be negative")
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be a positive number")
+
+        def progress(totals):
+            if options["verbosity"] > 1:
+                self.stdout.write(self.format_totals(totals))
+
+        totals = archive_settled_orders(
+            options["days"],
+            batch_size=options["batch_size"],
+            pause=options["pause"],
+            max_batches=options["max_batches"],
+            progress=progress,
+        )
+        self.stdout.write(self.style.SUCCESS(self.format_totals(totals)))
+
+    def format_totals(self, totals):
+        rows = totals["orders"] + totals["payments"]
+        seconds = totals["seconds"]
+        return "Archived {} orders and {} payments in {} batches ({:.2f}s, {:.0f} rows/s)".format(
+            totals["orders"],
+            totals["payments"],
+            totals["batches"],
+            seconds,
+            rows / seconds if seconds else 0,
+        )
@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.bulk_delete import (
+    DeleteRestricted,
+    ON_DELETE_CHOICE,
+    ON_DELETE_RESTRICT,
+    delete_cards,
+    delete_orders,
+)
+from api.models import CreditCard, EBTCard, Order
+
+
+CARD_MODELS = {
+    "credit_cards": CreditCard,
+    "ebt_cards": EBTCard,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete cards or orders by id or filter with set-based SQL. Payments of deleted "
+        "orders are always deleted, payments of deleted cards follow --on-delete."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("target", choices=sorted(CARD_MODELS) + ["orders"])
+        parser.add_argument("--ids", help="Comma separated ids, e.g. 1,2,3")
+        parser.add_argument("--brand", choices=[brand for brand, _ in CreditCard.CARD_BRAND_CHOICE])
+        parser.add_argument("--status", choices=[status for status, _ in Order.ORDER_STATUS_CHOICE])
+        parser.add_argument("--on-delete", choices=[choice for choice, _ in ON_DELETE_CHOICE], default=ON_DELETE_RESTRICT)
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--all", action="store_true", help="Delete every row of the target")
+
+    def handle(self, *args, **options):
+        target = options["target"]
+        if target == "orders":
+            model = Order
+            filters = {"status": options["status"]}
+            if options["brand"]:
+                raise CommandError("--brand only applies to cards")
+        else:
+            model = CARD_MODELS[target]
+            filters = {"brand": options["brand"]}
+            if options["status"]:
+                raise CommandError("--status only applies to orders")
+
+        queryset = model.objects.filter(**{field: value for field, value in filters.items() if value})
+        if options["ids"]:
+            try:
+                ids = [int(value) for value in options["ids"].split(",")]
+            except ValueError:
+                raise CommandError("--ids must be a comma separated list of numbers")
+            queryset = queryset.filter(pk__in=ids)
+        elif not any(filters.values()) and not options["all"]:
+            raise CommandError("Pass --ids, a filter or --all to select what to delete")
+
+        if target == "orders":
+            deleted = delete_orders(queryset, batch_size=options["batch_size"])
+        else:
+            try:
+                deleted = delete_cards(
+                    model, queryset, on_delete=options["on_delete"], batch_size=options["batch_size"]
+                )
+            except DeleteRestricted as e:
+                raise CommandError("{}, pass --on-delete cascade to delete them too".format(e))
+
+        self.stdout.write(self.style.SUCCESS(
+            "Deleted " + ", ".join("{} {}".format(count, name) for name, count in deleted.items())
+        ))
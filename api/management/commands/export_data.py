@@ -0,0 +1,120 @@
+import gzip
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date
+
+from api.export import EXPORTS, FORMAT_CSV, FORMAT_NDJSON, WRITERS, export_queryset, iter_rows_across_shards
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream every order or payment, in primary key order, to a CSV or NDJSON file. "
+        "The id of the last row written and the size of the file are checkpointed as the "
+        "export goes, rerun with --resume to cut the file back to the checkpoint and "
+        "append the rows that are still missing."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("target", choices=sorted(EXPORTS))
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=[FORMAT_CSV, FORMAT_NDJSON], default=FORMAT_CSV)
+        parser.add_argument("--gzip", action="store_true", help="Gzip the output (implied by a .gz path)")
+        parser.add_argument("--start", help="First processed date to export (YYYY-MM-DD)")
+        parser.add_argument("--end", help="Last processed date to export (YYYY-MM-DD)")
+        parser.add_argument("--status", action="append", help="Only export rows with this status, can be repeated")
+        parser.add_argument("--after-id", type=int, help="Only export rows with a greater id")
+        parser.add_argument("--resume", action="store_true", help="Continue after the last checkpointed id")
+        parser.add_argument("--checkpoint", help="Progress file, defaults to <path>.progress")
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        model, columns, iter_rows = EXPORTS[options["target"]]
+        path = options["path"]
+        checkpoint = options["checkpoint"] or path + ".progress"
+
+        after_id = options["after_id"]
+        offset = None
+        if options["resume"] and os.path.exists(checkpoint):
+            if os.path.exists(path):
+                with open(checkpoint) as f:
+                    progress = json.load(f)
+                after_id, offset = progress["last_id"], progress.get("offset")
+                self.stdout.write("Resuming after id {}".format(after_id))
+            else:
+                # The rows before the checkpoint went away with the file
+                self.stdout.write("{} does not exist anymore, exporting from the start".format(path))
+        appending = after_id is not None and os.path.exists(path)
+
+        queryset = export_queryset(
+            model,
+            start=self.parse_day(options["start"], "--start"),
+            end=self.parse_day(options["end"], "--end"),
+            statuses=options["status"],
+            after_id=after_id,
+        )
+
+        exported = {"rows": 0, "last_id": after_id}
+
+        def tracked(rows):
+            for row in rows:
+                exported["rows"] += 1
+                exported["last_id"] = row["id"]
+                yield row
+
+        compress = options["gzip"] or path.endswith(".gz")
+        output = open(path, "r+b" if appending else "wb")
+        if appending and offset is not None:
+            # Whatever was written after the checkpoint, possibly half a line, goes
+            output.truncate(offset)
+        output.seek(0, os.SEEK_END)
+
+        def write_chunk(lines):
+            # A chunk is written in one go and only then checkpointed, together with
+            # the size of the file. Each gzip chunk is a complete gzip member, which
+            # readers concatenate, so the file can be cut at any checkpoint.
+            data = "".join(lines).encode()
+            output.write(gzip.compress(data) if compress else data)
+            output.flush()
+            os.fsync(output.fileno())
+            with open(checkpoint + ".tmp", "w") as f:
+                json.dump({"last_id": exported["last_id"], "offset": output.tell()}, f)
+            os.replace(checkpoint + ".tmp", checkpoint)
+
+        started = time.monotonic()
+        chunk_size = options["chunk_size"]
+        with output:
+            lines = WRITERS[options["format"]](
+                tracked(iter_rows_across_shards(iter_rows, queryset, chunk_size)), columns, header=not appending
+            )
+            pending = []
+            for line in lines:
+                pending.append(line)
+                if exported["rows"] and exported["rows"] % chunk_size == 0:
+                    write_chunk(pending)
+                    pending = []
+            write_chunk(pending)
+
+        seconds = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            "Exported {} {} up to id {} ({:.2f}s, {:.0f} rows/s)".format(
+                exported["rows"],
+                options["target"],
+                exported["last_id"],
+                seconds,
+                exported["rows"] / seconds if seconds else 0,
+            )
+        ))
+
+    def parse_day(self, value, name):
+        if value is None:
+            return None
+        try:
+            day = parse_date(value)
+        except ValueError:
+            day = None
+        if day is None:
+            raise CommandError("{} must be a date in the YYYY-MM-DD format".format(name))
+        return day
@@ -0,0 +1,84 @@
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.bulk_delete import batched_ids, raw_delete
+from api.models import DEFAULT_CARD_NUMBER, ArchivedPayment, CreditCard, EBTCard, Payment, card_fingerprint, vault_key
+from api.sharding import order_shards
+
+
+class Command(BaseCommand):
+    help = (
+        "Fingerprint cards created before fingerprints existed. Cards which are already "
+        "vaulted are merged into the existing card: their payments are pointed at it and "
+        "the duplicate row is deleted. Cards holding the default number, which legacy "
+        "cards got when none was supplied, are only merged when their last_4, brand "
+        "and expiry match too."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be a positive number")
+
+        for card_model in (CreditCard, EBTCard):
+            fingerprinted, merged = self.backfill(card_model, options["batch_size"])
+            self.stdout.write(self.style.SUCCESS(
+                "{}: fingerprinted {} cards, merged {} duplicates".format(
+                    card_model.__name__, fingerprinted, merged
+                )
+            ))
+            # Legacy cards whose number was never supplied, they cannot be told apart
+            # by fingerprint and were kept as separate cards
+            collisions = card_model.objects.filter(fingerprint=card_fingerprint(DEFAULT_CARD_NUMBER)).count()
+            if collisions > 1:
+                self.stdout.write(self.style.WARNING(
+                    "{}: {} distinct cards share the default number {}".format(
+                        card_model.__name__, collisions, DEFAULT_CARD_NUMBER
+                    )
+                ))
+
+    def backfill(self, card_model, batch_size):
+        content_type = ContentType.objects.get_for_model(card_model)
+        fingerprinted = merged = 0
+
+        for ids in batched_ids(card_model.objects.filter(fingerprint__isnull=True), batch_size):
+            cards = list(
+                card_model.objects.filter(pk__in=ids)
+                .only("pk", "number", *card_model.IDENTITY_FIELDS)
+                .order_by("pk")
+            )
+            for card in cards:
+                card.fingerprint = card_fingerprint(card.number)
+
+            # One lookup for every card of the batch which is already vaulted
+            survivors = card_model.objects.vaulted_keys(cards)
+
+            to_update = []
+            duplicates = defaultdict(list)  # survivor pk -> duplicate pks
+            for card in cards:
+                key = vault_key(card)
+                if key in survivors:
+                    duplicates[survivors[key]].append(card.pk)
+                else:
+                    survivors[key] = card.pk
+                    to_update.append(card)
+
+            with transaction.atomic():
+                card_model.objects.bulk_update(to_update, ["fingerprint"])
+                for survivor, duplicate_ids in duplicates.items():
+                    for using in order_shards():
+                        for payment_model in (Payment, ArchivedPayment):
+                            payment_model.objects.using(using).filter(
+                                content_type=content_type, payment_method_id__in=duplicate_ids
+                            ).update(payment_method_id=survivor)
+                    raw_delete(card_model.objects.filter(pk__in=duplicate_ids))
+
+            fingerprinted += len(to_update)
+            merged += sum(len(duplicate_ids) for duplicate_ids in duplicates.values())
+
+        return fingerprinted, merged
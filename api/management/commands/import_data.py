@@ -0,0 +1,104 @@
+import json
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api.importer import FORMAT_CSV, FORMAT_NDJSON, IMPORTERS, read_records, run_import
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream a CSV or NDJSON file (optionally gzipped) of cards, orders or payments "
+        "into the database. Records use the same fields as the POST bodies in fixtures/, "
+        "payments also need payment_card. Progress is checkpointed after every chunk, "
+        "rerun with --resume to continue an interrupted import."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("target", choices=sorted(IMPORTERS))
+        parser.add_argument("path")
+        parser.add_argument("--format", choices=[FORMAT_CSV, FORMAT_NDJSON], help="Defaults to the file extension")
+        parser.add_argument("--batch-size", type=int, default=1000, help="Records per chunk and transaction")
+        parser.add_argument("--resume", action="store_true", help="Skip the records imported by a previous run")
+        parser.add_argument("--checkpoint", help="Progress file, defaults to <path>.progress")
+        parser.add_argument("--rejects", help="Write rejected records and their errors to this NDJSON file")
+        parser.add_argument("--no-copy", action="store_true", help="Use bulk_create even on PostgreSQL")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        if not os.path.exists(path):
+            raise CommandError("{} does not exist".format(path))
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be a positive number")
+
+        file_format = options["format"] or self.guess_format(path)
+        checkpoint = options["checkpoint"] or path + ".progress"
+        start = self.read_checkpoint(checkpoint) if options["resume"] else 0
+        use_copy = connection.vendor == "postgresql" and not options["no_copy"]
+
+        started = time.monotonic()
+        rejects = open(options["rejects"], "a") if options["rejects"] else None
+        shown_rejects = []
+
+        def on_reject(record, errors):
+            if rejects is not None:
+                rejects.write(json.dumps({"record": record, "errors": errors}) + "\n")
+            elif len(shown_rejects) < 10:
+                shown_rejects.append(record)
+                self.stderr.write("Record {} rejected: {}".format(record, json.dumps(errors)))
+
+        def on_chunk(totals):
+            with open(checkpoint, "w") as f:
+                json.dump({"records": totals["records"]}, f)
+            if options["verbosity"] > 1:
+                self.stdout.write(self.format_totals(totals, start, started))
+
+        if start:
+            self.stdout.write("Resuming after record {}".format(start))
+
+        try:
+            totals = run_import(
+                IMPORTERS[options["target"]](),
+                read_records(path, file_format),
+                batch_size=options["batch_size"],
+                use_copy=use_copy,
+                start=start,
+                on_chunk=on_chunk,
+                on_reject=on_reject,
+            )
+        except (ValueError, UnicodeDecodeError) as e:
+            raise CommandError("Unable to read {}: {}".format(path, e))
+        finally:
+            if rejects is not None:
+                rejects.close()
+
+        self.stdout.write(self.style.SUCCESS(self.format_totals(totals, start, started)))
+
+    def guess_format(self, path):
+        name = path[:-3] if path.endswith(".gz") else path
+        if name.endswith(".csv"):
+            return FORMAT_CSV
+        if name.endswith((".ndjson", ".jsonl")):
+            return FORMAT_NDJSON
+        raise CommandError("Unable to guess the format of {}, pass --format".format(path))
+
+    def read_checkpoint(self, checkpoint):
+        try:
+            with open(checkpoint) as f:
+                return json.load(f)["records"]
+        except FileNotFoundError:
+            return 0
+
+    def format_totals(self, totals, start, started):
+        seconds = time.monotonic() - started
+        records = totals["records"] - start
+        return "{} records: {} imported, {} rejected, {} already present ({:.2f}s, {:.0f} records/s)".format(
+            records,
+            totals["imported"],
+            totals["rejected"],
+            totals["skipped"],
+            seconds,
+            records / seconds if seconds else 0,
+        )
@@ -0,0 +1,51 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.outbox import merge_outbox
+
+
+class Command(BaseCommand):
+    help = (
+        "Merge the settlement changes and status events written on the order shards "
+        "into DailySettlement and StatusEvent on 'default' (see api/outbox.py), in "
+        "batches of at most --batch-size rows per shard. Runs until interrupted unless "
+        "--once is given. Run a single instance, it keeps the events in order."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000, help="Rows of each kind merged per transaction")
+        parser.add_argument("--interval", type=float, default=1, help="Seconds to wait when nothing is pending")
+        parser.add_argument("--once", action="store_true", help="Exit as soon as nothing is pending")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be a positive number")
+
+        totals = {"settlements": 0, "events": 0}
+        started = time.monotonic()
+        try:
+            while True:
+                batch_started = time.monotonic()
+                # One batch per shard at a time, so that no shard waits for a busy one
+                merged = merge_outbox(options["batch_size"], max_batches=1)
+                for key, value in merged.items():
+                    totals[key] += value
+
+                if not any(merged.values()):
+                    if options["once"]:
+                        break
+                    time.sleep(options["interval"])
+                    continue
+
+                if options["verbosity"] > 1:
+                    self.stdout.write(self.format_totals(merged, time.monotonic() - batch_started))
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(self.format_totals(totals, time.monotonic() - started)))
+
+    def format_totals(self, totals, seconds):
+        return "Merged {} settlement changes and {} events ({:.2f}s)".format(
+            totals["settlements"], totals["events"], seconds,
+        )
@@ -0,0 +1,196 @@
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, Max, Min, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from api.models import (
+    ArchivedOrder, ArchivedPayment, CreditCard, DailySettlement, EBTCard, Order, Payment, PendingSettlement,
+)
+from api.settlements import SETTLED_ORDER_STATUSES, SETTLED_PAYMENT_STATUSES
+from api.sharding import order_shards, sharding_enabled
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the DailySettlement rollups from the Order and Payment tables and "
+        "their archives. Rows are aggregated in SQL one primary key range at a time, "
+        "so every query only touches --chunk-size rows of a table. Days up to "
+        "yesterday are rebuilt by default: captures keep bumping today's buckets while "
+        "the totals are computed, and those increments would be lost in the swap."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=10000)
+        parser.add_argument("--start", help="First day to rebuild (YYYY-MM-DD)")
+        parser.add_argument("--end", help="Last day to rebuild (YYYY-MM-DD), defaults to yesterday")
+        parser.add_argument(
+            "--include-today",
+            action="store_true",
+            help="Allow --end to be today or later, only safe while no captures or retries run",
+        )
+
+    def handle(self, *args, **options):
+        chunk_size = options["chunk_size"]
+        if chunk_size < 1:
+            raise CommandError("--chunk-size must be a positive number")
+
+        start = self.parse_day(options["start"], "--start")
+        today = timezone.localdate()
+        end = self.parse_day(options["end"], "--end") or today - timedelta(days=1)
+        if end >= today and not options["include_today"]:
+            raise CommandError(
+                "Today's buckets are still being updated by captures, pass --include-today "
+                "to rebuild them anyway"
+            )
+
+        started = time.monotonic()
+        totals = defaultdict(lambda: [0, 0])
+
+        # Changes not merged from the shards yet (see api/outbox.py) are already in
+        # the rows counted below
+        for using in order_shards():
+            pending = PendingSettlement.objects.using(using).filter(date__lte=end)
+            if start is not None:
+                pending = pending.filter(date__gte=start)
+            pending.delete()
+
+        for source, tender, brand_model, amount_field, queryset in self.sources():
+            # Rows that were never processed have no day to be rolled up under
+            queryset = queryset.annotate(
+                day=TruncDate(Coalesce("processed_date", "success_date")),
+            ).filter(day__isnull=False)
+            if start is not None:
+                queryset = queryset.filter(day__gte=start)
+            queryset = queryset.filter(day__lte=end)
+
+            # Sharded orders and payments are aggregated one shard after the other
+            for using in order_shards():
+                for rows in self.chunked_aggregates(queryset.using(using), chunk_size, brand_model, amount_field):
+                    for row in rows:
+                        key = (row["day"], source, row["status"], row["brand"], tender)
+                        totals[key][0] += row["count"]
+                        totals[key][1] += row["amount"]
+
+        rollups = [
+            DailySettlement(
+                date=day,
+                source=source,
+                status=status,
+                brand=brand,
+                tender=tender,
+                count=count,
+                amount=amount,
+            )
+            for (day, source, status, brand, tender), (count, amount) in totals.items()
+        ]
+
+        # Only the small rollup table is locked while the new totals are swapped in
+        with transaction.atomic():
+            existing = DailySettlement.objects.filter(date__lte=end)
+            if start is not None:
+                existing = existing.filter(date__gte=start)
+            existing.delete()
+            DailySettlement.objects.bulk_create(rollups, batch_size=1000)
+
+        self.stdout.write(self.style.SUCCESS(
+            "Rebuilt {} settlement rows in {:.2f}s".format(
+                len(rollups), time.monotonic() - started
+            )
+        ))
+
+    def parse_day(self, value, name):
+        if value is None:
+            return None
+        try:
+            day = parse_date(value)
+        except ValueError:
+            day = None
+        if day is None:
+            raise CommandError("{} must be a date in the YYYY-MM-DD format".format(name))
+        return day
+
+    def sources(self):
+        """ Yields (source, tender, card model, amount field, queryset) for every kind of rollup row.
+
+        Archived orders and payments (see api/archive.py) are still part of the
+        history, they are aggregated from the archive tables next to the live ones.
+        """
+        for order_model in (Order, ArchivedOrder):
+            yield (
+                DailySettlement.TYPE_ORDER,
+                "",
+                None,
+                "order_total",
+                order_model.objects.filter(status__in=SETTLED_ORDER_STATUSES),
+            )
+
+        for tender, card_model in (
+            (Payment.TYPE_CREDITCARD, CreditCard),
+            (Payment.TYPE_EBTCARD, EBTCard),
+        ):
+            for payment_model in (Payment, ArchivedPayment):
+                yield (
+                    DailySettlement.TYPE_PAYMENT,
+                    tender,
+                    card_model,
+                    "amount",
+                    payment_model.objects.filter(
+                        status__in=SETTLED_PAYMENT_STATUSES,
+                        content_type=ContentType.objects.get_for_model(card_model),
+                    ),
+                )
+
+    def chunked_aggregates(self, queryset, chunk_size, brand_model, amount_field):
+        # Bounds come from the primary key index alone, the filters are applied per chunk
+        bounds = queryset.model.objects.using(queryset.db).aggregate(low=Min("id"), high=Max("id"))
+        if bounds["low"] is None:
+            return
+
+        if brand_model is not None and sharding_enabled():
+            # The cards are on 'default', not next to the payments
+            yield from self.chunked_aggregates_by_card(queryset, chunk_size, bounds, brand_model, amount_field)
+            return
+
+        if brand_model is None:
+            brand = Value("")
+        else:
+            brand = Coalesce(
+                Subquery(
+                    brand_model.objects.filter(pk=OuterRef("payment_method_id")).values("brand")[:1]
+                ),
+                Value(""),
+            )
+
+        for low in range(bounds["low"], bounds["high"] + 1, chunk_size):
+            yield (
+                queryset.filter(id__gte=low, id__lt=low + chunk_size)
+                .annotate(brand=brand)
+                .values("day", "status", "brand")
+                .annotate(count=Count("id"), amount=Sum(amount_field))
+                .order_by()
+            )
+
+    def chunked_aggregates_by_card(self, queryset, chunk_size, bounds, brand_model, amount_field):
+        """ Same rows as chunked_aggregates, grouped by card first and by brand afterwards. """
+        for low in range(bounds["low"], bounds["high"] + 1, chunk_size):
+            rows = list(
+                queryset.filter(id__gte=low, id__lt=low + chunk_size)
+                .values("day", "status", "payment_method_id")
+                .annotate(count=Count("id"), amount=Sum(amount_field))
+                .order_by()
+            )
+            brands = dict(
+                brand_model.objects.filter(
+                    pk__in={row["payment_method_id"] for row in rows}
+                ).values_list("pk", "brand")
+            )
+            for row in rows:
+                row["brand"] = brands.get(row.pop("payment_method_id"), "")
+            yield rows
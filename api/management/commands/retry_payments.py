@@ -0,0 +1,59 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.retries import retry_due_payments
+
+
+class Command(BaseCommand):
+    help = (
+        "Retry payments which failed with a transient processor error once their "
+        "backoff has expired, in batches of at most --batch-size payments and no more "
+        "than --rate payments per second. Runs until interrupted unless --once is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100, help="Payments submitted per processor call")
+        parser.add_argument("--rate", type=float, default=20, help="Payments per second at most, 0 for no limit")
+        parser.add_argument("--interval", type=float, default=5, help="Seconds to wait when nothing is due")
+        parser.add_argument("--once", action="store_true", help="Exit as soon as nothing is due")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be a positive number")
+        if options["rate"] < 0:
+            raise CommandError("--rate cannot be negative")
+
+        totals = {"retried": 0, "succeeded": 0, "orders": 0}
+        started = time.monotonic()
+        try:
+            while True:
+                batch_started = time.monotonic()
+                batch = retry_due_payments(options["batch_size"])
+                for key, value in batch.items():
+                    totals[key] += value
+
+                if not batch["retried"]:
+                    if options["once"]:
+                        break
+                    time.sleep(options["interval"])
+                    continue
+
+                if options["verbosity"] > 1:
+                    self.stdout.write(self.format_totals(batch, time.monotonic() - batch_started))
+                # A batch of n payments takes at least n / rate seconds
+                if options["rate"]:
+                    time.sleep(max(batch["retried"] / options["rate"] - (time.monotonic() - batch_started), 0))
+        except KeyboardInterrupt:
+            pass
+
+        self.stdout.write(self.style.SUCCESS(self.format_totals(totals, time.monotonic() - started)))
+
+    def format_totals(self, totals, seconds):
+        return "Retried {} payments, {} succeeded, {} orders completed ({:.2f}s, {:.1f} payments/s)".format(
+            totals["retried"],
+            totals["succeeded"],
+            totals["orders"],
+            seconds,
+            totals["retried"] / seconds if seconds else 0,
+        )
@@ -0,0 +1,43 @@
+# Generated by Django 3.2.15 on 2026-10-19 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySettlement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('source', models.CharField(choices=[('order', 'order'), ('payment', 'payment')], max_length=10)),
+                ('status', models.CharField(max_length=24)),
+                ('brand', models.CharField(blank=True, default='', max_length=255)),
+                ('tender', models.CharField(blank=True, choices=[('creditcard', 'creditcard'), ('ebtcard', 'ebtcard')], default='', max_length=10)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'ordering': ['date', 'source', 'status', 'brand', 'tender'],
+            },
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='processed_date',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Date when an order was last captured'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='processed_date',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Date when a payment was last processed'),
+        ),
+        migrations.AddConstraint(
+            model_name='dailysettlement',
+            constraint=models.UniqueConstraint(fields=('date', 'source', 'status', 'brand', 'tender'), name='unique_daily_settlement_bucket'),
+        ),
+    ]
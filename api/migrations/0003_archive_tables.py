@@ -0,0 +1,44 @@
+# Generated by Django 3.2.15 on 2026-10-19 12:01
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('api', '0002_settlement_rollups'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedOrder',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('order_total', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('status', models.CharField(choices=[('draft', 'draft'), ('failed', 'failed'), ('succeeded', 'succeeded')], max_length=10)),
+                ('success_date', models.DateTimeField(blank=True, null=True)),
+                ('processed_date', models.DateTimeField(blank=True, null=True)),
+                ('ebt_total', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedPayment',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('description', models.CharField(max_length=255)),
+                ('payment_method_id', models.PositiveIntegerField()),
+                ('payment_card', models.CharField(choices=[('creditcard', 'creditcard'), ('ebtcard', 'ebtcard')], max_length=10)),
+                ('status', models.CharField(choices=[('requires_confirmation', 'requires_confirmation'), ('succeeded', 'succeeded'), ('failed', 'failed')], max_length=24)),
+                ('success_date', models.DateTimeField(blank=True, null=True)),
+                ('processed_date', models.DateTimeField(blank=True, null=True)),
+                ('last_processing_error', models.TextField(blank=True, null=True)),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='api.archivedorder')),
+            ],
+        ),
+    ]
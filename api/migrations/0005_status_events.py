@@ -0,0 +1,24 @@
+# Generated by Django 3.2.15 on 2026-10-19 12:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_card_fingerprints'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatusEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_type', models.CharField(choices=[('order', 'order'), ('payment', 'payment')], max_length=10)),
+                ('object_id', models.BigIntegerField()),
+                ('order_id', models.BigIntegerField(db_index=True)),
+                ('status', models.CharField(max_length=24)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
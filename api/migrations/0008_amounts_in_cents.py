@@ -0,0 +1,77 @@
+import django.core.validators
+from django.db import migrations, models
+from django.db.models import ExpressionWrapper, F
+from django.db.models.functions import Cast, Round
+
+
+# Every amount moves from a DecimalField with two places to a BigIntegerField of
+# cents (see api/money.py). For each field a <name>_cents column is added, filled in
+# with one UPDATE per table, and then takes the place of the decimal column.
+AMOUNTS = [
+    # (model, fields, max_digits, final field)
+    ("order", ["order_total", "ebt_total"], 12, lambda: models.BigIntegerField(validators=[django.core.validators.MinValueValidator(0)])),
+    ("payment", ["amount"], 12, lambda: models.BigIntegerField(validators=[django.core.validators.MinValueValidator(0)])),
+    ("archivedorder", ["order_total", "ebt_total"], 12, lambda: models.BigIntegerField()),
+    ("archivedpayment", ["amount"], 12, lambda: models.BigIntegerField()),
+    ("dailysettlement", ["amount"], 14, lambda: models.BigIntegerField(default=0)),
+]
+
+
+def to_cents(model_name, fields):
+    def forwards(apps, schema_editor):
+        model = apps.get_model("api", model_name)
+        model.objects.using(schema_editor.connection.alias).update(**{
+            field + "_cents": Cast(Round(F(field) * 100), models.BigIntegerField())
+            for field in fields
+        })
+    return forwards
+
+
+def from_cents(model_name, fields, max_digits):
+    def backwards(apps, schema_editor):
+        model = apps.get_model("api", model_name)
+        # Divided by a float so that SQLite does not divide integers
+        model.objects.using(schema_editor.connection.alias).update(**{
+            field: ExpressionWrapper(
+                F(field + "_cents") / 100.0,
+                output_field=models.DecimalField(decimal_places=2, max_digits=max_digits),
+            )
+            for field in fields
+        })
+    return backwards
+
+
+def operations():
+    for model_name, fields, max_digits, final_field in AMOUNTS:
+        for field in fields:
+            # With a default the decimal column can be added back to a filled
+            # table when the migration is reversed
+            yield migrations.AlterField(
+                model_name=model_name,
+                name=field,
+                field=models.DecimalField(decimal_places=2, max_digits=max_digits, default=0),
+            )
+            yield migrations.AddField(
+                model_name=model_name,
+                name=field + "_cents",
+                field=models.BigIntegerField(default=0),
+            )
+        # The hints let the routers run the conversion on every shard holding the table
+        yield migrations.RunPython(
+            to_cents(model_name, fields),
+            from_cents(model_name, fields, max_digits),
+            hints={"model_name": model_name},
+        )
+        for field in fields:
+            yield migrations.RemoveField(model_name=model_name, name=field)
+            yield migrations.RenameField(model_name=model_name, old_name=field + "_cents", new_name=field)
+            yield migrations.AlterField(model_name=model_name, name=field, field=final_field())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_payment_retries'),
+    ]
+
+    operations = list(operations())
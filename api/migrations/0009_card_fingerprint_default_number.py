@@ -0,0 +1,31 @@
+# Generated by Django 3.2.15 on 2026-10-19 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_amounts_in_cents'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='creditcard',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='ebtcard',
+            name='fingerprint',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='creditcard',
+            constraint=models.UniqueConstraint(condition=models.Q(('number', '4111111111111111'), _negated=True), fields=('fingerprint',), name='api_creditcard_fingerprint_uniq'),
+        ),
+        migrations.AddConstraint(
+            model_name='ebtcard',
+            constraint=models.UniqueConstraint(condition=models.Q(('number', '4111111111111111'), _negated=True), fields=('fingerprint',), name='api_ebtcard_fingerprint_uniq'),
+        ),
+    ]
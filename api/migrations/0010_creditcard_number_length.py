@@ -0,0 +1,18 @@
+# Generated by Django 3.2.15 on 2026-10-19 12:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_card_fingerprint_default_number'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='creditcard',
+            name='number',
+            field=models.CharField(default='4111111111111111', max_length=19),
+        ),
+    ]
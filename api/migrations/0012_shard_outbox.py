@@ -0,0 +1,53 @@
+# Generated by Django 3.2.15 on 2026-10-19 13:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_payment_content_type_across_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MergedBatch',
+            fields=[
+                ('batch', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('shard', models.CharField(max_length=100)),
+                ('merged_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PendingSettlement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('source', models.CharField(choices=[('order', 'order'), ('payment', 'payment')], max_length=10)),
+                ('status', models.CharField(max_length=24)),
+                ('brand', models.CharField(blank=True, default='', max_length=255)),
+                ('tender', models.CharField(blank=True, choices=[('creditcard', 'creditcard'), ('ebtcard', 'ebtcard')], default='', max_length=10)),
+                ('count', models.IntegerField(default=0)),
+                ('amount', models.BigIntegerField(default=0)),
+                ('batch', models.CharField(blank=True, db_index=True, max_length=32, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PendingStatusEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_type', models.CharField(choices=[('order', 'order'), ('payment', 'payment')], max_length=10)),
+                ('object_id', models.BigIntegerField()),
+                ('order_id', models.BigIntegerField()),
+                ('status', models.CharField(max_length=24)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('batch', models.CharField(blank=True, db_index=True, max_length=32, null=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='statusevent',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,6 +1,10 @@
+from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 # from django.db import models, CheckConstraint, Q, F
@@ -18,13 +22,105 @@ def validate_number_length(value):
     if not 16 <= len(value) <= 19:
         raise ValidationError('Number length must be between 16 and 19 characters.')
 
+
+# Before the card endpoints accepted a number every card got this default, so
+# legacy cards sharing it are not necessarily the same card
+DEFAULT_CARD_NUMBER = "4111111111111111"
+
+
+def card_fingerprint(number):
+    """ Keyed hash of a card number, identical for every card with the same number.
+
+    The key is settings.CARD_FINGERPRINT_KEY, so fingerprints cannot be brute forced
+    back into card numbers without it. Spaces and dashes are ignored.
+    """
+    digits = "".join(ch for ch in number if ch.isdigit())
+    return salted_hmac(
+        "api.models.card_fingerprint",
+        digits,
+        secret=settings.CARD_FINGERPRINT_KEY,
+        algorithm="sha256",
+    ).hexdigest()
+
+
+def vault_key(card):
+    """ What makes two cards the same card in the vault.
+
+    The fingerprint, unless the card holds DEFAULT_CARD_NUMBER: such a card is only
+    the same card as another one when its IDENTITY_FIELDS match as well.
+    """
+    if card.number != DEFAULT_CARD_NUMBER:
+        return (card.fingerprint,)
+    return (card.fingerprint,) + tuple(getattr(card, field) for field in card.IDENTITY_FIELDS)
+
+
+def delete_card(card):
+    """ Model.delete() of the cards, see CardQuerySet.delete. """
+    return type(card).objects.filter(pk=card.pk).delete()
+
+
+class CardQuerySet(models.QuerySet):
+    def vault(self, number, **fields):
+        """ Returns (card, created), reusing the existing card with the same number.
+
+        The lookup goes through the fingerprint index, so re-vaulting a card costs a
+        single index lookup. The fingerprint is unique for every number but
+        DEFAULT_CARD_NUMBER, which is matched on the rest of the card's details too.
+        A reissued card keeps its number, so a later expiry replaces the stored one.
+        """
+        if number != DEFAULT_CARD_NUMBER:
+            card, created = self.get_or_create(
+                fingerprint=card_fingerprint(number),
+                defaults=dict(fields, number=number),
+            )
+            expiry = tuple(fields.get(field) for field in self.model.EXPIRY_FIELDS)
+            if not created and None not in expiry and expiry > tuple(getattr(card, field) for field in self.model.EXPIRY_FIELDS):
+                for field, value in zip(self.model.EXPIRY_FIELDS, expiry):
+                    setattr(card, field, value)
+                card.save(update_fields=self.model.EXPIRY_FIELDS)
+            return card, created
+        card = self.filter(
+            fingerprint=card_fingerprint(number),
+            **{field: fields.get(field) for field in self.model.IDENTITY_FIELDS}
+        ).order_by("pk").first()
+        if card is not None:
+            return card, False
+        return self.create(number=number, **fields), True
+
+    def delete(self):
+        # Payments reference cards through a generic foreign key, which Django's
+        # deletion collector would only follow on 'default'. Every delete goes
+        # through api/bulk_delete.py instead, and is refused while payments (on any
+        # shard) still reference the cards.
+        from api.bulk_delete import delete_cards
+
+        deleted = delete_cards(self.model, self)
+        return deleted["cards"], {self.model._meta.label: deleted["cards"]}
+
+    def vaulted_keys(self, cards):
+        """ Maps the vault_key of every card already vaulted as one of cards to its pk. """
+        condition = Q(fingerprint__in={card.fingerprint for card in cards if card.number != DEFAULT_CARD_NUMBER})
+        defaulted = {card.last_4 for card in cards if card.number == DEFAULT_CARD_NUMBER}
+        if defaulted:
+            # Narrowed down by last_4, every legacy card holds the default fingerprint
+            condition |= Q(fingerprint=card_fingerprint(DEFAULT_CARD_NUMBER), last_4__in=defaulted)
+        vaulted = self.filter(condition).only("pk", "number", "fingerprint", *self.model.IDENTITY_FIELDS)
+        # Oldest card last, so that it wins when several share a key
+        return {vault_key(card): card.pk for card in vaulted.order_by("-pk")}
+
+
 class EBTCard(models.Model):
     number = models.CharField(
         max_length=19, 
-        default="4111111111111111",
+        default=DEFAULT_CARD_NUMBER,
         validators=[validate_number_length]  # Added the custom validator
     )
     last_4 = models.CharField(max_length=4)
+
+    # card_fingerprint(number), set on save. Null only for rows created before
+    # fingerprints existed, see `python manage.py fingerprint_cards`. Unique except
+    # for DEFAULT_CARD_NUMBER, see vault_key.
+    fingerprint = models.CharField(max_length=64, null=True, blank=True, editable=False, db_index=True)
     
     # Constants for card brands that ACME supports
     TYPE_AMEX = "amex"
@@ -39,6 +135,29 @@ class EBTCard(models.Model):
     )
 
     brand = models.CharField(max_length=255, choices=CARD_BRAND_CHOICE)
+
+    def delete(self, using=None, keep_parents=False):
+        return delete_card(self)
+
+    objects = CardQuerySet.as_manager()
+
+    # Tell cards holding DEFAULT_CARD_NUMBER apart, see vault_key
+    IDENTITY_FIELDS = ("last_4", "brand")
+    # Compared as a tuple when a card is vaulted again, see CardQuerySet.vault
+    EXPIRY_FIELDS = ()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["fingerprint"],
+                condition=~Q(number=DEFAULT_CARD_NUMBER),
+                name="api_ebtcard_fingerprint_uniq",
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.fingerprint = card_fingerprint(self.number)
+        super().save(*args, **kwargs)
     
     # exp_month = models.PositiveSmallIntegerField(validators=[validateMonth])
     # exp_year = models.PositiveSmallIntegerField() # 2 digits, e.g. 26 instead of 2026
@@ -46,9 +165,13 @@ class EBTCard(models.Model):
 
 class CreditCard(models.Model):
     number = models.CharField(
-        max_length=17, default="4111111111111111"
+        # Up to 19 digits, the longest numbers api/card_validation.py accepts
+        max_length=19, default=DEFAULT_CARD_NUMBER
     )
     last_4 = models.CharField(max_length=4)
+
+    # card_fingerprint(number), see EBTCard.fingerprint
+    fingerprint = models.CharField(max_length=64, null=True, blank=True, editable=False, db_index=True)
     
     # Constants for card brands that ACME supports
     TYPE_AMEX = "amex"
@@ -66,14 +189,32 @@ class CreditCard(models.Model):
     exp_month = models.PositiveSmallIntegerField(validators=[validateMonth])
     exp_year = models.PositiveSmallIntegerField() # 2 digits, e.g. 26 instead of 2026
 
+    def delete(self, using=None, keep_parents=False):
+        return delete_card(self)
+
+    objects = CardQuerySet.as_manager()
+
+    IDENTITY_FIELDS = ("last_4", "brand", "exp_month", "exp_year")
+    EXPIRY_FIELDS = ("exp_year", "exp_month")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["fingerprint"],
+                condition=~Q(number=DEFAULT_CARD_NUMBER),
+                name="api_creditcard_fingerprint_uniq",
+            ),
+        ]
+
+    def save(self, *args, **kwargs):
+        self.fingerprint = card_fingerprint(self.number)
+        super().save(*args, **kwargs)
+
 
 class Order(models.Model):
-    # The total amount which needs to be paid by the customer, including taxes and fees
-    order_total = models.DecimalField(
-        decimal_places=2,
-        max_digits=12,
-        validators=[MinValueValidator(0)],
-    )
+    # The total amount which needs to be paid by the customer, including taxes and fees.
+    # Like every amount it is stored in cents, see api/money.py.
+    order_total = models.BigIntegerField(validators=[MinValueValidator(0)])
 
     # Constants for order statuses
     TYPE_DRAFT = "draft"
@@ -97,14 +238,20 @@ class Order(models.Model):
         blank=True,
     )
 
+    # Set every time the order is captured, whether it succeeded or failed.
+    # Settlement rollups are bucketed by this date.
+    processed_date = models.DateTimeField(
+        "Date when an order was last captured",
+        null=True,
+        blank=True,
+    )
+
     # UNCOMMENT THIS FIELD TO GET STARTED!
     #
     # The amount which can be paid for with EBT. It's not necessarily true that the
-    # entire ebt_total will be satisfied with EBT tender.
+    # entire ebt_total will be satisfied with EBT tender. In cents.
 
-    ebt_total = models.DecimalField(
-        decimal_places=2, max_digits=12, validators=[MinValueValidator(0)]
-    )
+    ebt_total = models.BigIntegerField(validators=[MinValueValidator(0)])
 
     # adding database contraints for order_total >= ebt_total
     def save(self, *args, **kwargs):
@@ -119,19 +266,18 @@ class Payment(models.Model):
         Order, on_delete=models.CASCADE, db_index=True
     )
 
-    # What the customer actually chose to pay on the payment_method
-    amount = models.DecimalField(
-        decimal_places=2,
-        max_digits=12,
-        validators=[MinValueValidator(0)],
-    )
+    # What the customer actually chose to pay on the payment_method, in cents
+    amount = models.BigIntegerField(validators=[MinValueValidator(0)])
 
     description = models.CharField(max_length=255)
     
+    # Content types are read from 'default' whichever shard holds the payment (see
+    # api/sharding.py), the shards' own django_content_type rows may have other ids
     content_type = models.ForeignKey(
         ContentType,
         on_delete=models.CASCADE,
         default=1,
+        db_constraint=False,
     )
 
     payment_method_id = models.PositiveIntegerField(default=1)
@@ -173,8 +319,27 @@ class Payment(models.Model):
         blank=True,
     )
 
+    # Set every time the payment is submitted to the processor, whether it
+    # succeeded or failed. Settlement rollups are bucketed by this date.
+    processed_date = models.DateTimeField(
+        "Date when a payment was last processed",
+        null=True,
+        blank=True,
+    )
+
     last_processing_error = models.TextField(null=True, blank=True)
 
+    # Payments which failed with a transient error are retried by
+    # `python manage.py retry_payments` once next_retry_at has passed (see api/retries.py)
+    attempt_count = models.PositiveIntegerField(default=0)
+    next_retry_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # The retry queue: failed payments in next_retry_at order
+            models.Index(fields=["status", "next_retry_at"], name="api_payment_retry_idx"),
+        ]
+
     # def save(self, *args, **kwargs):
     #     content_type = None
         
@@ -196,7 +361,9 @@ class Payment(models.Model):
 
     def save(self, *args, **kwargs):
 
-        if self.payment_method:
+        # Only a payment_method assigned in this process needs copying, loading the
+        # card here would look for it in the payment's database (see api/sharding.py)
+        if self._meta.get_field("payment_method").is_cached(self) and self.payment_method:
             if isinstance(self.payment_method, CreditCard):
                 self.content_type = ContentType.objects.get_for_model(CreditCard)
             elif isinstance(self.payment_method, EBTCard):
@@ -205,6 +372,158 @@ class Payment(models.Model):
         super().save(*args, **kwargs)
 
 
+class DailySettlement(models.Model):
+    """ Running totals of orders and payments per day, status, card brand and tender.
 
+    Rows are kept up to date incrementally by processPayment and CaptureOrder (see
+    api/settlements.py) and can be recomputed from scratch with
+    `python manage.py rebuild_settlements`.
+    """
+    TYPE_ORDER = "order"
+    TYPE_PAYMENT = "payment"
+    SOURCE_CHOICE = (
+        (TYPE_ORDER, "order"),
+        (TYPE_PAYMENT, "payment"),
+    )
 
-    
+    date = models.DateField()
+    source = models.CharField(max_length=10, choices=SOURCE_CHOICE)
+    status = models.CharField(max_length=24)
+
+    # Blank for orders, which are not tied to a single card
+    brand = models.CharField(max_length=255, blank=True, default="")
+    tender = models.CharField(
+        max_length=10,
+        choices=Payment.PAYMENT_METHOD_CHOICE,
+        blank=True,
+        default="",
+    )
+
+    count = models.PositiveIntegerField(default=0)
+    amount = models.BigIntegerField(default=0) # cents
+
+    class Meta:
+        # The unique constraint leads with date, so it also serves date-range queries
+        constraints = [
+            models.UniqueConstraint(
+                fields=["date", "source", "status", "brand", "tender"],
+                name="unique_daily_settlement_bucket",
+            ),
+        ]
+        ordering = ["date", "source", "status", "brand", "tender"]
+
+
+class StatusEvent(models.Model):
+    """ Append-only log of Order and Payment status changes.
+
+    Ids only ever grow, so the id of the last event a client has seen is all it
+    needs to resume the feed (see api/events.py and /api/events/).
+    """
+    TYPE_ORDER = "order"
+    TYPE_PAYMENT = "payment"
+    OBJECT_TYPE_CHOICE = (
+        (TYPE_ORDER, "order"),
+        (TYPE_PAYMENT, "payment"),
+    )
+
+    object_type = models.CharField(max_length=10, choices=OBJECT_TYPE_CHOICE)
+    object_id = models.BigIntegerField()
+    # The order itself for order events, the parent order for payment events
+    order_id = models.BigIntegerField(db_index=True)
+    status = models.CharField(max_length=24)
+    # Set when the status changed, events merged from a shard keep their time
+    created_at = models.DateTimeField(default=timezone.now)
+
+
+class PendingSettlement(models.Model):
+    """ A change of a DailySettlement bucket made on an order shard.
+
+    Captures on a shard other than 'default' append these next to the payments
+    instead of updating the rollups on 'default', see api/outbox.py. batch is set
+    once the row is being merged.
+    """
+    date = models.DateField()
+    source = models.CharField(max_length=10, choices=DailySettlement.SOURCE_CHOICE)
+    status = models.CharField(max_length=24)
+    brand = models.CharField(max_length=255, blank=True, default="")
+    tender = models.CharField(max_length=10, choices=Payment.PAYMENT_METHOD_CHOICE, blank=True, default="")
+    count = models.IntegerField(default=0)
+    amount = models.BigIntegerField(default=0) # cents
+    batch = models.CharField(max_length=32, null=True, blank=True, db_index=True)
+
+
+class PendingStatusEvent(models.Model):
+    """ A StatusEvent written on an order shard, see PendingSettlement. """
+    object_type = models.CharField(max_length=10, choices=StatusEvent.OBJECT_TYPE_CHOICE)
+    object_id = models.BigIntegerField()
+    order_id = models.BigIntegerField()
+    status = models.CharField(max_length=24)
+    created_at = models.DateTimeField(default=timezone.now)
+    batch = models.CharField(max_length=32, null=True, blank=True, db_index=True)
+
+
+class MergedBatch(models.Model):
+    """ A batch of pending rows already merged into 'default', so that it is never
+    merged twice (see api/outbox.py).
+    """
+    batch = models.CharField(max_length=32, primary_key=True)
+    shard = models.CharField(max_length=100)
+    merged_at = models.DateTimeField(auto_now_add=True)
+
+
+class PaymentAttempt(models.Model):
+    """ One submission of a payment to the processor, written by processPayments.
+
+    Stored next to the payment, in its shard. Attempts are deleted together with
+    their payment, archiving included.
+    """
+    payment = models.ForeignKey(Payment, on_delete=models.CASCADE, related_name="attempts")
+    attempt = models.PositiveIntegerField()
+    status = models.CharField(max_length=24, choices=Payment.PAYMENT_STATUS_CHOICE)
+    error = models.TextField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+
+class ShardSequence(models.Model):
+    """ Next id to hand out for Order or Payment rows when they are sharded.
+
+    The database of each shard can not pick ids on its own, they would collide
+    across shards. Rows live on 'default', see api/sharding.py.
+    """
+    name = models.CharField(max_length=32, primary_key=True)
+    next_value = models.BigIntegerField(default=1)
+
+
+# Archive tables
+#
+# Orders which succeeded or failed a while ago are moved here together with their
+# payments by `python manage.py archive_orders` (see api/archive.py), which keeps
+# the hot Order and Payment tables small. Rows keep the id they had in the hot
+# table so that the retrieve endpoints can fall back to the archive transparently.
+
+class ArchivedOrder(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    order_total = models.BigIntegerField()
+    status = models.CharField(max_length=10, choices=Order.ORDER_STATUS_CHOICE)
+    success_date = models.DateTimeField(null=True, blank=True)
+    processed_date = models.DateTimeField(null=True, blank=True)
+    ebt_total = models.BigIntegerField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+
+class ArchivedPayment(models.Model):
+    id = models.BigIntegerField(primary_key=True)
+    order = models.ForeignKey(ArchivedOrder, on_delete=models.CASCADE, db_index=True)
+    amount = models.BigIntegerField()
+    description = models.CharField(max_length=255)
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE, db_constraint=False)
+    payment_method_id = models.PositiveIntegerField()
+    payment_method = GenericForeignKey('content_type', 'payment_method_id')
+    payment_card = models.CharField(max_length=10, choices=Payment.PAYMENT_METHOD_CHOICE)
+    status = models.CharField(max_length=24, choices=Payment.PAYMENT_STATUS_CHOICE)
+    success_date = models.DateTimeField(null=True, blank=True)
+    processed_date = models.DateTimeField(null=True, blank=True)
+    last_processing_error = models.TextField(null=True, blank=True)
+    attempt_count = models.PositiveIntegerField(default=0)
+    next_retry_at = models.DateTimeField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
@@ -0,0 +1,47 @@
+# Money amounts are stored as integers of minor units (cents): Order.order_total,
+# Order.ebt_total, Payment.amount, their archived copies and DailySettlement.amount.
+# Totals, capture validation and the settlement rollups are plain integer sums, in
+# SQL and in Python, with no Decimal arithmetic or rounding involved.
+#
+# The API still reads and writes amounts as decimal strings with two places
+# ("20.45"), CentsField converts at the serializer boundary.
+
+from decimal import Decimal, ROUND_HALF_UP
+
+from rest_framework import serializers
+
+
+CENTS_PER_UNIT = 100
+# Two decimal places, like the DecimalFields the amounts used to be stored in
+MAX_DIGITS = 12
+
+
+def to_cents(value):
+    """ Cents in a decimal amount (Decimal, string or int), rounded half up. """
+    value = value if isinstance(value, Decimal) else Decimal(str(value))
+    return int((value * CENTS_PER_UNIT).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def to_decimal(cents):
+    """ The decimal amount of cents, with two places. """
+    return Decimal(cents).scaleb(-2)
+
+
+def format_cents(cents):
+    """ cents as a decimal string with two places, e.g. 2045 -> "20.45". """
+    sign = "-" if cents < 0 else ""
+    units, remainder = divmod(abs(cents), CENTS_PER_UNIT)
+    return "{}{}.{:02d}".format(sign, units, remainder)
+
+
+class CentsField(serializers.DecimalField):
+    """ A decimal string in the API, integer cents in validated data and on the model. """
+
+    def __init__(self, max_digits=MAX_DIGITS, **kwargs):
+        super().__init__(max_digits=max_digits, decimal_places=2, **kwargs)
+
+    def to_internal_value(self, data):
+        return to_cents(super().to_internal_value(data))
+
+    def to_representation(self, value):
+        return super().to_representation(to_decimal(value))
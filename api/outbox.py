@@ -0,0 +1,136 @@
+# Rollup and feed changes of orders stored on a shard other than 'default'.
+#
+# A capture, retry or delete on such a shard writes nothing to 'default': the
+# DailySettlement changes and StatusEvents it makes are appended as PendingSettlement
+# and PendingStatusEvent rows in the shard's own transaction (see api/settlements.py
+# and api/events.py). Every shard then commits on its own and captures scale with
+# the number of shards instead of queueing on the rollup rows of 'default'.
+#
+# merge_outbox() moves the pending rows to 'default' a batch at a time, run it in a
+# loop with `python manage.py merge_outbox`. The settlement report and the change
+# feed lag behind the shards by the time between two merges. A single merge process
+# keeps the events of every shard in order.
+#
+# A merge spans two databases without a distributed transaction, so it goes in
+# three steps that can each be repeated:
+#
+#   1. Claim: the oldest unclaimed rows of the shard get a new batch id (committed).
+#   2. Apply: a MergedBatch row for the batch id, the bucket changes and the events
+#      are written in one transaction on 'default'. When MergedBatch already holds
+#      the batch id, it was applied before and is skipped.
+#   3. Delete the batch's rows from the shard.
+#
+# A merge interrupted after step 1 or 2 leaves claimed rows behind, the next one
+# finishes their batch first. Every row is applied exactly once.
+
+import uuid
+from collections import defaultdict
+
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+
+from api.events import change_feed
+from api.models import MergedBatch, PendingSettlement, PendingStatusEvent, StatusEvent
+from api.settlements import apply_deltas
+from api.sharding import order_shards
+
+
+PENDING_MODELS = (PendingSettlement, PendingStatusEvent)
+
+
+def claim_batch(using, batch_size):
+    """ Claims up to batch_size unclaimed rows of each pending model of a shard.
+
+    Returns the batch id, None when there was nothing to claim.
+    """
+    batch = uuid.uuid4().hex
+    claimed = 0
+    with transaction.atomic(using=using):
+        for model in PENDING_MODELS:
+            unclaimed = model.objects.using(using).filter(batch__isnull=True)
+            ids = list(unclaimed.order_by("pk").values_list("pk", flat=True)[:batch_size])
+            claimed += unclaimed.filter(pk__in=ids).update(batch=batch)
+    return batch if claimed else None
+
+
+def apply_batch(using, batch):
+    """ Applies the rows of a claimed batch to 'default' unless that was done already,
+    then deletes them from the shard. Returns the number of (settlements, events) applied.
+    """
+    settlements = list(PendingSettlement.objects.using(using).filter(batch=batch))
+    events = list(PendingStatusEvent.objects.using(using).filter(batch=batch).order_by("pk"))
+
+    deltas = defaultdict(lambda: [0, 0])
+    for row in settlements:
+        delta = deltas[(row.date, row.source, row.status, row.brand, row.tender)]
+        delta[0] += row.count
+        delta[1] += row.amount
+
+    applied = (len(settlements), len(events))
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        try:
+            with transaction.atomic(using=DEFAULT_DB_ALIAS):
+                MergedBatch.objects.using(DEFAULT_DB_ALIAS).create(batch=batch, shard=using)
+        except IntegrityError:
+            # Applied by an earlier, or a concurrent, merge
+            applied = (0, 0)
+        else:
+            apply_deltas(deltas, DEFAULT_DB_ALIAS)
+            StatusEvent.objects.using(DEFAULT_DB_ALIAS).bulk_create([
+                StatusEvent(
+                    object_type=event.object_type,
+                    object_id=event.object_id,
+                    order_id=event.order_id,
+                    status=event.status,
+                    created_at=event.created_at,
+                )
+                for event in events
+            ])
+            transaction.on_commit(change_feed.notify, using=DEFAULT_DB_ALIAS)
+
+    for model in PENDING_MODELS:
+        model.objects.using(using).filter(batch=batch).delete()
+    return applied
+
+
+def merge_shard(using, batch_size=1000, max_batches=None):
+    """ Merges the pending rows of one shard, returns the number of (settlements, events) merged. """
+    totals = [0, 0]
+
+    def add(applied):
+        totals[0] += applied[0]
+        totals[1] += applied[1]
+
+    # Batches left behind by an interrupted merge come first
+    left_behind = set()
+    for model in PENDING_MODELS:
+        left_behind.update(
+            model.objects.using(using).filter(batch__isnull=False).values_list("batch", flat=True).distinct()
+        )
+    for batch in sorted(left_behind):
+        add(apply_batch(using, batch))
+
+    merged_batches = 0
+    while max_batches is None or merged_batches < max_batches:
+        batch = claim_batch(using, batch_size)
+        if batch is None:
+            break
+        add(apply_batch(using, batch))
+        merged_batches += 1
+    return tuple(totals)
+
+
+def merge_outbox(batch_size=1000, max_batches=None):
+    """ Merges the pending rows of every shard but 'default' (which has none).
+
+    max_batches bounds the batches merged per shard. Returns a dict with the number
+    of settlement changes and events merged.
+    """
+    totals = {"settlements": 0, "events": 0}
+    for using in order_shards():
+        if using == DEFAULT_DB_ALIAS:
+            continue
+        settlements, events = merge_shard(using, batch_size, max_batches)
+        totals["settlements"] += settlements
+        totals["events"] += events
+    return totals
+
@@ -0,0 +1,204 @@
+# On-demand profiling of single requests.
+#
+# ProfilingMiddleware runs a request under cProfile and logs every SQL query it
+# makes (on every database, through connection.execute_wrapper). The raw profile
+# is saved to settings.PROFILE_DIR as <id>.prof, for pstats or snakeviz, next to
+# <id>.json holding the query log and a summary of the top functions and queries.
+# The id is sent back in the X-Profile-Id header and the summaries are served by
+# /api/profiles/.
+#
+# A request is profiled when its X-Profile header holds settings.PROFILE_TOKEN or,
+# failing that, with probability settings.PROFILE_SAMPLE_RATE. Profiles hold the
+# SQL and code paths of the requests, so /api/profiles/ needs the same header.
+# Unless settings.PROFILE_REQUESTS is on the middleware removes itself from the
+# stack at startup, so it costs nothing, and it refuses to start without a token.
+#
+# Streaming responses are only profiled up to the start of the stream.
+
+import cProfile
+import hmac
+import json
+import os
+import pstats
+import random
+import re
+import time
+import uuid
+from collections import defaultdict
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+
+
+PROFILE_HEADER = "HTTP_X_PROFILE"
+PROFILE_ID_RE = re.compile(r"[0-9a-f]{14}-[0-9a-f]{8}")
+TOP_FUNCTIONS = 25
+TOP_QUERIES = 10
+
+
+def profiling_enabled():
+    return getattr(settings, "PROFILE_REQUESTS", False)
+
+
+def profile_dir():
+    return str(settings.PROFILE_DIR)
+
+
+def has_profile_token(request):
+    """ Whether the X-Profile header of request holds settings.PROFILE_TOKEN. """
+    header = request.META.get(PROFILE_HEADER, "")
+    token = getattr(settings, "PROFILE_TOKEN", "")
+    # An empty token never matches, and the comparison takes the same time whatever the header
+    return bool(token) and hmac.compare_digest(header.encode(), token.encode())
+
+
+class QueryLog:
+    """ execute_wrapper recording the SQL and duration of every query. """
+
+    def __init__(self, alias, queries):
+        self.alias = alias
+        self.queries = queries
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            # Parameters are left out, they may hold card numbers
+            self.queries.append({
+                "database": self.alias,
+                "sql": sql,
+                "many": many,
+                "duration_ms": (time.perf_counter() - started) * 1000,
+            })
+
+
+def summarize_functions(profiler, sort_key):
+    stats = pstats.Stats(profiler).stats
+    rows = sorted(stats.items(), key=lambda item: item[1][sort_key], reverse=True)[:TOP_FUNCTIONS]
+    return [
+        {
+            "function": "{}:{}({})".format(*function),
+            "calls": calls,
+            "internal_ms": internal * 1000,
+            "cumulative_ms": cumulative * 1000,
+        }
+        for function, (_, calls, internal, cumulative, _) in rows
+    ]
+
+
+def summarize_queries(queries):
+    """ Queries grouped by SQL text, slowest total first. """
+    grouped = defaultdict(lambda: {"count": 0, "duration_ms": 0.0})
+    for query in queries:
+        group = grouped[(query["database"], query["sql"])]
+        group["count"] += 1
+        group["duration_ms"] += query["duration_ms"]
+    rows = sorted(grouped.items(), key=lambda item: item[1]["duration_ms"], reverse=True)[:TOP_QUERIES]
+    return [dict(database=database, sql=sql, **totals) for (database, sql), totals in rows]
+
+
+def save_profile(profiler, queries, summary):
+    directory = profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    profiler.dump_stats(os.path.join(directory, summary["id"] + ".prof"))
+    summary = dict(
+        summary,
+        functions=summarize_functions(profiler, 3),
+        internal_functions=summarize_functions(profiler, 2),
+        top_queries=summarize_queries(queries),
+        queries=queries,
+    )
+    with open(os.path.join(directory, summary["id"] + ".json"), "w") as f:
+        json.dump(summary, f)
+    prune_profiles(directory)
+
+
+def prune_profiles(directory):
+    # Ids start with the time, the oldest sort first
+    ids = sorted(name[:-5] for name in os.listdir(directory) if name.endswith(".json"))
+    for profile_id in ids[:max(len(ids) - settings.PROFILE_KEEP, 0)]:
+        for extension in (".json", ".prof"):
+            try:
+                os.remove(os.path.join(directory, profile_id + extension))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles(limit=50):
+    """ Newest profiles first, without their function and query details. """
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    ids = sorted((name[:-5] for name in os.listdir(directory) if name.endswith(".json")), reverse=True)
+    profiles = []
+    for profile_id in ids[:limit]:
+        profile = load_profile(profile_id)
+        if profile is not None:
+            profiles.append({key: profile[key] for key in profile if key not in (
+                "functions", "internal_functions", "top_queries", "queries",
+            )})
+    return profiles
+
+
+def load_profile(profile_id):
+    """ The saved summary of profile_id, None if there is none. """
+    if not PROFILE_ID_RE.fullmatch(profile_id):
+        return None
+    try:
+        with open(os.path.join(profile_dir(), profile_id + ".json")) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        if not profiling_enabled():
+            raise MiddlewareNotUsed
+        if not getattr(settings, "PROFILE_TOKEN", ""):
+            raise ImproperlyConfigured("PROFILE_TOKEN must be set when PROFILE_REQUESTS is on")
+        self.get_response = get_response
+
+    def trigger(self, request):
+        if has_profile_token(request):
+            return "header"
+        if random.random() < getattr(settings, "PROFILE_SAMPLE_RATE", 0):
+            return "sample"
+        return None
+
+    def __call__(self, request):
+        trigger = self.trigger(request)
+        if trigger is None:
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        queries = []
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(QueryLog(alias, queries)))
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        duration = time.perf_counter() - started
+
+        profile_id = "{}-{}".format(timezone.now().strftime("%Y%m%d%H%M%S"), uuid.uuid4().hex[:8])
+        save_profile(profiler, queries, {
+            "id": profile_id,
+            "created_at": timezone.now().isoformat(),
+            "trigger": trigger,
+            "method": request.method,
+            "path": request.get_full_path(),
+            "status_code": response.status_code,
+            "duration_ms": duration * 1000,
+            "query_count": len(queries),
+            "query_ms": sum(query["duration_ms"] for query in queries),
+        })
+        response["X-Profile-Id"] = profile_id
+        return response
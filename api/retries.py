@@ -0,0 +1,161 @@
+# Background retries of payments which failed with a transient processor error.
+#
+# processPayments gives every payment that failed with one of TRANSIENT_ERRORS a
+# next_retry_at, further away after every attempt (exponential backoff with
+# jitter), until settings.PAYMENT_RETRY_MAX_ATTEMPTS is reached. The scheduler,
+# `python manage.py retry_payments`, finds the payments whose time has come through
+# the (status, next_retry_at) index, resubmits them batch_size at a time with
+# processPayments and marks their orders succeeded once every payment of the order
+# has succeeded.
+#
+# A batch is claimed before it is submitted by pushing its next_retry_at
+# CLAIM_SECONDS ahead, with the rows locked (SKIP LOCKED) where the database
+# supports it, so that several schedulers never submit the same payment together.
+# SQLite has no row locks, run a single scheduler there.
+
+from datetime import timedelta
+from random import uniform
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min, Q
+from django.utils import timezone
+
+from api.events import record_status_events
+from api.models import Order, Payment, PaymentAttempt
+from api.settlements import record_order_transition
+from api.sharding import attach_payment_methods, order_shards
+
+
+TRANSIENT_ERRORS = ("Card network outage",)
+CLAIM_SECONDS = 300
+# Throughput windows of the metrics, in seconds
+METRIC_WINDOWS = (("last_5_minutes", 300), ("last_hour", 3600))
+
+
+def next_retry_at(payment, now):
+    """ When payment should be retried after its last failed attempt, None for never. """
+    if payment.last_processing_error not in TRANSIENT_ERRORS:
+        return None
+    if payment.attempt_count >= settings.PAYMENT_RETRY_MAX_ATTEMPTS:
+        return None
+    delay = min(
+        settings.PAYMENT_RETRY_BASE_DELAY * 2 ** (payment.attempt_count - 1),
+        settings.PAYMENT_RETRY_MAX_DELAY,
+    )
+    # Payments which failed together (e.g. during an outage) are not retried together
+    return now + timedelta(seconds=delay * uniform(0.75, 1.25))
+
+
+def retry_queue(using=None):
+    return Payment.objects.using(using).filter(status=Payment.TYPE_FAILED, next_retry_at__isnull=False)
+
+
+def claim_due_payments(now, limit, using=None):
+    """ Claims up to limit payments of one database that are due for a retry. """
+    with transaction.atomic(using=using):
+        ids = list(
+            retry_queue(using)
+            .filter(next_retry_at__lte=now)
+            .order_by("next_retry_at")
+            .select_for_update(skip_locked=True)
+            .values_list("pk", flat=True)[:limit]
+        )
+        retry_queue(using).filter(pk__in=ids).update(next_retry_at=now + timedelta(seconds=CLAIM_SECONDS))
+    # The content types are those of 'default', attach_payment_methods reads them there
+    return attach_payment_methods(list(Payment.objects.using(using).filter(pk__in=ids)))
+
+
+def complete_orders(order_ids, using=None):
+    """ Marks the failed orders among order_ids whose payments have all succeeded by now
+    as succeeded. Returns the number of orders updated.
+    """
+    orders = list(
+        Order.objects.using(using)
+        .filter(pk__in=order_ids, status=Order.TYPE_FAILED)
+        .exclude(payment__status__in=(Payment.TYPE_REQ_CONF, Payment.TYPE_FAILED))
+    )
+    if not orders:
+        return 0
+
+    now = timezone.now()
+    transitions = []
+    for order in orders:
+        transitions.append((order, order.status, order.processed_date))
+        order.status = Order.TYPE_SUCCEEDED
+        order.processed_date = order.success_date = now
+
+    with transaction.atomic(using=using):
+        Order.objects.using(using).bulk_update(orders, ["status", "success_date", "processed_date"])
+        for order, old_status, old_processed_date in transitions:
+            record_order_transition(order, old_status, old_processed_date, using)
+        record_status_events(orders, using)
+    return len(orders)
+
+
+def retry_due_payments(batch_size=100, now=None):
+    """ Retries one batch of due payments per database.
+
+    Returns a dict with the number of payments retried, of those that succeeded and
+    of orders completed.
+    """
+    # Imported here, like in CaptureOrder, so that importing this module does not
+    # load the processor integration
+    from processor import processPayments
+
+    totals = {"retried": 0, "succeeded": 0, "orders": 0}
+    for using in order_shards():
+        payments = claim_due_payments(now or timezone.now(), batch_size, using)
+        if not payments:
+            continue
+        results = processPayments(payments)
+        succeeded = [payment for payment, error in zip(payments, results) if error is None]
+
+        totals["retried"] += len(payments)
+        totals["succeeded"] += len(succeeded)
+        totals["orders"] += complete_orders({payment.order_id for payment in succeeded}, using)
+    return totals
+
+
+def retry_metrics(now=None):
+    """ Depth of the retry queue and processor throughput over the last minutes. """
+    now = now or timezone.now()
+    queue = {"depth": 0, "due": 0, "oldest_due_at": None, "exhausted": 0}
+    windows = {
+        name: {"attempts": 0, "retries": 0, "succeeded": 0, "failed": 0}
+        for name, _ in METRIC_WINDOWS
+    }
+
+    for using in order_shards():
+        queued = retry_queue(using).aggregate(
+            depth=Count("id"),
+            due=Count("id", filter=Q(next_retry_at__lte=now)),
+            oldest=Min("next_retry_at"),
+        )
+        queue["depth"] += queued["depth"]
+        queue["due"] += queued["due"]
+        # With anything due, the earliest next_retry_at is the longest waiting payment
+        if queued["due"] and (queue["oldest_due_at"] is None or queued["oldest"] < queue["oldest_due_at"]):
+            queue["oldest_due_at"] = queued["oldest"]
+        # Failed with a transient error but out of attempts, left for the merchant
+        queue["exhausted"] += Payment.objects.using(using).filter(
+            status=Payment.TYPE_FAILED,
+            next_retry_at__isnull=True,
+            last_processing_error__in=TRANSIENT_ERRORS,
+        ).count()
+
+        for name, seconds in METRIC_WINDOWS:
+            counts = PaymentAttempt.objects.using(using).filter(
+                created_at__gte=now - timedelta(seconds=seconds)
+            ).aggregate(
+                attempts=Count("id"),
+                retries=Count("id", filter=Q(attempt__gt=1)),
+                succeeded=Count("id", filter=Q(status=Payment.TYPE_SUCCEEDED)),
+                failed=Count("id", filter=Q(status=Payment.TYPE_FAILED)),
+            )
+            for key, value in counts.items():
+                windows[name][key] += value
+
+    for name, seconds in METRIC_WINDOWS:
+        windows[name]["per_minute"] = windows[name]["attempts"] * 60 / seconds
+    return {"queue": queue, "throughput": windows}
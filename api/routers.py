@@ -0,0 +1,135 @@
+# Shard and read replica routing.
+#
+# ShardRouter sends Order and Payment rows, and their archived copies, to the shard
+# of their order id (see api/sharding.py). Every other model, and orders and
+# payments when they are not sharded, fall through to PrimaryReplicaRouter.
+#
+# PrimaryReplicaRouter sends reads to one of settings.DATABASE_REPLICAS and writes
+# to the primary ("default") database. ReplicaPinningMiddleware pins reads to the
+# primary for the rest of a request as soon as the request writes (and for the
+# whole of any POST/DELETE request, e.g. CaptureOrder), and for the following
+# REPLICA_PIN_SECONDS seconds of the client's session through a cookie, so that
+# clients read their own writes despite replication lag.
+
+import contextvars
+import random
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from api.sharding import order_shards, shard_for_id
+
+
+# Reads go to the primary while set, see ReplicaPinningMiddleware
+primary_pinned = contextvars.ContextVar("primary_pinned", default=False)
+# Set as soon as anything is written during the current request
+wrote_to_primary = contextvars.ContextVar("wrote_to_primary", default=False)
+
+PIN_COOKIE = "primary_pin_until"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+# Models stored in the shards, everything else only exists on 'default'
+SHARDED_MODELS = ("order", "payment", "archivedorder", "archivedpayment")
+# Also stored next to their payment, routed by the payment they belong to, and the
+# rollup and feed rows waiting to be merged into 'default' (see api/outbox.py)
+SHARD_TABLES = SHARDED_MODELS + ("paymentattempt", "pendingsettlement", "pendingstatusevent")
+
+
+def replicas():
+    return getattr(settings, "DATABASE_REPLICAS", [])
+
+
+class ShardRouter:
+    def shard_for_hints(self, model, hints):
+        shards = order_shards()
+        instance = hints.get("instance")
+        if len(shards) == 1 or model._meta.app_label != "api" or model._meta.model_name not in SHARD_TABLES:
+            return None
+        # The instance may also be the order a payment is being attached to, or the
+        # payment of an attempt
+        if instance is None:
+            return None
+        if instance._state.db in shards:
+            return instance._state.db
+        if instance._meta.model_name not in SHARDED_MODELS:
+            return None
+        # New payments are placed by their order until they get their own id
+        object_id = instance.pk if instance.pk is not None else getattr(instance, "order_id", None)
+        return shard_for_id(object_id) if object_id is not None else None
+
+    def db_for_read(self, model, **hints):
+        return self.shard_for_hints(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self.shard_for_hints(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Payments refer to content types (and cards) on 'default' across databases
+        databases = {DEFAULT_DB_ALIAS, *order_shards()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db == DEFAULT_DB_ALIAS or db not in order_shards():
+            return None
+        if app_label == "contenttypes":
+            return True
+        return app_label == "api" and model_name in SHARD_TABLES
+
+
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        available = replicas()
+        if not available or primary_pinned.get():
+            return DEFAULT_DB_ALIAS
+        # Reads inside a transaction must see the transaction's own writes
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(available)
+
+    def db_for_write(self, model, **hints):
+        primary_pinned.set(True)
+        wrote_to_primary.set(True)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, *replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema through replication
+        if db in replicas():
+            return False
+        return None
+
+
+class ReplicaPinningMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        pinned_until = request.COOKIES.get(PIN_COOKIE)
+        try:
+            recently_wrote = pinned_until is not None and float(pinned_until) > time.time()
+        except ValueError:
+            recently_wrote = False
+
+        pin_token = primary_pinned.set(request.method not in SAFE_METHODS or recently_wrote)
+        wrote_token = wrote_to_primary.set(False)
+        try:
+            response = self.get_response(request)
+            wrote = wrote_to_primary.get()
+        finally:
+            primary_pinned.reset(pin_token)
+            wrote_to_primary.reset(wrote_token)
+
+        if wrote:
+            window = getattr(settings, "REPLICA_PIN_SECONDS", 5)
+            response.set_cookie(PIN_COOKIE, str(time.time() + window), max_age=window, httponly=True)
+        return response
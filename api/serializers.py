@@ -1,12 +1,29 @@
 from rest_framework import serializers
 from rest_framework import viewsets
-from api.models import CreditCard, Payment, Order, EBTCard
+from api.models import CreditCard, Payment, Order, EBTCard, DailySettlement, ArchivedOrder, ArchivedPayment
 from itertools import chain
+from django.db import transaction
 from django.db.models import QuerySet
 from django.contrib.contenttypes.models import ContentType
+from api.bulk_delete import ON_DELETE_CHOICE, ON_DELETE_RESTRICT
+from api.card_validation import clean_cards
+from api.money import CentsField
+from api.sharding import attach_payment_methods, new_order_id, new_payment_id, shard_for_id
 
 
-class EBTCardSerializer(serializers.ModelSerializer):
+class VaultCardMixin:
+    """ Creating a card that is already vaulted returns the existing row instead.
+
+    After save(), `created` tells whether a new card was actually inserted.
+    """
+    created = False
+
+    def create(self, validated_data):
+        card, self.created = self.Meta.model.objects.vault(**validated_data)
+        return card
+
+
+class EBTCardSerializer(VaultCardMixin, serializers.ModelSerializer):
     class Meta:
         model = EBTCard
         fields = [
@@ -15,19 +32,82 @@ class EBTCardSerializer(serializers.ModelSerializer):
             "brand",
             "number",
         ]
+        # The brand is inferred from the number when it belongs to a known network,
+        # and last_4 is taken from the number
+        extra_kwargs = {"brand": {"required": False}, "last_4": {"required": False}}
+
+    def validate(self, data):
+        # State issued EBT numbers are not in the BIN table, only their checksum is checked
+        errors = clean_cards([data], require_brand=False)[0]
+        if errors:
+            raise serializers.ValidationError(errors)
+        return data
 
-class CreditCardSerializer(serializers.ModelSerializer):
+class CreditCardSerializer(VaultCardMixin, serializers.ModelSerializer):
     class Meta:
         model = CreditCard
         fields = [
             "id",
+            "number",
             "last_4",
             "brand",
             "exp_month",
             "exp_year",
         ]
+        # The number is needed to fingerprint the card but never sent back, the
+        # brand and last_4 are taken from it
+        extra_kwargs = {
+            "number": {"write_only": True},
+            "brand": {"required": False},
+            "last_4": {"required": False},
+        }
+
+    def validate(self, data):
+        errors = clean_cards([data])[0]
+        if errors:
+            raise serializers.ValidationError(errors)
+        return data
+
+class BulkDeleteSerializer(serializers.Serializer):
+    """ Request body of the bulk_delete endpoints, at least one filter is required. """
+    ids = serializers.ListField(child=serializers.IntegerField(min_value=1), required=False)
+
+    filter_fields = ()
+
+    def validate(self, data):
+        if not any(field in data for field in ("ids",) + self.filter_fields):
+            raise serializers.ValidationError(
+                "Provide ids or one of {} to select what to delete".format(", ".join(self.filter_fields))
+            )
+        return data
+
+    def get_queryset(self, queryset):
+        if "ids" in self.validated_data:
+            queryset = queryset.filter(pk__in=self.validated_data["ids"])
+        for field in self.filter_fields:
+            if field in self.validated_data:
+                queryset = queryset.filter(**{field: self.validated_data[field]})
+        return queryset
+
+
+class CardBulkDeleteSerializer(BulkDeleteSerializer):
+    brand = serializers.ChoiceField(choices=CreditCard.CARD_BRAND_CHOICE, required=False)
+    on_delete = serializers.ChoiceField(choices=ON_DELETE_CHOICE, default=ON_DELETE_RESTRICT)
+
+    filter_fields = ("brand",)
+
+
+class OrderBulkDeleteSerializer(BulkDeleteSerializer):
+    status = serializers.ChoiceField(choices=Order.ORDER_STATUS_CHOICE, required=False)
+
+    filter_fields = ("status",)
+
 
 class OrderSerializer(serializers.ModelSerializer):
+    # Integer cents on the model, decimal strings in the API (see api/money.py)
+    order_total = CentsField(min_value=0)
+    ebt_total = CentsField(min_value=0)
+
     class Meta:
         model = Order
         fields = [
@@ -38,12 +118,61 @@ class OrderSerializer(serializers.ModelSerializer):
             "ebt_total",
         ]
 
+    # Same rule as Order.save, checked here so that clients get a 400 and bulk
+    # imports (which bypass save) reject the row
+    def validate(self, data):
+        if data["ebt_total"] > data["order_total"]:
+            raise serializers.ValidationError({"ebt_total": ["ebt total cannot be greater than order total"]})
+        return data
+
+    def create(self, validated_data):
+        # When orders are sharded the id is picked first, it decides the database
+        order = Order(id=new_order_id(), **validated_data)
+        order.save(force_insert=True)
+        return order
+
+
+
+
+class ArchivedOrderSerializer(OrderSerializer):
+    class Meta(OrderSerializer.Meta):
+        model = ArchivedOrder
+
+
+class DailySettlementSerializer(serializers.ModelSerializer):
+    amount = CentsField(max_digits=14)
+
+    class Meta:
+        model = DailySettlement
+        fields = [
+            "date",
+            "source",
+            "status",
+            "brand",
+            "tender",
+            "count",
+            "amount",
+        ]
+
 
+class ShardedOrderField(serializers.PrimaryKeyRelatedField):
+    """ Looks the order up in the shard its id belongs to. """
+
+    def to_internal_value(self, data):
+        try:
+            return self.get_queryset().using(shard_for_id(int(data))).get(pk=data)
+        except Order.DoesNotExist:
+            self.fail("does_not_exist", pk_value=data)
+        except (TypeError, ValueError):
+            self.fail("incorrect_type", data_type=type(data).__name__)
 
 
 class PaymentSerializer(serializers.ModelSerializer):
+    order = ShardedOrderField(queryset=Order.objects.all())
+    amount = CentsField(min_value=0)
     payment_method = serializers.SerializerMethodField()
     def get_payment_method(self, obj):
+        attach_payment_methods([obj]) # no query when the view attached the cards already
         if isinstance(obj.payment_method, CreditCard):
             return CreditCardSerializer(obj.payment_method).data
         elif isinstance(obj.payment_method, EBTCard):
@@ -65,7 +194,10 @@ class PaymentSerializer(serializers.ModelSerializer):
             "status",
             "success_date",
             "last_processing_error",
+            "attempt_count",
+            "next_retry_at",
         ]
+        read_only_fields = ["attempt_count", "next_retry_at"]
     
     def create(self, validated_data):
 
@@ -80,15 +212,62 @@ class PaymentSerializer(serializers.ModelSerializer):
 
         
         if  payment_card == "creditcard":
-            content_type = ContentType.objects.get_for_model(CreditCard)
-            payment_method = CreditCard.objects.get(pk=payment_method)
+            card_model = CreditCard
         elif payment_card == "ebtcard": 
-            content_type = ContentType.objects.get_for_model(EBTCard)
-            payment_method = EBTCard.objects.get(pk=payment_method)
-        
+            card_model = EBTCard
+        else:
+            choices = ", ".join('"{}"'.format(choice) for choice, _ in Payment.PAYMENT_METHOD_CHOICE)
+            raise serializers.ValidationError({"payment_card": ["Must be one of {}.".format(choices)]})
+        content_type = ContentType.objects.get_for_model(card_model)
 
-        payment = Payment.objects.create(order=order, amount=amount, description=description, status=status, payment_method=payment_method, content_type=content_type, **validated_data)
+        # Stored in the order's shard, see api/sharding.py. The id is reserved first,
+        # that can not happen inside the transaction below.
+        payment_id = new_payment_id(order.pk)
+
+        # The card stays locked until the payment is written, so that delete_cards
+        # (see api/bulk_delete.py) never deletes it from under a new payment
+        with transaction.atomic():
+            try:
+                payment_method = card_model.objects.select_for_update().get(pk=payment_method)
+            except card_model.DoesNotExist:
+                raise serializers.ValidationError({"payment_method": ["{} {} does not exist.".format(card_model.__name__, payment_method)]})
+            payment = Payment(id=payment_id, order=order, amount=amount, description=description, status=status, payment_method=payment_method, content_type=content_type, **validated_data)
+            payment.save(force_insert=True)
         return payment
 
 
-    
+class ArchivedPaymentSerializer(PaymentSerializer):
+    # Archived payments are read only, they are never created through the API
+    class Meta(PaymentSerializer.Meta):
+        model = ArchivedPayment
+
+
+# Serializers used by `python manage.py import_data` (see api/importer.py). They
+# apply the same field rules as the API serializers above, but leave the checks
+# which need the database or work better on whole batches to the importer.
+
+class CreditCardImportSerializer(CreditCardSerializer):
+    def validate(self, data):
+        return data # clean_cards runs once per chunk
+
+
+class EBTCardImportSerializer(EBTCardSerializer):
+    def validate(self, data):
+        return data # clean_cards runs once per chunk
+
+
+class PaymentImportSerializer(PaymentSerializer):
+    # Plain ids, existence is checked once per chunk instead of one query per row
+    order = serializers.IntegerField(min_value=1)
+    payment_method = serializers.IntegerField(min_value=1)
+    payment_card = serializers.ChoiceField(choices=Payment.PAYMENT_METHOD_CHOICE)
+
+    class Meta(PaymentSerializer.Meta):
+        fields = [
+            "order",
+            "amount",
+            "description",
+            "payment_method",
+            "payment_card",
+            "status",
+        ]
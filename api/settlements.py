@@ -0,0 +1,184 @@
+# Incremental maintenance of the DailySettlement rollup table.
+#
+# Every time processPayment or CaptureOrder moves a Payment/Order into a final
+# status, the matching bucket is bumped with a single UPDATE ... SET count = count + 1.
+# If the object was already counted under an earlier status (e.g. a failed payment
+# that is retried and succeeds), that bucket is decremented first so that every
+# object is only ever counted once, under its latest status. Rows removed with
+# api/bulk_delete.py are taken out of their bucket the same way.
+#
+# Changes made on an order shard other than 'default' are appended there as
+# PendingSettlement rows, in the shard's transaction, and merged into the buckets
+# asynchronously (see api/outbox.py), so that captures never write to 'default'.
+#
+# Amounts are integer cents (see api/money.py), so the buckets add up exactly.
+
+from collections import defaultdict
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS, IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import Coalesce, TruncDate
+from django.utils import timezone
+
+from api.models import ArchivedOrder, DailySettlement, Order, Payment, PendingSettlement
+from api.sharding import attach_payment_methods
+
+
+# Only final statuses are rolled up, drafts and unconfirmed payments are not settled
+SETTLED_PAYMENT_STATUSES = (Payment.TYPE_SUCCEEDED, Payment.TYPE_FAILED)
+SETTLED_ORDER_STATUSES = (Order.TYPE_SUCCEEDED, Order.TYPE_FAILED)
+
+
+def settlement_day(value):
+    return timezone.localdate(value) if timezone.is_aware(value) else value.date()
+
+
+def bump_bucket(day, source, status, brand="", tender="", count=1, amount=0):
+    bucket = DailySettlement.objects.filter(
+        date=day, source=source, status=status, brand=brand, tender=tender
+    )
+    if bucket.update(count=F("count") + count, amount=F("amount") + amount):
+        return
+
+    try:
+        with transaction.atomic():
+            DailySettlement.objects.create(
+                date=day,
+                source=source,
+                status=status,
+                brand=brand,
+                tender=tender,
+                count=count,
+                amount=amount,
+            )
+    except IntegrityError:
+        # Somebody else created the bucket between our UPDATE and INSERT
+        bucket.update(count=F("count") + count, amount=F("amount") + amount)
+
+
+def payment_tender(payment):
+    # get_for_id is served from the ContentType cache, no query after the first call
+    return ContentType.objects.get_for_id(payment.content_type_id).model
+
+
+def payment_brand(payment):
+    attach_payment_methods([payment])
+    payment_method = payment.payment_method
+    return payment_method.brand if payment_method is not None else ""
+
+
+def record_payment_transition(payment, old_status, old_processed_date, using=None):
+    """ Move a payment from its old settlement bucket to the one for its current status.
+
+    using is the database of the payment, see apply_deltas.
+    """
+    record_payment_transitions([(payment, old_status, old_processed_date)], using)
+
+
+def record_payment_transitions(transitions, using=None):
+    """ Batch version of record_payment_transition, takes (payment, old status, old
+    processed date) tuples. Every bucket touched by the batch is bumped once.
+    """
+    attach_payment_methods([payment for payment, _, _ in transitions])
+    deltas = defaultdict(lambda: [0, 0])
+
+    for payment, old_status, old_processed_date in transitions:
+        tender = payment_tender(payment)
+        brand = payment_brand(payment)
+
+        if old_status in SETTLED_PAYMENT_STATUSES and old_processed_date is not None:
+            delta = deltas[(settlement_day(old_processed_date), DailySettlement.TYPE_PAYMENT, old_status, brand, tender)]
+            delta[0] -= 1
+            delta[1] -= payment.amount
+
+        if payment.status in SETTLED_PAYMENT_STATUSES and payment.processed_date is not None:
+            delta = deltas[(settlement_day(payment.processed_date), DailySettlement.TYPE_PAYMENT, payment.status, brand, tender)]
+            delta[0] += 1
+            delta[1] += payment.amount
+
+    apply_deltas(deltas, using)
+
+
+def record_order_transition(order, old_status, old_processed_date, using=None):
+    """ Move an order from its old settlement bucket to the one for its current status. """
+    deltas = defaultdict(lambda: [0, 0])
+
+    if old_status in SETTLED_ORDER_STATUSES and old_processed_date is not None:
+        delta = deltas[(settlement_day(old_processed_date), DailySettlement.TYPE_ORDER, old_status, "", "")]
+        delta[0] -= 1
+        delta[1] -= order.order_total
+
+    if order.status in SETTLED_ORDER_STATUSES and order.processed_date is not None:
+        delta = deltas[(settlement_day(order.processed_date), DailySettlement.TYPE_ORDER, order.status, "", "")]
+        delta[0] += 1
+        delta[1] += order.order_total
+
+    apply_deltas(deltas, using)
+
+
+def record_deletions(queryset):
+    """ Takes the settled rows of queryset out of their buckets, before they are deleted.
+
+    queryset holds orders or payments, live or archived. The rows are grouped in SQL
+    under the same day as rebuild_settlements uses, so only one row per bucket and
+    card is loaded whatever the number of rows deleted. The changes are recorded on
+    the database of queryset, see apply_deltas.
+    """
+    rows = queryset.annotate(day=TruncDate(Coalesce("processed_date", "success_date"))).filter(day__isnull=False)
+    deltas = defaultdict(lambda: [0, 0])
+
+    if issubclass(queryset.model, (Order, ArchivedOrder)):
+        totals = (
+            rows.filter(status__in=SETTLED_ORDER_STATUSES)
+            .values("day", "status")
+            .annotate(count=Count("id"), amount=Sum("order_total"))
+            .order_by()
+        )
+        for row in totals:
+            delta = deltas[(row["day"], DailySettlement.TYPE_ORDER, row["status"], "", "")]
+            delta[0] -= row["count"]
+            delta[1] -= row["amount"]
+    else:
+        totals = list(
+            rows.filter(status__in=SETTLED_PAYMENT_STATUSES)
+            .values("day", "status", "content_type_id", "payment_method_id")
+            .annotate(count=Count("id"), amount=Sum("amount"))
+            .order_by()
+        )
+        # The cards are on 'default', not next to the payments
+        brands = {}
+        for content_type_id in {row["content_type_id"] for row in totals}:
+            card_model = ContentType.objects.get_for_id(content_type_id).model_class()
+            brands[content_type_id] = dict(card_model.objects.filter(
+                pk__in={row["payment_method_id"] for row in totals if row["content_type_id"] == content_type_id}
+            ).values_list("pk", "brand"))
+        for row in totals:
+            tender = ContentType.objects.get_for_id(row["content_type_id"]).model
+            brand = brands[row["content_type_id"]].get(row["payment_method_id"], "")
+            delta = deltas[(row["day"], DailySettlement.TYPE_PAYMENT, row["status"], brand, tender)]
+            delta[0] -= row["count"]
+            delta[1] -= row["amount"]
+
+    apply_deltas(deltas, queryset.db)
+
+
+def apply_deltas(deltas, using=None):
+    """ Bumps the buckets of deltas, {(day, source, status, brand, tender): [count, amount]}.
+
+    using is the database whose transaction made the changes: on a shard other than
+    'default' they are appended there as PendingSettlement rows instead.
+    """
+    deltas = sorted((key, delta) for key, delta in deltas.items() if delta[0] or delta[1])
+    if using is not None and using != DEFAULT_DB_ALIAS:
+        PendingSettlement.objects.using(using).bulk_create([
+            PendingSettlement(
+                date=day, source=source, status=status, brand=brand, tender=tender, count=count, amount=amount,
+            )
+            for (day, source, status, brand, tender), (count, amount) in deltas
+        ])
+        return
+
+    # Always in the same order, so that concurrent batches lock the rows in the same order
+    for (day, source, status, brand, tender), (count, amount) in deltas:
+        bump_bucket(day, source, status, brand, tender, count=count, amount=amount)
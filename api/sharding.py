@@ -0,0 +1,164 @@
+# Horizontal sharding of orders and payments.
+#
+# settings.ORDER_SHARDS lists the databases holding Order and Payment rows and
+# their archived copies. An order lives in shard `order id % len(ORDER_SHARDS)` and
+# its payments are stored next to it: payment ids are allocated as
+# `n * len(ORDER_SHARDS) + shard index of the order`, so that a payment id alone
+# also tells which shard to read. Ids come from ShardSequence rows on 'default',
+# reserved a block at a time by every process.
+#
+# Everything else (cards, settlement rollups, status events, id sequences) stays on
+# 'default'. Payments reference their card and its content type across databases
+# (there is no foreign key constraint on the content type), attach_payment_methods()
+# fetches the cards of a list of payments with one query per card type instead of
+# going through the generic foreign key, which would look in the payment's shard.
+#
+# With a single shard (the default) nothing changes: the database picks the ids and
+# shard_for_id() returns None, so that reads keep going through PrimaryReplicaRouter.
+# Changing the number of shards means moving rows, sharding must be enabled on an
+# empty database.
+
+import heapq
+import threading
+from collections import defaultdict
+from itertools import islice
+from operator import attrgetter
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import F
+
+from api.models import ShardSequence
+
+
+def order_shards():
+    return getattr(settings, "ORDER_SHARDS", None) or [DEFAULT_DB_ALIAS]
+
+
+def sharding_enabled():
+    return len(order_shards()) > 1
+
+
+def shard_for_id(object_id):
+    """ Database of an order or payment id, None when orders are not sharded. """
+    shards = order_shards()
+    if len(shards) == 1:
+        return None
+    return shards[int(object_id) % len(shards)]
+
+
+def reserve_ids(name, count):
+    """ Reserves count ids of the ShardSequence name, returns them as a range. """
+    # A rolled back reservation would hand the same ids out twice
+    if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+        raise RuntimeError("Shard ids must be reserved outside of a transaction on 'default'")
+
+    with transaction.atomic(using=DEFAULT_DB_ALIAS):
+        sequences = ShardSequence.objects.using(DEFAULT_DB_ALIAS)
+        sequences.get_or_create(name=name)
+        sequences.filter(name=name).update(next_value=F("next_value") + count)
+        end = sequences.filter(name=name).values_list("next_value", flat=True).get()
+    return range(end - count, end)
+
+
+class IdAllocator:
+    """ Hands out the ids of one ShardSequence, one query per block_size ids. """
+
+    def __init__(self, name, block_size=100):
+        self.name = name
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.block = iter(())
+
+    def allocate(self):
+        with self.lock:
+            value = next(self.block, None)
+            if value is None:
+                self.block = iter(reserve_ids(self.name, self.block_size))
+                value = next(self.block)
+            return value
+
+
+order_ids = IdAllocator("order")
+payment_ids = IdAllocator("payment")
+
+
+def new_order_id():
+    """ Id for a new Order, None (the database picks it) when orders are not sharded. """
+    if not sharding_enabled():
+        return None
+    return order_ids.allocate()
+
+
+def new_payment_id(order_id):
+    """ Id for a new Payment of order_id, in the same shard as the order. """
+    shards = order_shards()
+    if len(shards) == 1:
+        return None
+    return payment_ids.allocate() * len(shards) + int(order_id) % len(shards)
+
+
+def assign_ids(instances):
+    """ Gives unsaved Order or Payment instances their ids, with one query for all of them.
+
+    Payments must have their order_id set. Does nothing when orders are not sharded.
+    """
+    shards = order_shards()
+    if len(shards) == 1 or not instances:
+        return
+    if instances[0]._meta.model_name == "order":
+        for instance, value in zip(instances, reserve_ids("order", len(instances))):
+            instance.pk = value
+    else:
+        for instance, value in zip(instances, reserve_ids("payment", len(instances))):
+            instance.pk = value * len(shards) + instance.order_id % len(shards)
+
+
+def group_by_shard(instances):
+    """ Splits Order or Payment instances by database, {None: instances} when not sharded. """
+    groups = defaultdict(list)
+    for instance in instances:
+        groups[shard_for_id(instance.pk)].append(instance)
+    return groups
+
+
+def merge_shards(queryset, after=None, limit=None):
+    """ Rows of queryset from every shard, merged in primary key order.
+
+    after is the last primary key of the previous page and limit the page size,
+    every shard is asked for at most limit rows.
+    """
+    queryset = queryset.order_by("pk")
+    if after is not None:
+        queryset = queryset.filter(pk__gt=after)
+    if limit is not None:
+        queryset = queryset[:limit]
+    if not sharding_enabled():
+        return list(queryset)
+    merged = heapq.merge(*(queryset.using(alias) for alias in order_shards()), key=attrgetter("pk"))
+    return list(islice(merged, limit))
+
+
+def attach_payment_methods(payments):
+    """ Fetches the cards of payments (live or archived) with one query per card type.
+
+    The cards are cached on payment.payment_method, payments whose card is already
+    cached are left alone. Returns payments.
+    """
+    missing = defaultdict(set)
+    pending = []
+    for payment in payments:
+        field = payment._meta.get_field("payment_method")
+        if not field.is_cached(payment):
+            missing[payment.content_type_id].add(payment.payment_method_id)
+            pending.append((field, payment))
+
+    # Cards are read through the routers, i.e. from 'default' or one of its replicas
+    cards = {
+        content_type_id: ContentType.objects.get_for_id(content_type_id).model_class().objects.in_bulk(ids)
+        for content_type_id, ids in missing.items()
+    }
+    for field, payment in pending:
+        field.set_cached_value(payment, cards[payment.content_type_id].get(payment.payment_method_id))
+    return payments
@@ -1,3 +1,927 @@
-from django.test import TestCase
+import contextvars
+import gzip
+import io
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.http import HttpResponse
+from django.test import RequestFactory, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from processor import processPayments
+
+from api import bulk_delete, export, outbox, sharding
+from api.events import ChangeFeed
+from api.models import (
+    DEFAULT_CARD_NUMBER, ArchivedOrder, ArchivedPayment, CreditCard, DailySettlement, EBTCard, MergedBatch,
+    Order, Payment, PaymentAttempt, PendingSettlement, PendingStatusEvent, StatusEvent, card_fingerprint,
+)
+from api.money import format_cents, to_cents, to_decimal
+from api.outbox import merge_outbox
+from api.profiling import ProfilingMiddleware
+from api.retries import retry_due_payments, retry_metrics
+from api.routers import PIN_COOKIE, PrimaryReplicaRouter, ReplicaPinningMiddleware
+from api.serializers import OrderSerializer
+from api.sharding import new_order_id, new_payment_id, order_shards, shard_for_id, sharding_enabled
+
+
+CREDIT_CARD_NUMBER = "5555555555554444"
+EBT_CARD_NUMBER = "6007600000000007"
+
+
+def quiet():
+    """ The views still print a few debugging lines per request. """
+    return mock.patch("sys.stdout", new_callable=io.StringIO)
+
+
+def in_shards(queryset):
+    """ The rows of queryset in every order shard, see api/sharding.py. """
+    return [row for using in order_shards() for row in queryset.using(using)]
+
+
+def create_order_row(**fields):
+    """ An Order saved in its shard, like OrderSerializer.create does. """
+    order = Order(id=new_order_id(), **fields)
+    order.save(force_insert=True)
+    return order
+
+
+def create_payment_row(order, **fields):
+    payment = Payment(id=new_payment_id(order.pk), order=order, **fields)
+    payment.save(force_insert=True)
+    return payment
+
+
+class DatabaseTestCase(TransactionTestCase):
+    """ Runs on every configured database, shards included (API_TAKE_HOME_ORDER_SHARDS).
+
+    Shard ids are reserved outside of any transaction on 'default' (see
+    api/sharding.py), which TestCase would wrap every test in.
+    """
+    databases = "__all__"
+
+    def setUp(self):
+        # ShardSequence is flushed after every test, ids reserved before must not be handed out again
+        for allocator in (sharding.order_ids, sharding.payment_ids):
+            allocator.block = iter(())
+
+
+class ApiTestCase(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.credit_card, _ = CreditCard.objects.vault(
+            number=CREDIT_CARD_NUMBER, last_4="4444", brand="mastercard", exp_month=2, exp_year=30,
+        )
+        self.ebt_card, _ = EBTCard.objects.vault(number=EBT_CARD_NUMBER, last_4="0007", brand="visa")
+
+    def create_order(self, order_total="20.45", ebt_total="10.00", credit="12.45", ebt="8.00"):
+        with quiet():
+            response = self.client.post("/api/orders/", {"order_total": order_total, "ebt_total": ebt_total}, format="json")
+            self.assertEqual(response.status_code, 201, response.data)
+            order_id = response.data["id"]
+            for card, payment_card, amount in ((self.credit_card, "creditcard", credit), (self.ebt_card, "ebtcard", ebt)):
+                response = self.client.post("/api/payments/", {
+                    "order": order_id,
+                    "payment_method": card.pk,
+                    "payment_card": payment_card,
+                    "amount": amount,
+                    "description": "test",
+                    "status": Payment.TYPE_REQ_CONF,
+                }, format="json")
+                self.assertEqual(response.status_code, 201, response.data)
+        return order_id
+
+    def capture(self, order_id):
+        # The processor always approves
+        with quiet(), mock.patch("processor.false_5_percent", return_value=True):
+            return self.client.post("/api/orders/{}/capture/".format(order_id))
+
+    def rollups(self):
+        # What the report shows once the shards' changes are merged
+        merge_outbox()
+        return sorted(
+            DailySettlement.objects.exclude(count=0).values_list("source", "status", "tender", "count", "amount")
+        )
+
+
+class MoneyTests(ApiTestCase):
+    def test_cents_helpers(self):
+        self.assertEqual(to_cents("20.45"), 2045)
+        self.assertEqual(to_cents(Decimal("0.29")), 29)
+        self.assertEqual(to_cents("0.005"), 1)
+        self.assertEqual(to_decimal(2045), Decimal("20.45"))
+        self.assertEqual(format_cents(5), "0.05")
+        self.assertEqual(format_cents(-1250), "-12.50")
+
+    def test_api_keeps_decimal_strings(self):
+        order_id = self.create_order()
+        order = Order.objects.using(shard_for_id(order_id)).get(pk=order_id)
+        self.assertEqual((order.order_total, order.ebt_total), (2045, 1000))
+        self.assertEqual(sorted(in_shards(Payment.objects.values_list("amount", flat=True))), [800, 1245])
+
+        with quiet():
+            response = self.client.get("/api/orders/{}/".format(order_id))
+        self.assertEqual((response.data["order_total"], response.data["ebt_total"]), ("20.45", "10.00"))
+
+    def test_serializer_rejects_invalid_amounts(self):
+        for order_total in ("-1.00", "1.005", "abc"):
+            serializer = OrderSerializer(data={"order_total": order_total, "ebt_total": "0"})
+            self.assertFalse(serializer.is_valid(), order_total)
+            self.assertIn("order_total", serializer.errors)
+
+
+class AmountsInCentsMigrationTests(TransactionTestCase):
+    before = [("api", "0007_payment_retries")]
+    after = [("api", "0008_amounts_in_cents")]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+
+    def test_forwards_and_backwards(self):
+        apps = self.migrate(self.before)
+        content_type = ContentType.objects.get_for_model(CreditCard)
+        order = apps.get_model("api", "Order").objects.create(order_total=Decimal("20.45"), ebt_total=Decimal("10.01"))
+        apps.get_model("api", "Payment").objects.create(
+            order_id=order.pk, amount=Decimal("0.29"), description="test", content_type_id=content_type.pk,
+        )
+        apps.get_model("api", "DailySettlement").objects.create(
+            date="2026-01-01", source="payment", status="failed", amount=Decimal("123456789012.57"),
+        )
+
+        apps = self.migrate(self.after)
+        self.assertEqual(
+            list(apps.get_model("api", "Order").objects.values_list("order_total", "ebt_total")), [(2045, 1001)]
+        )
+        self.assertEqual(list(apps.get_model("api", "Payment").objects.values_list("amount", flat=True)), [29])
+        self.assertEqual(
+            list(apps.get_model("api", "DailySettlement").objects.values_list("amount", flat=True)), [12345678901257]
+        )
+
+        apps = self.migrate(self.before)
+        self.assertEqual(
+            list(apps.get_model("api", "Order").objects.values_list("order_total", "ebt_total")),
+            [(Decimal("20.45"), Decimal("10.01"))],
+        )
+        self.assertEqual(
+            list(apps.get_model("api", "Payment").objects.values_list("amount", flat=True)), [Decimal("0.29")]
+        )
+
+
+class CaptureOrderTests(ApiTestCase):
+    def test_capture_settles_order_and_rollups(self):
+        order_id = self.create_order()
+        response = self.capture(order_id)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data["status"], Order.TYPE_SUCCEEDED)
+        self.assertEqual(self.rollups(), [
+            ("order", "succeeded", "", 1, 2045),
+            ("payment", "succeeded", "creditcard", 1, 1245),
+            ("payment", "succeeded", "ebtcard", 1, 800),
+        ])
+
+    def test_payment_total_must_match_order_total(self):
+        order_id = self.create_order(credit="12.44")
+        response = self.capture(order_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Payment total does not match", response.data["error_message"])
+        self.assertEqual(Order.objects.using(shard_for_id(order_id)).get(pk=order_id).status, Order.TYPE_DRAFT)
+
+    def test_ebt_payments_must_not_exceed_ebt_total(self):
+        order_id = self.create_order(ebt_total="7.99")
+        response = self.capture(order_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("exceeds EBT eligibility", response.data["error_message"])
+
+    def test_ebt_payments_are_matched_by_content_type_id(self):
+        order_id = self.create_order(ebt_total="7.99")
+        # A shard's own django_content_type rows may not match the ids used on 'default'
+        ContentType.objects.filter(pk=ContentType.objects.get_for_model(EBTCard).pk).update(model="stale")
+        self.assertEqual(self.capture(order_id).status_code, 400)
+
+    def test_order_without_payments(self):
+        with quiet():
+            order_id = self.client.post("/api/orders/", {"order_total": "0.00", "ebt_total": "0.00"}, format="json").data["id"]
+        self.assertEqual(self.capture(order_id).status_code, 200)
+
+
+class RebuildSettlementsTests(ApiTestCase):
+    def test_rebuild_keeps_archived_history(self):
+        for _ in range(2):
+            self.capture(self.create_order())
+        rollups = self.rollups()
+
+        call_command("archive_orders", "--days", "0", stdout=io.StringIO())
+        self.assertEqual((len(in_shards(Order.objects.all())), len(in_shards(ArchivedOrder.objects.all()))), (0, 2))
+        self.assertEqual(len(in_shards(ArchivedPayment.objects.all())), 4)
+
+        call_command("rebuild_settlements", "--include-today", stdout=io.StringIO())
+        self.assertEqual(self.rollups(), rollups)
+        self.assertEqual(rollups[0], ("order", "succeeded", "", 2, 4090))
+
+    def test_today_is_left_to_the_live_updates(self):
+        self.capture(self.create_order())
+        merge_outbox()
+        today = timezone.localdate()
+        # Pretend that a capture bumps today's bucket while the rebuild runs
+        DailySettlement.objects.filter(date=today, source="order").update(count=5)
+        stale = DailySettlement.objects.create(
+            date=today - timedelta(days=1), source="order", status=Order.TYPE_SUCCEEDED, count=3, amount=300,
+        )
+
+        call_command("rebuild_settlements", stdout=io.StringIO())
+        self.assertFalse(DailySettlement.objects.filter(pk=stale.pk).exists())
+        self.assertEqual(DailySettlement.objects.get(date=today, source="order").count, 5)
+
+        with self.assertRaisesMessage(CommandError, "--include-today"):
+            call_command("rebuild_settlements", "--end", today.isoformat(), stdout=io.StringIO())
+
+
+class FingerprintCardsTests(DatabaseTestCase):
+    def legacy_cards(self, *cards):
+        # bulk_create skips save(), like rows created before fingerprints existed
+        CreditCard.objects.bulk_create([
+            CreditCard(**dict({"brand": "visa", "exp_month": 2, "exp_year": 30}, **card)) for card in cards
+        ])
+        return list(CreditCard.objects.filter(fingerprint__isnull=True).order_by("pk"))
+
+    def backfill(self):
+        out = io.StringIO()
+        call_command("fingerprint_cards", stdout=out)
+        return out.getvalue()
+
+    def pay_with(self, card):
+        order = create_order_row(order_total=100, ebt_total=0)
+        return create_payment_row(order, amount=100, description="test", payment_method=card)
+
+    def test_default_number_cards_with_different_details_are_kept(self):
+        amex, visa = self.legacy_cards({"last_4": "1234", "brand": "amex"}, {"last_4": "9999"})
+        payment = self.pay_with(visa)
+
+        output = self.backfill()
+        self.assertIn("merged 0 duplicates", output)
+        self.assertIn("2 distinct cards share the default number", output)
+        self.assertEqual(set(CreditCard.objects.values_list("pk", flat=True)), {amex.pk, visa.pk})
+        self.assertFalse(CreditCard.objects.filter(fingerprint__isnull=True).exists())
+        payment.refresh_from_db()
+        self.assertEqual(payment.payment_method_id, visa.pk)
+
+    def test_default_number_cards_with_same_details_are_merged(self):
+        first, second = self.legacy_cards({"last_4": "9999"}, {"last_4": "9999"})
+        payment = self.pay_with(second)
+
+        self.assertIn("merged 1 duplicates", self.backfill())
+        self.assertEqual(list(CreditCard.objects.values_list("pk", flat=True)), [first.pk])
+        payment.refresh_from_db()
+        self.assertEqual(payment.payment_method_id, first.pk)
+
+    def test_supplied_numbers_are_merged_into_the_vaulted_card(self):
+        vaulted, _ = CreditCard.objects.vault(
+            number=CREDIT_CARD_NUMBER, last_4="4444", brand="mastercard", exp_month=2, exp_year=30,
+        )
+        first, second = self.legacy_cards(
+            {"number": CREDIT_CARD_NUMBER, "last_4": "4444"},
+            {"number": CREDIT_CARD_NUMBER, "last_4": "4444", "exp_month": 3},
+        )
+        payment = self.pay_with(second)
+
+        self.assertIn("merged 2 duplicates", self.backfill())
+        self.assertEqual(list(CreditCard.objects.values_list("pk", flat=True)), [vaulted.pk])
+        payment.refresh_from_db()
+        self.assertEqual(payment.payment_method_id, vaulted.pk)
+
+    def test_vault_matches_default_number_on_details(self):
+        self.legacy_cards({"last_4": "1234", "brand": "amex"}, {"last_4": "9999"})
+        self.backfill()
+
+        card, created = CreditCard.objects.vault(
+            number=DEFAULT_CARD_NUMBER, last_4="9999", brand="visa", exp_month=2, exp_year=30,
+        )
+        self.assertFalse(created)
+        self.assertEqual(card.last_4, "9999")
+        _, created = CreditCard.objects.vault(
+            number=DEFAULT_CARD_NUMBER, last_4="1111", brand="visa", exp_month=2, exp_year=30,
+        )
+        self.assertTrue(created)
+        self.assertEqual(CreditCard.objects.filter(fingerprint=card_fingerprint(DEFAULT_CARD_NUMBER)).count(), 3)
+
+
+class VaultCardTests(ApiTestCase):
+    def post_card(self, **fields):
+        data = {"number": CREDIT_CARD_NUMBER, "exp_month": 2, "exp_year": 30}
+        data.update(fields)
+        with quiet():
+            return self.client.post("/api/credit_cards/", data, format="json")
+
+    def test_reissued_card_gets_the_later_expiry(self):
+        response = self.post_card(exp_month=5, exp_year=33)
+        self.assertEqual(response.data["id"], self.credit_card.pk)
+        self.assertEqual((response.data["exp_month"], response.data["exp_year"]), (5, 33))
+        self.credit_card.refresh_from_db()
+        self.assertEqual((self.credit_card.exp_month, self.credit_card.exp_year), (5, 33))
+
+        # An older expiry sent afterwards does not undo it
+        self.post_card(exp_month=2, exp_year=31)
+        self.credit_card.refresh_from_db()
+        self.assertEqual((self.credit_card.exp_month, self.credit_card.exp_year), (5, 33))
+
+    def test_last_4_is_taken_from_the_number(self):
+        response = self.post_card(number="4111111111111111110")
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data["last_4"], "1110")
+
+    def test_last_4_must_match_the_number(self):
+        response = self.post_card(number="4111111111111111110", last_4="4242")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("last_4", response.data)
+        self.assertFalse(CreditCard.objects.filter(number="4111111111111111110").exists())
+
+
+class CardValidationTests(ApiTestCase):
+    def post_card(self, number):
+        with quiet():
+            return self.client.post("/api/credit_cards/", {
+                "number": number, "last_4": number[-4:], "exp_month": 2, "exp_year": 30,
+            }, format="json")
+
+    def test_rejects_non_ascii_digits(self):
+        response = self.post_card("²111111111111111")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("number", response.data)
+
+    def test_accepts_19_digit_numbers(self):
+        response = self.post_card("4111111111111111110")
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data["brand"], "visa")
+
+
+class DeleteCardsTests(ApiTestCase):
+    def test_restrict_refuses_cards_in_use(self):
+        self.create_order()
+        with self.assertRaises(bulk_delete.DeleteRestricted) as raised:
+            bulk_delete.delete_cards(CreditCard)
+        self.assertEqual(raised.exception.payment_count, 1)
+        self.assertTrue(CreditCard.objects.filter(pk=self.credit_card.pk).exists())
+
+    def test_restrict_deletes_unused_cards(self):
+        self.create_order()
+        unused, _ = CreditCard.objects.vault(
+            number="4111111111111111110", last_4="1110", brand="visa", exp_month=2, exp_year=30,
+        )
+        deleted = bulk_delete.delete_cards(CreditCard, CreditCard.objects.filter(pk=unused.pk))
+        self.assertEqual(deleted, {"cards": 1, "payments": 0})
+        self.assertTrue(CreditCard.objects.filter(pk=self.credit_card.pk).exists())
+
+    def test_restrict_rechecks_before_deleting(self):
+        order = create_order_row(order_total=100, ebt_total=0)
+        count = bulk_delete.restricted_payment_count
+        checks = []
+
+        def count_then_add_payment(card_model, ids):
+            payment_count = count(card_model, ids)
+            if not checks:
+                # A payment is created between the up-front check and the delete
+                create_payment_row(order, amount=100, description="late", payment_method=self.credit_card)
+            checks.append(payment_count)
+            return payment_count
+
+        with mock.patch.object(bulk_delete, "restricted_payment_count", count_then_add_payment):
+            with self.assertRaises(bulk_delete.DeleteRestricted):
+                bulk_delete.delete_cards(CreditCard, CreditCard.objects.filter(pk=self.credit_card.pk))
+        self.assertEqual(checks, [0, 1])
+        self.assertTrue(CreditCard.objects.filter(pk=self.credit_card.pk).exists())
+
+    def test_model_delete_is_restricted(self):
+        self.create_order()
+        with self.assertRaises(bulk_delete.DeleteRestricted):
+            self.credit_card.delete()
+        with self.assertRaises(bulk_delete.DeleteRestricted):
+            CreditCard.objects.all().delete()
+        self.assertEqual(len(in_shards(Payment.objects.all())), 2)
+        self.assertTrue(CreditCard.objects.filter(pk=self.credit_card.pk).exists())
+
+        unused, _ = EBTCard.objects.vault(number="6007600000000015", last_4="0015", brand="visa")
+        self.assertEqual(unused.delete(), (1, {"api.EBTCard": 1}))
+        self.assertFalse(EBTCard.objects.filter(pk=unused.pk).exists())
+
+    def test_cascade_deletes_payments(self):
+        order_id = self.create_order()
+        self.capture(order_id)
+        call_command("archive_orders", "--days", "0", stdout=io.StringIO())
+        self.create_order()
+
+        deleted = bulk_delete.delete_cards(CreditCard, on_delete=bulk_delete.ON_DELETE_CASCADE, batch_size=1)
+        self.assertEqual(deleted, {"cards": 1, "payments": 2})
+        self.assertFalse(CreditCard.objects.exists())
+        content_type = ContentType.objects.get_for_model(CreditCard)
+        self.assertFalse(in_shards(Payment.objects.filter(content_type=content_type)))
+        self.assertFalse(in_shards(ArchivedPayment.objects.filter(content_type=content_type)))
+        self.assertFalse(in_shards(PaymentAttempt.objects.filter(payment__content_type=content_type)))
+        # The EBT payments are left alone
+        self.assertEqual(len(in_shards(Payment.objects.all())), 1)
+        # The archived credit card payment was settled, its bucket is emptied
+        self.assertEqual(self.rollups(), [
+            ("order", "succeeded", "", 1, 2045),
+            ("payment", "succeeded", "ebtcard", 1, 800),
+        ])
+
+    def test_deleted_orders_leave_the_rollups(self):
+        settled = self.create_order()
+        self.capture(settled)
+        self.capture(self.create_order(order_total="1.00", ebt_total="0.00", credit="1.00", ebt="0.00"))
+        self.create_order()
+
+        deleted = bulk_delete.delete_orders(Order.objects.exclude(pk=settled), batch_size=1)
+        self.assertEqual(deleted, {"orders": 2, "payments": 4})
+        self.assertEqual(self.rollups(), [
+            ("order", "succeeded", "", 1, 2045),
+            ("payment", "succeeded", "creditcard", 1, 1245),
+            ("payment", "succeeded", "ebtcard", 1, 800),
+        ])
+
+
+class CreatePaymentTests(ApiTestCase):
+    def post_payment(self, **fields):
+        order = create_order_row(order_total=100, ebt_total=0)
+        data = {"order": order.pk, "payment_method": self.credit_card.pk, "amount": "1.00", "description": "test", "status": Payment.TYPE_REQ_CONF}
+        data.update(fields)
+        data = {key: value for key, value in data.items() if value is not None}
+        with quiet():
+            return self.client.post("/api/payments/", data, format="json")
+
+    def test_unknown_payment_card_is_rejected(self):
+        response = self.post_payment(payment_card="giftcard")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("payment_card", response.data)
+        self.assertFalse(in_shards(Payment.objects.all()))
+
+    def test_missing_payment_card_is_rejected(self):
+        response = self.post_payment(payment_card=None)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("payment_card", response.data)
+        self.assertFalse(in_shards(Payment.objects.all()))
+
+    def test_unknown_card_is_rejected(self):
+        response = self.post_payment(payment_card="ebtcard", payment_method=self.credit_card.pk + 100)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("payment_method", response.data)
+
+
+class StatusEventTests(ApiTestCase):
+    def event(self, event_id):
+        StatusEvent.objects.create(
+            id=event_id, object_type=StatusEvent.TYPE_ORDER, object_id=1, order_id=1, status=Order.TYPE_SUCCEEDED,
+        )
+
+    def test_non_finite_timeout_is_rejected(self):
+        for timeout in ("nan", "inf", "-inf"):
+            with quiet():
+                response = self.client.get("/api/events/", {"cursor": 0, "timeout": timeout})
+            self.assertEqual(response.status_code, 400, timeout)
+
+    def test_feed_waits_for_missing_ids(self):
+        for event_id in (1, 2, 4):
+            self.event(event_id)
+        feed = ChangeFeed(refresh_interval=0, gap_timeout=60)
+
+        events, cursor = feed.wait(0, timeout=0)
+        self.assertEqual(([event["id"] for event in events], cursor), ([1, 2], 2))
+
+        # 3 commits after 4
+        self.event(3)
+        events, cursor = feed.wait(cursor, timeout=0)
+        self.assertEqual(([event["id"] for event in events], cursor), ([3, 4], 4))
+
+    def test_feed_gives_up_on_rolled_back_ids(self):
+        for event_id in (1, 3):
+            self.event(event_id)
+        feed = ChangeFeed(refresh_interval=0, gap_timeout=0)
+        events, cursor = feed.wait(0, timeout=0)
+        self.assertEqual(([event["id"] for event in events], cursor), ([1, 3], 3))
+
+
+class ExportResumeTests(ApiTestCase):
+    def export(self, path, *args):
+        call_command("export_data", "payments", path, "--chunk-size", "3", *args, stdout=io.StringIO())
+
+    def crash_after(self, rows):
+        model, columns, iter_rows = export.EXPORTS["payments"]
+        read = []
+
+        # Counted over every shard, their rows are merged by the command
+        def crashing(queryset, chunk_size=2000):
+            for row in iter_rows(queryset, chunk_size):
+                if len(read) == rows:
+                    raise KeyboardInterrupt
+                read.append(row)
+                yield row
+
+        return mock.patch.dict(export.EXPORTS, {"payments": (model, columns, crashing)})
+
+    def test_resume_cuts_back_to_the_checkpoint(self):
+        for _ in range(4):
+            self.create_order()
+        temporary = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary.cleanup)
+        directory = temporary.name
+
+        for name, read in (("payments.csv", lambda path: open(path, "rb").read()),
+                           ("payments.csv.gz", lambda path: gzip.open(path, "rb").read())):
+            full, path = os.path.join(directory, "full-" + name), os.path.join(directory, name)
+            self.export(full)
+            with self.crash_after(5), self.assertRaises(KeyboardInterrupt):
+                self.export(path)
+            with open(path + ".progress") as f:
+                self.assertEqual(json.load(f)["last_id"], sorted(in_shards(Payment.objects.values_list("pk", flat=True)))[2])
+            # Rows written past the checkpoint before the crash, the last one cut short
+            with open(path, "ab") as f:
+                f.write(b"4,2,12.45,half a li")
+
+            self.export(path, "--resume")
+            self.assertEqual(read(path), read(full), name)
+
+    def test_resume_without_the_output_starts_over(self):
+        self.create_order()
+        temporary = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary.cleanup)
+        full, path = os.path.join(temporary.name, "full.csv"), os.path.join(temporary.name, "payments.csv")
+        self.export(full)
+        self.export(path)
+        os.remove(path)
+
+        self.export(path, "--resume")
+        with open(path, "rb") as f, open(full, "rb") as expected:
+            self.assertEqual(f.read(), expected.read())
+
+
+class ImportDataTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, name, lines):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        return path
+
+    def import_data(self, target, path, *args):
+        stdout = io.StringIO()
+        call_command("import_data", target, path, *args, stdout=stdout, stderr=io.StringIO())
+        return stdout.getvalue()
+
+    def test_malformed_lines_are_rejected(self):
+        path = self.write("cards.ndjson", [
+            json.dumps({"number": "4111111111111111110", "exp_month": 2, "exp_year": 30}),
+            '{"number": "4012888888881881", ',
+            json.dumps({"number": "4012888888881881", "exp_month": 2, "exp_year": 30}),
+        ])
+        rejects = os.path.join(self.directory, "rejects.ndjson")
+        output = self.import_data("credit_cards", path, "--rejects", rejects)
+
+        self.assertIn("2 imported, 1 rejected", output)
+        with open(rejects) as f:
+            self.assertEqual([json.loads(line)["record"] for line in f], [2])
+        self.assertEqual(CreditCard.objects.get(number="4012888888881881").last_4, "1881")
+
+    def test_cards_already_vaulted_are_skipped(self):
+        path = self.write("cards.ndjson", [
+            json.dumps({"number": CREDIT_CARD_NUMBER, "exp_month": 2, "exp_year": 30}),
+        ] * 2)
+        self.assertIn("0 imported, 0 rejected, 2 already present", self.import_data("credit_cards", path))
+        self.assertEqual(CreditCard.objects.count(), 1)
+
+    def test_payments_must_reference_existing_rows(self):
+        order = create_order_row(order_total=1000, ebt_total=0)
+        payment = {"order": order.pk, "payment_method": self.credit_card.pk, "payment_card": "creditcard",
+                   "amount": "10.00", "description": "import"}
+        path = self.write("payments.ndjson", [
+            json.dumps(payment),
+            json.dumps(dict(payment, order=order.pk + 100)),
+            json.dumps(dict(payment, payment_card="ebtcard", payment_method=self.credit_card.pk + 100)),
+        ])
+        self.assertIn("1 imported, 2 rejected", self.import_data("payments", path))
+        self.assertEqual(in_shards(Payment.objects.values_list("order_id", "amount")), [(order.pk, 1000)])
+
+    def test_resume_skips_checkpointed_records(self):
+        path = self.write("orders.csv", ["order_total,ebt_total", "1.00,0", "2.00,0", "3.00,1.00"])
+        with open(path + ".progress", "w") as f:
+            json.dump({"records": 2}, f)
+        self.assertIn("1 imported", self.import_data("orders", path, "--resume"))
+        self.assertEqual(in_shards(Order.objects.values_list("order_total", "ebt_total")), [(300, 100)])
+        with open(path + ".progress") as f:
+            self.assertEqual(json.load(f), {"records": 3})
+
+
+class ProfilingTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings = override_settings(
+            PROFILE_REQUESTS=True, PROFILE_TOKEN="secret", PROFILE_SAMPLE_RATE=0, PROFILE_DIR=directory.name,
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def get(self, path, token=None):
+        headers = {} if token is None else {"HTTP_X_PROFILE": token}
+        with quiet():
+            return self.client.get(path, **headers)
+
+    def test_requests_with_the_token_are_profiled(self):
+        response = self.get("/api/orders/", token="secret")
+        profile_id = response["X-Profile-Id"]
+
+        profiles = self.get("/api/profiles/", token="secret").data
+        self.assertEqual([profile["id"] for profile in profiles], [profile_id])
+        self.assertEqual(profiles[0]["trigger"], "header")
+        profile = self.get("/api/profiles/{}/".format(profile_id), token="secret").data
+        self.assertTrue(profile["functions"])
+        self.assertNotIn("queries", profile)
+
+    def test_other_requests_are_not_profiled(self):
+        for token in (None, "", "wrong"):
+            self.assertFalse(self.get("/api/orders/", token=token).has_header("X-Profile-Id"), token)
+        self.assertEqual(self.get("/api/profiles/", token="secret").data, [])
+
+    def test_profiles_need_the_token(self):
+        profile_id = self.get("/api/orders/", token="secret")["X-Profile-Id"]
+        for token in (None, "", "wrong"):
+            self.assertEqual(self.get("/api/profiles/", token=token).status_code, 403, token)
+            self.assertEqual(self.get("/api/profiles/{}/".format(profile_id), token=token).status_code, 403, token)
+
+    def test_token_is_required(self):
+        with override_settings(PROFILE_TOKEN=""):
+            with self.assertRaises(ImproperlyConfigured):
+                ProfilingMiddleware(lambda request: None)
+
+
+class ShardOutboxTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        # 'default' when orders are not sharded, the merge works the same there
+        self.shard = order_shards()[-1]
+
+    def order_on_shard(self):
+        """ A new order stored on self.shard. """
+        while True:
+            order_id = self.create_order()
+            if (shard_for_id(order_id) or "default") == self.shard:
+                return order_id
+
+    def pending(self):
+        return (
+            PendingSettlement.objects.using(self.shard).count(),
+            PendingStatusEvent.objects.using(self.shard).count(),
+        )
+
+    def add_pending(self, count=2):
+        day = timezone.localdate()
+        PendingSettlement.objects.using(self.shard).bulk_create([
+            PendingSettlement(date=day, source="order", status=Order.TYPE_SUCCEEDED, count=1, amount=100)
+            for _ in range(count)
+        ])
+        PendingStatusEvent.objects.using(self.shard).bulk_create([
+            PendingStatusEvent(object_type="order", object_id=order_id, order_id=order_id, status=Order.TYPE_SUCCEEDED)
+            for order_id in range(1, count + 1)
+        ])
+
+    @skipUnless(sharding_enabled(), "orders are not sharded, run with API_TAKE_HOME_ORDER_SHARDS=2")
+    def test_capture_on_a_shard_writes_nothing_to_default(self):
+        order_id = self.order_on_shard()
+        payment_ids = in_shards(Payment.objects.filter(order_id=order_id).values_list("pk", flat=True))
+        self.assertEqual({shard_for_id(payment_id) for payment_id in payment_ids}, {self.shard})
+
+        writes = []
+
+        def record_writes(execute, sql, params, many, context):
+            if not sql.lstrip().upper().startswith(("SELECT", "SAVEPOINT", "RELEASE")):
+                writes.append(sql)
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record_writes):
+            self.assertEqual(self.capture(order_id).status_code, 200)
+        self.assertEqual(writes, [])
+        self.assertEqual(self.pending(), (3, 3))
+        self.assertFalse(StatusEvent.objects.exists())
+
+        self.assertEqual(merge_outbox(), {"settlements": 3, "events": 3})
+        self.assertEqual(self.pending(), (0, 0))
+        self.assertEqual(StatusEvent.objects.filter(order_id=order_id).count(), 3)
+        self.assertEqual(self.rollups(), [
+            ("order", "succeeded", "", 1, 2045),
+            ("payment", "succeeded", "creditcard", 1, 1245),
+            ("payment", "succeeded", "ebtcard", 1, 800),
+        ])
+
+    def test_merge_moves_pending_rows_in_batches(self):
+        self.add_pending(3)
+        self.assertEqual(outbox.merge_shard(self.shard, batch_size=2), (3, 3))
+        self.assertEqual(self.pending(), (0, 0))
+        self.assertEqual(list(StatusEvent.objects.order_by("pk").values_list("object_id", flat=True)), [1, 2, 3])
+        self.assertEqual(DailySettlement.objects.get(source="order").count, 3)
+        self.assertEqual(MergedBatch.objects.count(), 2)
+
+    def test_interrupted_merge_is_applied_once(self):
+        self.add_pending()
+        batch = outbox.claim_batch(self.shard, 1000)
+        # Applied to 'default', the process dies before the rows are deleted from the shard
+        with mock.patch.object(outbox, "PENDING_MODELS", ()):
+            outbox.apply_batch(self.shard, batch)
+        self.assertEqual(self.pending(), (2, 2))
+
+        self.assertEqual(outbox.merge_shard(self.shard), (0, 0))
+        self.assertEqual(self.pending(), (0, 0))
+        self.assertEqual(StatusEvent.objects.count(), 2)
+        self.assertEqual(DailySettlement.objects.get(source="order").amount, 200)
+
+    def test_claimed_batch_is_finished_first(self):
+        self.add_pending()
+        outbox.claim_batch(self.shard, 1000)
+        # A row added after the claim goes into the next batch
+        self.add_pending(1)
+        self.assertEqual(outbox.merge_shard(self.shard), (3, 3))
+        self.assertEqual(list(StatusEvent.objects.order_by("pk").values_list("object_id", flat=True)), [1, 2, 1])
+
+    def test_rebuild_drops_pending_changes_it_counts(self):
+        self.add_pending()
+        yesterday = timezone.localdate() - timedelta(days=1)
+        PendingSettlement.objects.using(self.shard).update(date=yesterday)
+        call_command("rebuild_settlements", stdout=io.StringIO())
+        self.assertEqual(self.pending(), (0, 2))
+
+
+class ReplicaRoutingTests(DatabaseTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("api.routers.replicas", return_value=["replica"])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.router = PrimaryReplicaRouter()
+
+    def in_request(self, request):
+        """ Runs ReplicaPinningMiddleware, returns the response and where the view read from. """
+        reads = []
+
+        def view(request):
+            reads.append(self.router.db_for_read(CreditCard))
+            if request.method not in ("GET", "HEAD", "OPTIONS"):
+                self.router.db_for_write(CreditCard)
+            return HttpResponse()
+
+        # Like the server, every request gets its own context
+        response = contextvars.Context().run(ReplicaPinningMiddleware(view), request)
+        return response, reads[0]
+
+    def test_reads_go_to_the_primary_when_pinned_or_in_a_transaction(self):
+        def reads():
+            found = [self.router.db_for_read(CreditCard)]
+            with transaction.atomic():
+                found.append(self.router.db_for_read(CreditCard))
+            self.router.db_for_write(CreditCard)
+            found.append(self.router.db_for_read(CreditCard))
+            return found
+
+        # Outside of the test's context, which earlier writes have pinned
+        self.assertEqual(contextvars.Context().run(reads), ["replica", "default", "default"])
+
+    def test_writes_pin_the_following_requests(self):
+        factory = RequestFactory()
+        response, read_from = self.in_request(factory.get("/api/orders/"))
+        self.assertEqual(read_from, "replica")
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+        response, read_from = self.in_request(factory.post("/api/orders/"))
+        self.assertEqual(read_from, "default")
+        pinned_until = response.cookies[PIN_COOKIE].value
+
+        request = factory.get("/api/orders/")
+        request.COOKIES[PIN_COOKIE] = pinned_until
+        response, read_from = self.in_request(request)
+        self.assertEqual(read_from, "default")
+        # Reading does not extend the pin
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+        for expired in (str(time.time() - 1), "garbage"):
+            request = factory.get("/api/orders/")
+            request.COOKIES[PIN_COOKIE] = expired
+            self.assertEqual(self.in_request(request)[1], "replica", expired)
+
+
+class ProcessPaymentsTests(ApiTestCase):
+    def test_one_upstream_call_per_batch(self):
+        order_ids = [self.create_order(), self.create_order()]
+        payments = sorted(in_shards(Payment.objects.filter(order_id__in=order_ids)), key=lambda payment: payment.pk)
+        payments[1].status = Payment.TYPE_SUCCEEDED
+        payments[1].save()
+
+        with mock.patch("processor.authorizePayments", return_value=[None, "Suspected fraud", None]) as authorize:
+            results = processPayments(payments)
+        # The payment that already succeeded is not submitted again
+        authorize.assert_called_once_with([payments[0], payments[2], payments[3]])
+        self.assertEqual(results, [None, None, "Suspected fraud", None])
+
+        stored = {payment.pk: payment for payment in in_shards(Payment.objects.all())}
+        self.assertEqual(
+            [(stored[payment.pk].status, stored[payment.pk].attempt_count) for payment in payments],
+            [
+                (Payment.TYPE_SUCCEEDED, 1),
+                (Payment.TYPE_SUCCEEDED, 0),
+                (Payment.TYPE_FAILED, 1),
+                (Payment.TYPE_SUCCEEDED, 1),
+            ],
+        )
+        self.assertEqual(stored[payments[2].pk].last_processing_error, "Suspected fraud")
+        self.assertEqual(
+            sorted(in_shards(PaymentAttempt.objects.values_list("payment_id", "attempt", "status", "error"))),
+            [
+                (payments[0].pk, 1, Payment.TYPE_SUCCEEDED, None),
+                (payments[2].pk, 1, Payment.TYPE_FAILED, "Suspected fraud"),
+                (payments[3].pk, 1, Payment.TYPE_SUCCEEDED, None),
+            ],
+        )
+        merge_outbox()
+        self.assertEqual(StatusEvent.objects.filter(object_type="payment").count(), 3)
+
+    def test_nothing_to_submit(self):
+        order_id = self.create_order()
+        payments = in_shards(Payment.objects.filter(order_id=order_id))
+        for payment in payments:
+            payment.status = Payment.TYPE_SUCCEEDED
+        with mock.patch("processor.authorizePayments") as authorize:
+            self.assertEqual(processPayments([]), [])
+            self.assertEqual(processPayments(payments), [None, None])
+        authorize.assert_not_called()
+        self.assertEqual(in_shards(PaymentAttempt.objects.all()), [])
+
+
+class RetryPaymentsTests(ApiTestCase):
+    def capture_failing(self, order_id, error):
+        with mock.patch("processor.authorizePayments", side_effect=lambda payments: [error for _ in payments]):
+            self.assertEqual(self.capture(order_id).data["status"], Order.TYPE_FAILED)
+        return in_shards(Payment.objects.filter(order_id=order_id))
+
+    def retry(self, error=None, after=timedelta(hours=1)):
+        with mock.patch("processor.authorizePayments", side_effect=lambda payments: [error for _ in payments]):
+            return retry_due_payments(now=timezone.now() + after)
+
+    def test_transient_failures_are_retried(self):
+        order_id = self.create_order()
+        payments = self.capture_failing(order_id, "Card network outage")
+        for payment in payments:
+            self.assertEqual((payment.status, payment.attempt_count), (Payment.TYPE_FAILED, 1))
+            self.assertGreater(payment.next_retry_at, payment.processed_date)
+
+        # Not due yet
+        self.assertEqual(self.retry(after=timedelta(0))["retried"], 0)
+        self.assertEqual(self.retry(), {"retried": 2, "succeeded": 2, "orders": 1})
+
+        order = Order.objects.using(shard_for_id(order_id)).get(pk=order_id)
+        self.assertEqual(order.status, Order.TYPE_SUCCEEDED)
+        self.assertEqual(
+            [(payment.status, payment.attempt_count, payment.next_retry_at) for payment in in_shards(Payment.objects.all())],
+            [(Payment.TYPE_SUCCEEDED, 2, None)] * 2,
+        )
+        self.assertEqual(len(in_shards(PaymentAttempt.objects.all())), 4)
+        self.assertEqual(self.rollups(), [
+            ("order", "succeeded", "", 1, 2045),
+            ("payment", "succeeded", "creditcard", 1, 1245),
+            ("payment", "succeeded", "ebtcard", 1, 800),
+        ])
+
+    def test_other_failures_are_not_retried(self):
+        payments = self.capture_failing(self.create_order(), "Suspected fraud")
+        self.assertEqual([payment.next_retry_at for payment in payments], [None, None])
+        self.assertEqual(self.retry()["retried"], 0)
+
+    @override_settings(PAYMENT_RETRY_MAX_ATTEMPTS=2)
+    def test_retries_stop_after_the_last_attempt(self):
+        self.capture_failing(self.create_order(), "Card network outage")
+        self.assertEqual(self.retry("Card network outage"), {"retried": 2, "succeeded": 0, "orders": 0})
+        self.assertEqual(self.retry(after=timedelta(days=1))["retried"], 0)
+
+        self.assertEqual(
+            [(payment.attempt_count, payment.next_retry_at) for payment in in_shards(Payment.objects.all())],
+            [(2, None)] * 2,
+        )
+        self.assertEqual(retry_metrics()["queue"], {"depth": 0, "due": 0, "oldest_due_at": None, "exhausted": 2})
@@ -1,6 +1,7 @@
 from django.urls import path
 
 from api import views
+from api.models import CreditCard, EBTCard
 
 
 app_name = "api"
@@ -16,6 +17,11 @@ urlpatterns = [
         views.ListCreateEBTCard.as_view(),
         name="ebt-cards-list-create",
     ),
+    path(
+        "ebt_cards/bulk_delete/",
+        views.BulkDeleteCards.as_view(card_model=EBTCard),
+        name="ebt-cards-bulk-delete",
+    ),
     path(
         "credit_cards/",
         views.ListCreateCreditCard.as_view(),
@@ -26,16 +32,26 @@ urlpatterns = [
         views.RetrieveDeleteCreditCard.as_view(),
         name="credit-cards-retrieve-delete",
     ),
+    path(
+        "credit_cards/bulk_delete/",
+        views.BulkDeleteCards.as_view(card_model=CreditCard),
+        name="credit-cards-bulk-delete",
+    ),
     path(
         "orders/",
         views.ListCreateOrder.as_view(),
         name="orders-list-create",
     ),
     path(
-        "orders/<int:pk>/",
+        "orders/<int:id>/",
         views.RetrieveDeleteOrder.as_view(),
         name="orders-retrieve-delete",
     ),
+    path(
+        "orders/bulk_delete/",
+        views.BulkDeleteOrders.as_view(),
+        name="orders-bulk-delete",
+    ),
     path(
         "payments/",
         views.ListCreatePayment.as_view(),
@@ -51,4 +67,39 @@ urlpatterns = [
         views.CaptureOrder.as_view(), 
         name="orders-capture"
     ),
+    path(
+        "reports/settlements/",
+        views.ListSettlements.as_view(),
+        name="reports-settlements",
+    ),
+    path(
+        "exports/<str:target>/",
+        views.ExportRows.as_view(),
+        name="exports",
+    ),
+    path(
+        "events/",
+        views.ListStatusEvents.as_view(),
+        name="events-list",
+    ),
+    path(
+        "events/stream/",
+        views.StreamStatusEvents.as_view(),
+        name="events-stream",
+    ),
+    path(
+        "metrics/retries/",
+        views.RetryMetrics.as_view(),
+        name="metrics-retries",
+    ),
+    path(
+        "profiles/",
+        views.ListProfiles.as_view(),
+        name="profiles-list",
+    ),
+    path(
+        "profiles/<str:profile_id>/",
+        views.RetrieveProfile.as_view(),
+        name="profiles-retrieve",
+    ),
 ]
@@ -1,18 +1,80 @@
 # See the fixtures/ directory for examples of the request bodies
 # needed to create objects using the ListCreateAPIViews below.
 
+from django.db import transaction
+from django.db.models import Q, Sum
+from django.db.models.functions import Coalesce
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
+from django.utils.cache import add_never_cache_headers
 from django.utils import timezone
+from django.utils.dateparse import parse_date
 from rest_framework import status
 from rest_framework.generics import ListCreateAPIView, RetrieveDestroyAPIView
 from rest_framework.response import Response
 from rest_framework.views import APIView
-from api.models import Payment, CreditCard, Order, EBTCard
-from api.serializers import PaymentSerializer, CreditCardSerializer, OrderSerializer, EBTCardSerializer
-from processor import processPayment
+from api.models import Payment, CreditCard, Order, EBTCard, DailySettlement, ArchivedOrder, ArchivedPayment
+from api.serializers import PaymentSerializer, CreditCardSerializer, OrderSerializer, EBTCardSerializer, DailySettlementSerializer, ArchivedOrderSerializer, ArchivedPaymentSerializer, CardBulkDeleteSerializer, OrderBulkDeleteSerializer
+from api.settlements import record_order_transition
+from api.events import change_feed, record_status_events
+from api.export import EXPORTS, FORMAT_CSV, WRITERS, iter_export, iter_gzip
+from api.bulk_delete import DeleteRestricted, ON_DELETE_CHOICE, ON_DELETE_RESTRICT, delete_cards, delete_orders
+from api.sharding import attach_payment_methods, merge_shards, shard_for_id
+from api.profiling import has_profile_token, list_profiles, load_profile, profiling_enabled
+from api.retries import retry_metrics
 from django.contrib.contenttypes.models import ContentType
 
 import json
+import math
+
+MAX_PAGE_SIZE = 1000
+
+
+def list_across_shards(request, queryset, serializer_class, prepare=None):
+    """ Shared GET handler of the order and payment lists.
+
+    Rows are merged in id order from every shard (see api/sharding.py). With
+    ?limit=N the response is a page of at most N rows, {"results": [...], "cursor": id},
+    and ?cursor=id returns the next one (cursor is null on the last page). Without
+    limit every row is returned as a plain list.
+    """
+    cursor = request.query_params.get("cursor")
+    limit = request.query_params.get("limit")
+    for name, value in (("cursor", cursor), ("limit", limit)):
+        if value is not None and not value.isdigit():
+            return Response({"error_message": "{} must be a number".format(name)}, status=status.HTTP_400_BAD_REQUEST)
+    if limit is not None:
+        limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+
+    rows = merge_shards(queryset, after=int(cursor) if cursor is not None else None, limit=limit)
+    if prepare is not None:
+        prepare(rows)
+    data = serializer_class(rows, many=True).data
+    if limit is None:
+        return Response(data)
+    return Response({"results": data, "cursor": rows[-1].pk if len(rows) == limit else None})
+
+
+def delete_card(request, card_model, card_id):
+    """ Shared DELETE handler of the card endpoints.
+
+    Payments which still use the card make the delete fail with 409, unless
+    ?on_delete=cascade is passed, in which case those payments are deleted too.
+    """
+    name = card_model.__name__
+    on_delete = request.query_params.get("on_delete", ON_DELETE_RESTRICT)
+    if on_delete not in dict(ON_DELETE_CHOICE):
+        return Response({"detail": "on_delete must be restrict or cascade."}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        deleted = delete_cards(card_model, card_model.objects.filter(id=card_id), on_delete=on_delete)
+    except DeleteRestricted as e:
+        return Response({"detail": "{} is in use: {}.".format(name, e)}, status=status.HTTP_409_CONFLICT)
+
+    if deleted["cards"]:
+        return Response({"detail": "{} deleted.".format(name)}, status=status.HTTP_204_NO_CONTENT)
+    return Response({"detail": "{} not found.".format(name)}, status=status.HTTP_404_NOT_FOUND)
+
 
 # done
 class ListCreateEBTCard(APIView):
@@ -35,7 +97,9 @@ class ListCreateEBTCard(APIView):
         serializer = EBTCardSerializer(data=request.data)
         if serializer.is_valid():
             serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            # An already vaulted card is returned as is
+            status_code = status.HTTP_201_CREATED if serializer.created else status.HTTP_200_OK
+            return Response(serializer.data, status=status_code)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
@@ -60,12 +124,7 @@ class RetrieveDeleteEBTCard(APIView):
 
     def delete(self, request, *args, **kwargs):
         card_id = self.kwargs['id']  
-        try:
-            ebt_card = EBTCard.objects.get(id=card_id)
-            ebt_card.delete()
-            return Response({"detail": "EBTCard deleted."}, status=status.HTTP_204_NO_CONTENT)
-        except EBTCard.DoesNotExist:
-            return Response({"detail": "EBTCard not found."}, status=status.HTTP_404_NOT_FOUND)
+        return delete_card(request, EBTCard, card_id)
 
 
 
@@ -91,7 +150,9 @@ class ListCreateCreditCard(ListCreateAPIView):
         serializer = CreditCardSerializer(data=request.data)
         if serializer.is_valid():
             serializer.save()
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
+            # An already vaulted card is returned as is
+            status_code = status.HTTP_201_CREATED if serializer.created else status.HTTP_200_OK
+            return Response(serializer.data, status=status_code)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 # done
@@ -114,12 +175,7 @@ class RetrieveDeleteCreditCard(RetrieveDestroyAPIView):
 
     def delete(self, request, *args, **kwargs):
         card_id = self.kwargs['pk']  
-        try:
-            credit_card = CreditCard.objects.get(id=card_id)
-            credit_card.delete()
-            return Response({"detail": "C4reditCard deleted."}, status=status.HTTP_204_NO_CONTENT)
-        except CreditCard.DoesNotExist:
-            return Response({"detail": "CreditCard not found."}, status=status.HTTP_404_NOT_FOUND)
+        return delete_card(request, CreditCard, card_id)
 
 
 # done
@@ -135,10 +191,7 @@ class ListCreateOrder(ListCreateAPIView):
 
     def get(self, request, *args, **kwargs):
         print("GET request from /api/orders/ ")
-        queryset = Order.objects.all()
-        serializer_class = OrderSerializer
-        serializer = serializer_class(queryset, many=True)
-        return Response(serializer.data)
+        return list_across_shards(request, Order.objects.all(), OrderSerializer)
     
     # This is the way to call POST request in django 
 
@@ -165,21 +218,27 @@ class RetrieveDeleteOrder(RetrieveDestroyAPIView):
     def get(self, request, *args, **kwargs):
         order_id = self.kwargs['id']  # Access the ID passed in the URL
         try:
-            queryset = Order.objects.get(id=order_id)  # Retrieve the card by ID
+            queryset = Order.objects.using(shard_for_id(order_id)).get(id=order_id)  # Retrieve the card by ID
             serializer = OrderSerializer(queryset)  # Use serializer for a single object
             return Response(serializer.data)
         except Order.DoesNotExist:
+            pass
+
+        # Settled orders are moved to the archive after a while (see api/archive.py)
+        try:
+            queryset = ArchivedOrder.objects.using(shard_for_id(order_id)).get(id=order_id)
+            serializer = ArchivedOrderSerializer(queryset)
+            return Response(serializer.data)
+        except ArchivedOrder.DoesNotExist:
             return Response({"detail": "Order not found."}, status=status.HTTP_404_NOT_FOUND)
     
 
     def delete(self, request, *args, **kwargs):
         order_id = self.kwargs['id']  
-        try:
-            oorder = Order.objects.get(id=order_id)
-            oorder.delete()
+        deleted = delete_orders(Order.objects.filter(id=order_id))
+        if deleted["orders"]:
             return Response({"detail": "Order deleted."}, status=status.HTTP_204_NO_CONTENT)
-        except EBTCard.DoesNotExist:
-            return Response({"detail": "Order not found."}, status=status.HTTP_404_NOT_FOUND)
+        return Response({"detail": "Order not found."}, status=status.HTTP_404_NOT_FOUND)
 
 
 
@@ -204,10 +263,8 @@ class ListCreatePayment(ListCreateAPIView):
 
 
     def get(self, request, *args, **kwargs):
-        queryset = Payment.objects.all()
-        serializer_class = PaymentSerializer
-        serializer = serializer_class(queryset, many=True)
-        return Response(serializer.data)
+        # Cards are fetched with one query per card type for the whole page
+        return list_across_shards(request, Payment.objects.all(), PaymentSerializer, prepare=attach_payment_methods)
     
 
 
@@ -237,10 +294,18 @@ class RetrieveDeletePayment(RetrieveDestroyAPIView):
     def get(self, request, *args, **kwargs):
         payment_id = self.kwargs['id']
         try:
-            queryset = Payment.objects.get(id=payment_id)
+            queryset = Payment.objects.using(shard_for_id(payment_id)).get(id=payment_id)
             serializer = PaymentSerializer(queryset)
             return Response(serializer.data)
         except Payment.DoesNotExist:
+            pass
+
+        # Payments are archived together with their settled order (see api/archive.py)
+        try:
+            queryset = ArchivedPayment.objects.using(shard_for_id(payment_id)).get(id=payment_id)
+            serializer = ArchivedPaymentSerializer(queryset)
+            return Response(serializer.data)
+        except ArchivedPayment.DoesNotExist:
             return Response({"detail": "Payment not found."}, status=status.HTTP_404_NOT_FOUND)
     
     def delete(self, request, *args, **kwargs):
@@ -268,53 +333,55 @@ class CaptureOrder(APIView):
     """
 
     def post(self, request, id):
-        try:
-            order_obj = Order.objects.get(id=id) # throws if order_id not found
-
-            # Find all Payments associated with this Order via /api/payments/
-            payment_queryset = Payment.objects.filter(order__id=id)
+        # Imported here so that processes which never capture (e.g. read-only API
+        # workers, management commands) do not load the processor integration
+        from processor import processPayments
 
-        
-            # print("PAYMENT QUERYSET: ",payment_queryset) 
-            # for payments in payment_queryset:
-            #     if payments.payment_card == 'ebtcard':
-            #         print("EBT PAYMENTS: ",payments.amount)
-            #     else:
-            #         print("CREDIT PAYMENTS: ",payments.amount)
-
-            # Payments must satisfy the order_total
-            total_payment_amount = sum([x.amount for x in payment_queryset])
-            if total_payment_amount != order_obj.order_total:
-                print("Total payment amount: ", total_payment_amount)
-                print("Order total: ", order_obj.order_total)
+        try:
+            # The order and its payments are in the same shard
+            shard = shard_for_id(id)
+            order_obj = Order.objects.using(shard).get(id=id) # throws if order_id not found
+
+            # Payments must satisfy the order_total and the EBT total. Amounts are integer
+            # cents (see api/money.py), both totals are summed by the database. Content
+            # types are matched by the id from 'default', the shards' own copies of the
+            # django_content_type table are not kept in sync.
+            ebt_content_type = ContentType.objects.get_for_model(EBTCard)
+            totals = Payment.objects.using(shard).filter(order__id=id).aggregate(
+                payments=Coalesce(Sum("amount"), 0),
+                ebt=Coalesce(Sum("amount", filter=Q(content_type_id=ebt_content_type.pk)), 0),
+            )
+            if totals["payments"] != order_obj.order_total:
                 return Response({
                     "error_message": "Payment total does not match order total for Order with id {}".format(id)
                 }, status=status.HTTP_400_BAD_REQUEST)
 
-            
-            # Payments must satisfy the EBT total
-
-            
-            ebt_payments_amount = sum([payment.amount for payment in payment_queryset if payment.content_type.model == 'ebtcard'])
-            print("EBT PAYMENTS AMOUNT: ",ebt_payments_amount)
-            if ebt_payments_amount > order_obj.ebt_total:
+            if totals["ebt"] > order_obj.ebt_total:
                 return Response({"error_message": "Total amount of payments with EBT cards exceeds EBT eligibility for Order with id {}".format(id)}, status=status.HTTP_400_BAD_REQUEST)
 
+            # Find all Payments associated with this Order via /api/payments/
+            # (the cards are fetched up front rather than once per payment)
+            payment_queryset = attach_payment_methods(list(Payment.objects.using(shard).filter(order__id=id)))
 
-            potential_errors = []
-            for payment in payment_queryset:
-                potential_error = processPayment(payment)
+            # All the payments of the order go to the processor in one batch
+            potential_errors = [error for error in processPayments(payment_queryset) if error]
 
-                if potential_error:
-                    potential_errors.append(potential_error)
+            old_status = order_obj.status
+            old_processed_date = order_obj.processed_date
+            order_obj.processed_date = timezone.now()
 
             if potential_errors:
                 order_obj.status = Order.TYPE_FAILED
             else:
                 order_obj.status = Order.TYPE_SUCCEEDED
-                order_obj.success_date = timezone.now()
+                order_obj.success_date = order_obj.processed_date
 
-            order_obj.save() # write status back to database
+            # Everything is written to the order's shard, see api/outbox.py
+            order_db = order_obj._state.db
+            with transaction.atomic(using=order_db):
+                order_obj.save() # write status back to database
+                record_order_transition(order_obj, old_status, old_processed_date, order_db)
+                record_status_events([order_obj], order_db)
 
             return Response(
                 OrderSerializer(order_obj).data
@@ -324,3 +391,269 @@ class CaptureOrder(APIView):
             return Response({
                 "error_message": "Unable to find Order with id {}".format(id)
             }, status=status.HTTP_404_NOT_FOUND)
+
+
+class ListSettlements(APIView):
+    """ Exposes the following routes,
+
+    1. GET http://localhost:8000/api/reports/settlements/?start=2023-08-01&end=2023-08-31
+       <- returns the daily settlement totals for every day in the (inclusive) range,
+          broken down by source (order/payment), status, card brand and tender.
+          Both start and end are optional, and source=order or source=payment narrows
+          the report down to one kind of row.
+
+    Totals are read from the DailySettlement rollups, so the cost of a report only
+    depends on the number of days requested and not on the size of the Payment table.
+    """
+
+    def get(self, request, format=None):
+        queryset = DailySettlement.objects.all()
+
+        for param, lookup in (("start", "date__gte"), ("end", "date__lte")):
+            value = request.query_params.get(param)
+            if value is None:
+                continue
+            try:
+                day = parse_date(value)
+            except ValueError:
+                day = None
+            if day is None:
+                return Response({
+                    "error_message": "{} must be a date in the YYYY-MM-DD format".format(param)
+                }, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(**{lookup: day})
+
+        source = request.query_params.get("source")
+        if source is not None:
+            queryset = queryset.filter(source=source)
+
+        # Rows that went back to zero after a payment was retried are not interesting
+        queryset = queryset.exclude(count=0)
+
+        serializer = DailySettlementSerializer(queryset, many=True)
+        return Response(serializer.data)
+
+
+class BulkDeleteCards(APIView):
+    """ Exposes the following routes,
+
+    1. POST http://localhost:8000/api/credit_cards/bulk_delete/
+    2. POST http://localhost:8000/api/ebt_cards/bulk_delete/
+       <- deletes every card matching the body, e.g.
+          {"ids": [1, 2, 3], "on_delete": "cascade"} or {"brand": "amex"}
+
+    With on_delete=restrict (the default) nothing is deleted if any of the cards is
+    still used by a payment. With on_delete=cascade those payments are deleted too.
+    """
+    card_model = None
+
+    def post(self, request, format=None):
+        serializer = CardBulkDeleteSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            deleted = delete_cards(
+                self.card_model,
+                serializer.get_queryset(self.card_model.objects.all()),
+                on_delete=serializer.validated_data["on_delete"],
+            )
+        except DeleteRestricted as e:
+            return Response({"detail": str(e)}, status=status.HTTP_409_CONFLICT)
+        return Response(deleted)
+
+
+class BulkDeleteOrders(APIView):
+    """ Exposes the following routes,
+
+    1. POST http://localhost:8000/api/orders/bulk_delete/
+       <- deletes every order matching the body, together with its payments, e.g.
+          {"ids": [1, 2, 3]} or {"status": "failed"}
+    """
+
+    def post(self, request, format=None):
+        serializer = OrderBulkDeleteSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        deleted = delete_orders(serializer.get_queryset(Order.objects.all()))
+        return Response(deleted)
+
+
+class ExportRows(APIView):
+    """ Exposes the following routes,
+
+    1. GET http://localhost:8000/api/exports/orders/
+    2. GET http://localhost:8000/api/exports/payments/
+       <- streams every row in id order as CSV (default) or NDJSON. Optional query
+          params are output=csv|ndjson, gzip=1, start and end (YYYY-MM-DD, on the
+          processed date), status (can be repeated) and after_id to resume a
+          download after the last id received.
+
+    Rows are read with a server-side cursor and written to the response as they are
+    encoded, so the response never has to fit in memory.
+    """
+
+    def get(self, request, target, format=None):
+        if target not in EXPORTS:
+            return Response({"detail": "Unknown export {}.".format(target)}, status=status.HTTP_404_NOT_FOUND)
+
+        file_format = request.query_params.get("output", FORMAT_CSV)
+        if file_format not in WRITERS:
+            return Response({"error_message": "output must be csv or ndjson"}, status=status.HTTP_400_BAD_REQUEST)
+
+        filters = {"statuses": request.query_params.getlist("status")}
+        for param in ("start", "end"):
+            value = request.query_params.get(param)
+            if value is None:
+                continue
+            try:
+                filters[param] = parse_date(value)
+            except ValueError:
+                filters[param] = None
+            if filters[param] is None:
+                return Response({
+                    "error_message": "{} must be a date in the YYYY-MM-DD format".format(param)
+                }, status=status.HTTP_400_BAD_REQUEST)
+        after_id = request.query_params.get("after_id")
+        if after_id is not None:
+            if not after_id.isdigit():
+                return Response({"error_message": "after_id must be a number"}, status=status.HTTP_400_BAD_REQUEST)
+            filters["after_id"] = int(after_id)
+
+        content = iter_export(target, file_format, **filters)
+        filename = "{}.{}".format(target, file_format)
+        content_type = "text/csv" if file_format == FORMAT_CSV else "application/x-ndjson"
+        if request.query_params.get("gzip") in ("1", "true"):
+            content = iter_gzip(content)
+            filename += ".gz"
+            content_type = "application/gzip"
+
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response["Content-Disposition"] = 'attachment; filename="{}"'.format(filename)
+        return response
+
+
+def parse_feed_params(request):
+    """ Returns (cursor, order_id) from the query params of the event endpoints. """
+    cursor = request.query_params.get("cursor", request.META.get("HTTP_LAST_EVENT_ID"))
+    order_id = request.query_params.get("order")
+    for name, value in (("cursor", cursor), ("order", order_id)):
+        if value is not None and not value.isdigit():
+            raise ValueError("{} must be a number".format(name))
+    return (
+        int(cursor) if cursor is not None else None,
+        int(order_id) if order_id is not None else None,
+    )
+
+
+class ListStatusEvents(APIView):
+    """ Exposes the following routes,
+
+    1. GET http://localhost:8000/api/events/?cursor=42&order=7&timeout=25
+       <- long-polls for Order/Payment status changes. Returns as soon as there are
+          events after cursor (optionally only those of one order), or an empty list
+          after timeout seconds (at most 60). Pass the returned cursor to the next call.
+          Without a cursor only events from now on are returned.
+
+    Use this instead of polling GET /api/orders/:id/ after a capture.
+    """
+    max_timeout = 60
+
+    def get(self, request, format=None):
+        try:
+            cursor, order_id = parse_feed_params(request)
+            timeout = float(request.query_params.get("timeout", 25))
+            # nan would never reach the deadline and hold the worker forever
+            if not math.isfinite(timeout):
+                raise ValueError("timeout must be a finite number of seconds")
+            timeout = min(timeout, self.max_timeout)
+        except ValueError as e:
+            return Response({"error_message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        events, cursor = change_feed.wait(cursor, max(timeout, 0), order_id)
+        return Response({"events": events, "cursor": cursor})
+
+
+class StreamStatusEvents(APIView):
+    """ Exposes the following routes,
+
+    1. GET http://localhost:8000/api/events/stream/?cursor=42&order=7
+       <- Server-Sent Events stream of Order/Payment status changes. Every event
+          carries its id, so EventSource reconnects resume through Last-Event-ID.
+    """
+    keepalive = 15
+
+    def get(self, request, format=None):
+        try:
+            cursor, order_id = parse_feed_params(request)
+        except ValueError as e:
+            return Response({"error_message": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        def stream(cursor):
+            while True:
+                events, cursor = change_feed.wait(cursor, self.keepalive, order_id)
+                if not events:
+                    yield ": keepalive\n\n"
+                for event in events:
+                    yield "id: {}\nevent: status\ndata: {}\n\n".format(event["id"], json.dumps(event))
+
+        response = StreamingHttpResponse(stream(cursor), content_type="text/event-stream")
+        add_never_cache_headers(response)
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+
+class RetryMetrics(APIView):
+    """ Exposes the following routes,
+
+    1. GET http://localhost:8000/api/metrics/retries/ <- returns the state of the
+       payment retry queue (see api/retries.py): payments waiting for a retry, how
+       many of them are due, since when the oldest one is due and how many ran out of
+       attempts, and processor attempts (first tries and retries) over the last 5
+       minutes and the last hour.
+    """
+
+    def get(self, request, format=None):
+        return Response(retry_metrics())
+
+
+class ListProfiles(APIView):
+    """ Exposes the following routes,
+
+    1. GET http://localhost:8000/api/profiles/ <- returns the most recent request
+       profiles (newest first): path, status, duration and number of queries.
+
+    Requests are only profiled when settings.PROFILE_REQUESTS is on (see
+    api/profiling.py), otherwise this returns 404. The request needs the
+    X-Profile: <PROFILE_TOKEN> header.
+    """
+
+    def get(self, request, format=None):
+        if not profiling_enabled():
+            return Response({"detail": "Profiling is not enabled."}, status=status.HTTP_404_NOT_FOUND)
+        if not has_profile_token(request):
+            return Response({"detail": "X-Profile header missing or invalid."}, status=status.HTTP_403_FORBIDDEN)
+        return Response(list_profiles())
+
+
+class RetrieveProfile(APIView):
+    """ Exposes the following routes,
+
+    1. GET http://localhost:8000/api/profiles/:profile_id/ <- returns the summary of
+       one profile: its top functions by cumulative and by internal time, and its
+       slowest queries. ?queries=1 adds the full SQL query log.
+
+    The id is the X-Profile-Id header of the profiled response. The raw cProfile data
+    is in <PROFILE_DIR>/<id>.prof. Like the list, this needs the X-Profile header.
+    """
+
+    def get(self, request, profile_id, format=None):
+        if profiling_enabled() and not has_profile_token(request):
+            return Response({"detail": "X-Profile header missing or invalid."}, status=status.HTTP_403_FORBIDDEN)
+        profile = load_profile(profile_id) if profiling_enabled() else None
+        if profile is None:
+            return Response({"detail": "Profile not found."}, status=status.HTTP_404_NOT_FOUND)
+        if request.query_params.get("queries") != "1":
+            del profile["queries"]
+        return Response(profile)
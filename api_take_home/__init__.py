@@ -0,0 +1,20 @@
+import os
+
+
+# Settings module used for each value of the API_TAKE_HOME_PROFILE environment
+# variable. "api" is the lean, JSON-only profile from settings_api.py.
+SETTINGS_PROFILES = {
+    "full": "api_take_home.settings",
+    "api": "api_take_home.settings_api",
+}
+
+
+def settings_module():
+    """ Settings module selected by API_TAKE_HOME_PROFILE, the full profile by default. """
+    profile = os.environ.get("API_TAKE_HOME_PROFILE", "full")
+    try:
+        return SETTINGS_PROFILES[profile]
+    except KeyError:
+        raise RuntimeError(
+            "Unknown API_TAKE_HOME_PROFILE {!r}, use one of {}".format(profile, ", ".join(SETTINGS_PROFILES))
+        )
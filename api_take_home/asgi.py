@@ -9,8 +9,9 @@ https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
 
 import os
 
+from api_take_home import settings_module
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'api_take_home.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module())
 
 application = get_asgi_application()
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -22,6 +23,10 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = 'django-insecure-x%67rpdns)c&0y1+mkj31l^pplok&9kz1uz2j^_xkg3lz6!$5n'
 
+# Key of the card number fingerprints (see api.models.card_fingerprint). Changing it
+# invalidates every stored fingerprint, so keep it even when SECRET_KEY is rotated.
+CARD_FINGERPRINT_KEY = SECRET_KEY
+
 # SECURITY WARNING: don't run with debug turned on in production!
 DEBUG = True
 
@@ -41,6 +46,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -48,6 +54,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'api.routers.ReplicaPinningMiddleware',
 ]
 
 ROOT_URLCONF = 'api_take_home.urls'
@@ -81,6 +88,62 @@ DATABASES = {
     }
 }
 
+# Read replicas (see api/routers.py). GET requests read from one of
+# DATABASE_REPLICAS, writes and the reads that follow them go to 'default'.
+#
+# To try it locally point API_TAKE_HOME_READ_REPLICA at a second SQLite file, e.g.
+# a copy of db.sqlite3 (cp db.sqlite3 replica.sqlite3 stands in for replication),
+# or at db.sqlite3 itself for a replica without lag.
+DATABASE_REPLICAS = []
+
+if os.environ.get('API_TAKE_HOME_READ_REPLICA'):
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ['API_TAKE_HOME_READ_REPLICA'],
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS = ['replica']
+
+# Order shards (see api/sharding.py). Orders and their payments are spread over
+# these databases by order id, everything else stays on 'default', which is also
+# the first shard. API_TAKE_HOME_ORDER_SHARDS=N adds N - 1 local SQLite shards
+# next to db.sqlite3, create their tables with
+# `python manage.py migrate --database shard1` (and so on) after migrating default.
+ORDER_SHARDS = ['default']
+
+for shard in range(1, int(os.environ.get('API_TAKE_HOME_ORDER_SHARDS', 1))):
+    DATABASES['shard{}'.format(shard)] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db_shard{}.sqlite3'.format(shard),
+    }
+    ORDER_SHARDS.append('shard{}'.format(shard))
+
+DATABASE_ROUTERS = ['api.routers.ShardRouter', 'api.routers.PrimaryReplicaRouter']
+
+# Seconds during which a client that wrote keeps reading from the primary, this
+# should cover the replication lag
+REPLICA_PIN_SECONDS = 5
+
+# Retries of payments which failed with a transient processor error (see
+# api/retries.py). A payment is submitted at most PAYMENT_RETRY_MAX_ATTEMPTS times,
+# the first retry comes PAYMENT_RETRY_BASE_DELAY seconds after the failure and
+# every following one twice as late, up to PAYMENT_RETRY_MAX_DELAY seconds.
+PAYMENT_RETRY_MAX_ATTEMPTS = 5
+PAYMENT_RETRY_BASE_DELAY = 30
+PAYMENT_RETRY_MAX_DELAY = 3600
+
+# Per-request profiling (see api/profiling.py). Off unless
+# API_TAKE_HOME_PROFILE_REQUESTS=1, the middleware then removes itself at startup.
+# When on, PROFILE_TOKEN is required: requests sent with an X-Profile header
+# holding it are profiled, and a PROFILE_SAMPLE_RATE share of the others. The
+# /api/profiles/ endpoints need the same header. The newest PROFILE_KEEP profiles
+# are kept in PROFILE_DIR.
+PROFILE_REQUESTS = os.environ.get('API_TAKE_HOME_PROFILE_REQUESTS') == '1'
+PROFILE_TOKEN = os.environ.get('API_TAKE_HOME_PROFILE_TOKEN', '')
+PROFILE_SAMPLE_RATE = float(os.environ.get('API_TAKE_HOME_PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.environ.get('API_TAKE_HOME_PROFILE_DIR', BASE_DIR / 'profiles')
+PROFILE_KEEP = 200
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
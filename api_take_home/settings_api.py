@@ -0,0 +1,47 @@
+"""
+API-only settings for api_take_home.
+
+Select them with API_TAKE_HOME_PROFILE=api (or DJANGO_SETTINGS_MODULE). Only the
+apps and middleware needed by the JSON endpoints in api/urls.py are loaded: no
+admin, sessions, messages, auth, CSRF or clickjacking protection, no templates
+and no browsable API. DEBUG is off, so queries are not kept in memory.
+
+See benchmarks/runtime_profile.py for a comparison with settings.py.
+"""
+
+import os
+
+from api_take_home.settings import *  # noqa: F401,F403
+
+
+DEBUG = False
+
+ALLOWED_HOSTS = os.environ.get("API_TAKE_HOME_ALLOWED_HOSTS", "localhost,127.0.0.1").split(",")
+
+# contenttypes backs Payment.payment_method
+INSTALLED_APPS = [
+    'django.contrib.contenttypes',
+    'api',
+]
+
+MIDDLEWARE = [
+    'api.profiling.ProfilingMiddleware',
+    'django.middleware.common.CommonMiddleware',
+    'api.routers.ReplicaPinningMiddleware',
+]
+
+ROOT_URLCONF = 'api_take_home.urls_api'
+
+TEMPLATES = []
+
+AUTH_PASSWORD_VALIDATORS = []
+
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': ['rest_framework.renderers.JSONRenderer'],
+    'DEFAULT_PARSER_CLASSES': ['rest_framework.parsers.JSONParser'],
+    # The endpoints are not authenticated, and without these DRF would import
+    # django.contrib.auth for every request
+    'DEFAULT_AUTHENTICATION_CLASSES': [],
+    'DEFAULT_PERMISSION_CLASSES': ['rest_framework.permissions.AllowAny'],
+    'UNAUTHENTICATED_USER': None,
+}
@@ -0,0 +1,9 @@
+"""api_take_home URL Configuration of the API-only profile (settings_api.py).
+
+Same as urls.py without the admin.
+"""
+from django.urls import path, include
+
+urlpatterns = [
+    path("api/", include("api.urls", namespace="api")),
+]
@@ -0,0 +1,76 @@
+""" Throughput of the batch card validation in api/card_validation.py.
+
+Usage: python benchmarks/card_validation.py [count]
+
+Generates `count` random card numbers (default 1,000,000) with valid checksums
+across every supported brand and validates them in batches on a single core.
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "api_take_home.settings")
+
+import django
+
+django.setup()
+
+from api.card_validation import clean_cards, luhn_valid, validate_numbers  # noqa: E402
+
+
+BATCH_SIZE = 10000
+PREFIXES = [("4", 16), ("51", 16), ("2221", 16), ("34", 15), ("37", 15), ("6011", 16), ("65", 16)]
+
+
+def with_check_digit(partial):
+    for digit in "0123456789":
+        if luhn_valid(partial + digit):
+            return partial + digit
+
+
+def random_numbers(count, seed=0):
+    rng = random.Random(seed)
+    numbers = []
+    for _ in range(count):
+        prefix, length = rng.choice(PREFIXES)
+        body = "".join(rng.choice("0123456789") for _ in range(length - len(prefix) - 1))
+        numbers.append(with_check_digit(prefix + body))
+    return numbers
+
+
+def timed(label, count, func):
+    started = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - started
+    print("{:<28} {:>10,} rows in {:6.2f}s  {:>12,.0f} rows/min".format(
+        label, count, elapsed, count / elapsed * 60
+    ))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    numbers = random_numbers(count)
+    rows = [
+        {"number": number, "exp_month": 12, "exp_year": 30}
+        for number in numbers
+    ]
+    batches = range(0, count, BATCH_SIZE)
+
+    def run_numbers():
+        for start in batches:
+            results = validate_numbers(numbers[start:start + BATCH_SIZE])
+            assert not any(errors for _, errors in results)
+
+    def run_rows():
+        for start in batches:
+            assert not any(clean_cards(rows[start:start + BATCH_SIZE]))
+
+    timed("validate_numbers", count, run_numbers)
+    timed("clean_cards", count, run_rows)
+
+
+if __name__ == "__main__":
+    main()
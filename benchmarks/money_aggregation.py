@@ -0,0 +1,158 @@
+""" Aggregation over a large Payment table with amounts in integer cents.
+
+Usage: python benchmarks/money_aggregation.py [payments]
+
+Runs in a fresh interpreter against a new SQLite file in a temporary directory.
+`payments` payments (default 200,000, two per order) are created, and a copy of
+every amount is kept in a decimal column next to the cents, the way amounts were
+stored before api/money.py. The same totals are then computed from both columns:
+in SQL, over the whole table and per order (what rebuild_settlements and the
+capture validation run), and in Python, over values already loaded from the
+database. Every timing is the best of RUNS runs.
+"""
+
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = 5
+BATCH_SIZE = 5000
+
+
+def best_of(function):
+    timings = []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def setup_database(directory):
+    from django.conf import settings
+    from django.core.management import call_command
+
+    # Before the first connection is opened, the settings point at the project's file
+    settings.DATABASES["default"]["NAME"] = os.path.join(directory, "default.sqlite3")
+    call_command("migrate", verbosity=0)
+
+
+def create_payments(count):
+    from django.db import connection
+
+    from api.models import Order, Payment
+
+    random.seed(0)
+    orders = Order.objects.bulk_create(
+        [Order(id=pk, order_total=0, ebt_total=0) for pk in range(1, count // 2 + 1)],
+        batch_size=BATCH_SIZE,
+    )
+    Payment.objects.bulk_create(
+        [
+            Payment(
+                id=pk, order_id=orders[(pk - 1) // 2].pk, amount=random.randint(1, 50000),
+                description="benchmark",
+            )
+            for pk in range(1, len(orders) * 2 + 1)
+        ],
+        batch_size=BATCH_SIZE,
+    )
+    with connection.cursor() as cursor:
+        cursor.execute("ALTER TABLE api_payment ADD COLUMN amount_decimal decimal")
+        cursor.execute("UPDATE api_payment SET amount_decimal = amount / 100.0")
+
+
+def measure_sql():
+    from django.db import connection
+
+    def query(sql):
+        def run():
+            with connection.cursor() as cursor:
+                cursor.execute(sql)
+                return cursor.fetchall()
+        return run
+
+    results = {}
+    for name, column in (("cents", "amount"), ("decimal", "amount_decimal")):
+        total_seconds, total = best_of(query("SELECT SUM({}) FROM api_payment".format(column)))
+        per_order_seconds, _ = best_of(query(
+            "SELECT order_id, SUM({}) FROM api_payment GROUP BY order_id".format(column)
+        ))
+        results[name] = {"total": total_seconds, "per_order": per_order_seconds, "value": str(total[0][0])}
+    return results
+
+
+def measure_python():
+    from api.models import Payment
+    from api.money import to_decimal
+
+    cents = list(Payment.objects.order_by("pk").values_list("order_id", "amount"))
+    decimals = [(order_id, to_decimal(amount)) for order_id, amount in cents]
+
+    def per_order(rows):
+        def run():
+            totals = defaultdict(int)
+            for order_id, amount in rows:
+                totals[order_id] += amount
+            return totals
+        return run
+
+    results = {}
+    for name, rows in (("cents", cents), ("decimal", decimals)):
+        amounts = [amount for _, amount in rows]
+        total_seconds, total = best_of(lambda: sum(amounts))
+        per_order_seconds, _ = best_of(per_order(rows))
+        results[name] = {"total": total_seconds, "per_order": per_order_seconds, "value": str(total)}
+    return results
+
+
+def child(payments):
+    sys.path.insert(0, ROOT)
+    os.environ["DJANGO_SETTINGS_MODULE"] = "api_take_home.settings"
+    import django
+
+    django.setup()
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup_database(directory)
+        create_payments(payments)
+        results = {"sql": measure_sql(), "python": measure_python()}
+
+    print(json.dumps(results))
+
+
+def run_child(payments):
+    env = dict(os.environ)
+    for name in ("DJANGO_SETTINGS_MODULE", "API_TAKE_HOME_READ_REPLICA", "API_TAKE_HOME_PROFILE", "API_TAKE_HOME_ORDER_SHARDS"):
+        env.pop(name, None)
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", str(payments)],
+        env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    payments = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    print("{} payments, {} orders, best of {} runs".format(payments, payments // 2, RUNS))
+    print("{:>7} {:>8} {:>12} {:>14} {:>20}".format("where", "amounts", "total ms", "per order ms", "total"))
+    results = run_child(payments)
+    for where in ("sql", "python"):
+        for name in ("cents", "decimal"):
+            result = results[where][name]
+            print("{:>7} {:>8} {:>12.1f} {:>14.1f} {:>20}".format(
+                where, name, result["total"] * 1000, result["per_order"] * 1000, result["value"]
+            ))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        child(int(sys.argv[2]))
+    else:
+        main()
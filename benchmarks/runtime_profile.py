@@ -0,0 +1,115 @@
+""" Startup time and per-request overhead of the full and API-only settings profiles.
+
+Usage: python benchmarks/runtime_profile.py [requests]
+
+Every measurement runs in a fresh interpreter so that the profiles do not share
+imported modules. "app + urls" is the time to build the WSGI application and load
+the URLconf, "process start" the whole run including the interpreter and
+django.setup(). Per-request overhead is measured with the test client against an
+in-memory database, on GET /api/orders/:id/ (a single query).
+"""
+
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROFILES = ("full", "api")
+STARTUP_RUNS = 5
+
+
+def measure_startup():
+    started = time.perf_counter()
+    from django.core.wsgi import get_wsgi_application
+    from django.urls import get_resolver
+
+    get_wsgi_application()
+    get_resolver().url_patterns
+    return {"startup": time.perf_counter() - started, "modules": len(sys.modules)}
+
+
+def measure_requests(count):
+    from django.conf import settings
+    from django.db import connection, reset_queries
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    connection.creation.create_test_db(verbosity=0)
+
+    from api.models import Order
+
+    order = Order.objects.create(order_total=2045, ebt_total=1000) # cents
+    client = Client()
+    path = "/api/orders/{}/".format(order.pk)
+    client.get(path) # warm up
+
+    # The test runner always forces DEBUG off, put the profile's value back to see
+    # the cost of query logging
+    settings.DEBUG = PROFILE_DEBUG[os.environ["API_TAKE_HOME_PROFILE"]]
+    reset_queries()
+
+    started = time.perf_counter()
+    for _ in range(count):
+        response = client.get(path)
+        assert response.status_code == 200, response.status_code
+    elapsed = time.perf_counter() - started
+    # connection.queries is reset at the start of every request, so what matters is
+    # whether queries are being recorded at all
+    return {"per_request": elapsed / count, "query_log": connection.queries_logged}
+
+
+PROFILE_DEBUG = {"full": True, "api": False}
+
+
+def child(mode, count):
+    sys.path.insert(0, ROOT)
+    from api_take_home import settings_module
+
+    os.environ["DJANGO_SETTINGS_MODULE"] = settings_module()
+    import django
+
+    django.setup()
+    result = measure_startup() if mode == "startup" else measure_requests(count)
+    print(json.dumps(result))
+
+
+def run_child(profile, mode, count):
+    env = dict(os.environ, API_TAKE_HOME_PROFILE=profile)
+    env.pop("DJANGO_SETTINGS_MODULE", None)
+    started = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", mode, str(count)],
+        env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process"] = time.perf_counter() - started
+    return result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    print("{:<6} {:>14} {:>14} {:>9} {:>14} {:>15}".format(
+        "", "process start", "app + urls", "modules", "per request", "query logging"
+    ))
+    for profile in PROFILES:
+        startups = [run_child(profile, "startup", 0) for _ in range(STARTUP_RUNS)]
+        requests = run_child(profile, "requests", count)
+        print("{:<6} {:>12.1f}ms {:>12.1f}ms {:>9} {:>12.1f}us {:>15}".format(
+            profile,
+            statistics.median(run["process"] for run in startups) * 1000,
+            statistics.median(run["startup"] for run in startups) * 1000,
+            startups[0]["modules"],
+            requests["per_request"] * 1e6,
+            "on" if requests["query_log"] else "off",
+        ))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        child(sys.argv[2], int(sys.argv[3]))
+    else:
+        main()
@@ -0,0 +1,187 @@
+""" Capture throughput with orders spread over 1, 2 and 4 SQLite shards.
+
+Usage: python benchmarks/shard_capture.py [orders]
+
+Every shard count runs in a fresh interpreter against new SQLite files in a
+temporary directory (API_TAKE_HOME_ORDER_SHARDS, see api_take_home/settings.py).
+Each order has a credit card and an EBT payment. One process per shard (forked
+like the workers of a WSGI server, and pinned to its own core when there are
+enough) captures the orders of its shard through POST /api/orders/:id/capture/.
+The processor always succeeds so that every run does the same writes.
+
+Next to the throughput, the statements a capture of an order on a shard other
+than 'default' writes to 'default' are counted. There should be none: those
+captures leave their rollup and event changes on their shard, and merge_outbox
+moves them to 'default' afterwards (its time is reported separately). The
+speedup is bound by the number of cores, which is printed first.
+"""
+
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHARD_COUNTS = (1, 2, 4)
+
+
+def setup_databases(directory):
+    from django.conf import settings
+    from django.core.management import call_command
+
+    # Before the first connection is opened, the settings point at the project's files
+    for alias in settings.ORDER_SHARDS:
+        settings.DATABASES[alias]["NAME"] = os.path.join(directory, alias + ".sqlite3")
+        settings.DATABASES[alias]["OPTIONS"] = {"timeout": 60}
+    for alias in settings.ORDER_SHARDS:
+        call_command("migrate", database=alias, verbosity=0)
+
+
+def create_orders(count):
+    from api.models import CreditCard, EBTCard, Order, Payment
+    from api.sharding import new_order_id, new_payment_id
+
+    credit_card, _ = CreditCard.objects.vault(
+        number="4111111111111111", last_4="1111", brand="visa", exp_month=2, exp_year=30
+    )
+    ebt_card, _ = EBTCard.objects.vault(number="6007600000000007", last_4="0007", brand="visa")
+
+    order_ids = []
+    for _ in range(count):
+        order = Order(id=new_order_id(), order_total=2045, ebt_total=1000) # cents
+        order.save(force_insert=True)
+        for card, amount in ((credit_card, 1245), (ebt_card, 800)):
+            Payment(
+                id=new_payment_id(order.pk), order=order, amount=amount, description="benchmark",
+                payment_method=card, status=Payment.TYPE_REQ_CONF,
+            ).save(force_insert=True)
+        order_ids.append(order.pk)
+    return order_ids
+
+
+def capture_orders(worker, order_ids):
+    from django.db import DEFAULT_DB_ALIAS, connections
+    from django.test import Client
+
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cores[worker % len(cores)]})
+
+    default_writes = []
+
+    def count_writes(execute, sql, params, many, context):
+        if not sql.lstrip().upper().startswith(("SELECT", "SAVEPOINT", "RELEASE")):
+            default_writes.append(sql)
+        return execute(sql, params, many, context)
+
+    client = Client()
+    failures = 0
+    with connections[DEFAULT_DB_ALIAS].execute_wrapper(count_writes):
+        for order_id in order_ids:
+            if client.post("/api/orders/{}/capture/".format(order_id)).status_code != 200:
+                failures += 1
+    connections.close_all()
+    return failures, len(default_writes)
+
+
+def capture(order_ids):
+    from django.db import connections
+
+    from api.sharding import order_shards, shard_for_id
+
+    # One process per shard, each with its own connections
+    by_shard = {alias: [] for alias in order_shards()}
+    for order_id in order_ids:
+        by_shard[shard_for_id(order_id) or "default"].append(order_id)
+
+    connections.close_all()
+    context = multiprocessing.get_context("fork")
+    with context.Pool(len(by_shard)) as pool:
+        started = time.perf_counter()
+        results = pool.starmap(capture_orders, enumerate(by_shard.values()))
+        seconds = time.perf_counter() - started
+
+    # Writes to 'default' per capture of an order on another shard
+    other_orders = sum(len(ids) for alias, ids in by_shard.items() if alias != "default")
+    other_writes = sum(writes for alias, (_, writes) in zip(by_shard, results) if alias != "default")
+    return seconds, sum(failures for failures, _ in results), other_writes / other_orders if other_orders else None
+
+
+def merge():
+    from api.outbox import merge_outbox
+
+    started = time.perf_counter()
+    merge_outbox()
+    return time.perf_counter() - started
+
+
+def child(shards, orders):
+    sys.path.insert(0, ROOT)
+    os.environ["DJANGO_SETTINGS_MODULE"] = "api_take_home.settings"
+    import django
+
+    django.setup()
+
+    import contextlib
+    import io
+
+    from django.conf import settings
+
+    import processor
+
+    settings.DEBUG = False
+    settings.ALLOWED_HOSTS = ["testserver"]
+    processor.false_5_percent = lambda: True
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup_databases(directory)
+        order_ids = create_orders(orders)
+        # The views still print a few debugging lines per request
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds, failures, default_writes = capture(order_ids)
+        merge_seconds = merge()
+
+    print(json.dumps({
+        "seconds": seconds, "failures": failures, "default_writes": default_writes, "merge_seconds": merge_seconds,
+    }))
+
+
+def run_child(shards, orders):
+    env = dict(os.environ, API_TAKE_HOME_ORDER_SHARDS=str(shards))
+    for name in ("DJANGO_SETTINGS_MODULE", "API_TAKE_HOME_READ_REPLICA", "API_TAKE_HOME_PROFILE"):
+        env.pop(name, None)
+    output = subprocess.run(
+        [sys.executable, __file__, "--child", str(shards), str(orders)],
+        env=env, check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    orders = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    print("{} orders (2 payments each), one capture process per shard, {} cores".format(orders, cores))
+    print("{:>6} {:>10} {:>14} {:>9} {:>22} {:>10} {:>9}".format(
+        "shards", "seconds", "captures/s", "speedup", "writes to default/op", "merge s", "failed"
+    ))
+    baseline = None
+    for shards in SHARD_COUNTS:
+        result = run_child(shards, orders)
+        rate = orders / result["seconds"]
+        baseline = baseline or rate
+        default_writes = result["default_writes"]
+        print("{:>6} {:>10.2f} {:>14.0f} {:>8.2f}x {:>22} {:>10.2f} {:>9}".format(
+            shards, result["seconds"], rate, rate / baseline,
+            "-" if default_writes is None else "{:.1f}".format(default_writes),
+            result["merge_seconds"], result["failures"],
+        ))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        child(int(sys.argv[2]), int(sys.argv[3]))
+    else:
+        main()
@@ -3,11 +3,16 @@
 # ACME acts as an intermediary between merchants and EBT processors
 # which differ by state.
 
+from collections import defaultdict
 from random import uniform
 
+from django.db import router, transaction
 from django.utils import timezone
 
-from api.models import Payment
+from api.models import Payment, PaymentAttempt
+from api.events import record_status_events
+from api.retries import next_retry_at
+from api.settlements import record_payment_transitions
 
 # 95% would be a terrible uptime for a payments app!  
 def false_5_percent():
@@ -22,24 +27,80 @@ def random_error():
         return "Card network outage"
     
 
-def processPayment(payment_obj):
-    if payment_obj.status == Payment.TYPE_SUCCEEDED:
-        return None # don't double process
-
-    if false_5_percent():
-        # Payment was successful
-        
-        payment_obj.status = Payment.TYPE_SUCCEEDED
-        payment_obj.success_date = timezone.now()
-        payment_obj.save()
-    else:
-        payment_obj.status = Payment.TYPE_FAILED
+def authorizePayments(payments):
+    """ One batch authorization call upstream, returns None (approved) or an error
+    message for each payment.
+    """
+    return [None if false_5_percent() else random_error() for _ in payments]
 
-        error_message = random_error()
-        payment_obj.last_processing_error = error_message
 
-        payment_obj.save()
+# Columns written back after processing, nothing else about a payment changes
+PROCESSED_FIELDS = [
+    "status",
+    "success_date",
+    "processed_date",
+    "last_processing_error",
+    "attempt_count",
+    "next_retry_at",
+]
 
-        return error_message
 
-    
+def processPayments(payments):
+    """ Submits payments to the processor as a single batch.
+
+    Returns one result per payment, in the same order: None if the payment succeeded
+    (or had already succeeded), the processor's error message otherwise. The status
+    changes are written back with one bulk_update per database, together with their
+    attempt history, settlement rollups and feed events. Payments which failed with a
+    transient error are scheduled for a retry (see api/retries.py).
+    """
+    payments = list(payments)
+    pending = [payment_obj for payment_obj in payments if payment_obj.status != Payment.TYPE_SUCCEEDED] # don't double process
+    if not pending:
+        return [None for _ in payments]
+    errors =dict(zip(map(id, pending), authorizePayments(pending)))
+
+    processed_date = timezone.now()
+    transitions = defaultdict(list)
+    for payment_obj in pending:
+        transitions[router.db_for_write(Payment, instance=payment_obj)].append(
+            (payment_obj, payment_obj.status, payment_obj.processed_date)
+        )
+        payment_obj.processed_date = processed_date
+        payment_obj.attempt_count += 1
+
+        error_message = errors[id(payment_obj)]
+        if error_message is None:
+            # Payment was successful
+            payment_obj.status = Payment.TYPE_SUCCEEDED
+            payment_obj.success_date = processed_date
+            payment_obj.next_retry_at = None
+        else:
+            payment_obj.status = Payment.TYPE_FAILED
+            payment_obj.last_processing_error = error_message
+            payment_obj.next_retry_at = next_retry_at(payment_obj, processed_date)
+
+    # The status changes, their settlement rollups and their feed events are written
+    # together, in the payments' database (see api/outbox.py for sharded orders).
+    for payment_db, batch in transitions.items():
+        processed = [payment_obj for payment_obj, _, _ in batch]
+        with transaction.atomic(using=payment_db):
+            Payment.objects.using(payment_db).bulk_update(processed, PROCESSED_FIELDS)
+            PaymentAttempt.objects.using(payment_db).bulk_create([
+                PaymentAttempt(
+                    payment_id=payment_obj.pk,
+                    attempt=payment_obj.attempt_count,
+                    status=payment_obj.status,
+                    error=errors[id(payment_obj)],
+                )
+                for payment_obj in processed
+            ])
+            record_payment_transitions(batch, payment_db)
+            record_status_events(processed, payment_db)
+
+    return [errors.get(id(payment_obj)) for payment_obj in payments]
+
+
+def processPayment(payment_obj):
+    """ Processes a single payment, see processPayments. """
+    return processPayments([payment_obj])[0]